@@ -0,0 +1,124 @@
+#!/usr/bin/env python2
+#
+# Reader for EDI capture files with peek support
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import io
+import sys
+import mmap
+
+# Size of the buffer used for stdin and pipes
+RING_SIZE = 4 * 1024 * 1024
+
+class BufferedFile:
+    """Read a file with peek() support.
+
+    Regular files are memory-mapped, and read() and peek() only move a
+    cursor. Streams that cannot be mapped (stdin, pipes) are read in large
+    blocks into a fixed buffer that gets compacted when it runs full.
+
+    read() and peek() return a str of at most n bytes, shorter only at EOF.
+    For a mapped file, slicing the mapping copies the requested bytes only.
+
+    For regular files, start and end restrict reading to a byte range."""
+
+    # The returned buffers stay valid after further reads
+    persistent = True
+
+    def __init__(self, fname, ring_size=RING_SIZE, start=0, end=None):
+        if fname == "-":
+            self.fd = io.open(sys.stdin.fileno(), "rb", closefd=False)
+        else:
+            self.fd = io.open(fname, "rb")
+
+        self.map = None
+        self.pos = 0
+
+        try:
+            self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError, mmap.error):
+            # Empty files, pipes and terminals cannot be mapped
+            self.map = None
+
+        if self.map is not None:
+            self.data = self.map
+            self.size = len(self.map) if end is None else min(end, len(self.map))
+            self.pos = start
+        elif start != 0 or end is not None:
+            raise ValueError("Byte ranges need a regular file")
+        else:
+            self.ring = bytearray(ring_size)
+            self.start = 0
+            self.end = 0
+            self.eof = False
+
+    def _fill(self, n):
+        """Make sure n bytes are available in the ring buffer, unless EOF"""
+        while self.end - self.start < n and not self.eof:
+            if len(self.ring) - self.start < n:
+                # Move the remaining data to the front
+                avail = self.end - self.start
+                if len(self.ring) < n:
+                    ring = bytearray(max(n, 2 * len(self.ring)))
+                    ring[:avail] = self.ring[self.start:self.end]
+                    self.ring = ring
+                else:
+                    self.ring[:avail] = self.ring[self.start:self.end]
+                self.start = 0
+                self.end = avail
+
+            view = memoryview(self.ring)[self.end:]
+            num_read = self.fd.readinto(view)
+            del view
+            if not num_read:
+                self.eof = True
+            else:
+                self.end += num_read
+
+    def peek(self, n):
+        if self.map is not None:
+            return self.data[self.pos:min(self.pos + n, self.size)]
+        else:
+            self._fill(n)
+            n = min(n, self.end - self.start)
+            return memoryview(self.ring)[self.start:self.start + n].tobytes()
+
+    def read(self, n):
+        if self.map is not None:
+            ret = self.data[self.pos:min(self.pos + n, self.size)]
+        else:
+            ret = self.peek(n)
+            self.start += len(ret)
+        self.pos += len(ret)
+        return ret
+
+    def tell(self):
+        """Position in the file"""
+        return self.pos
+
+    def close(self):
+        if self.map is not None:
+            self.data = None
+            self.map.close()
+        self.fd.close()
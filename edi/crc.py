@@ -1,4 +1,19 @@
 #library for crc16 calculation
+#
+# CRC-16-CCITT (polynomial 0x1021, MSB first) as used by EDI (ETSI TS 102 821),
+# ETI (EN 300 799) and UECP. The same module is used by edi/ and uecpparse/.
+#
+# crc16() runs in C through binascii.crc_hqx, which computes exactly this CRC
+# and accepts str/bytes, bytearray and memoryview without copying them. The
+# slicing-by-8 implementation below is the pure-python fallback, and is also
+# what crcbench.py compares against.
+
+import struct
+
+try:
+    from binascii import crc_hqx
+except ImportError:
+    crc_hqx = None
 
 
 crc16tab = [
@@ -35,12 +50,49 @@ crc16tab = [
     0xef1f, 0xff3e, 0xcf5d, 0xdf7c, 0xaf9b, 0xbfba, 0x8fd9, 0x9ff8,
     0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0 ]
 
-def crc16(data, l_crc=0xffff):
-    for d in data:
-        #print("crc 0x{:02x} 0x{:04x}".format(ord(d), l_crc))
-        l_crc = (l_crc << 8) ^ crc16tab[(l_crc >> 8) ^ ord(d)]
-        l_crc = l_crc & 0xFFFF
+def _make_slice_tables(num_slices):
+    """Table n gives the CRC contribution of a byte followed by n zero bytes"""
+    tables = [crc16tab]
+    for n in range(1, num_slices):
+        prev = tables[-1]
+        tables.append([((v << 8) & 0xFFFF) ^ crc16tab[v >> 8] for v in prev])
+    return tables
+
+crc16_slices = _make_slice_tables(8)
+
+def _as_buffer(data):
+    # lists of ints (as used in uecpparse) need to be packed once, everything
+    # else supports the buffer protocol
+    if isinstance(data, (list, tuple)):
+        return bytearray(data)
+    return data
+
+def crc16_sliced(data, l_crc=0xffff):
+    """Slicing-by-8 CRC, eight bytes per loop iteration"""
+    data = _as_buffer(data)
+    t0, t1, t2, t3, t4, t5, t6, t7 = crc16_slices
+    n = len(data)
+    for i in range(0, n - 7, 8):
+        b0, b1, b2, b3, b4, b5, b6, b7 = struct.unpack_from("8B", data, i)
+        l_crc = (t7[b0 ^ (l_crc >> 8)] ^ t6[b1 ^ (l_crc & 0xFF)] ^
+                 t5[b2] ^ t4[b3] ^ t3[b4] ^ t2[b5] ^ t1[b6] ^ t0[b7])
+    tail = n - (n % 8)
+    for d in struct.unpack_from("{}B".format(n - tail), data, tail):
+        l_crc = ((l_crc << 8) & 0xFFFF) ^ crc16tab[(l_crc >> 8) ^ d]
 
     return l_crc
 
+def crc16(data, l_crc=0xffff):
+    """CRC over data, continuing from l_crc for incremental updates"""
+    return crc_hqx(_as_buffer(data), l_crc)
+
+if crc_hqx is None:
+    crc16 = crc16_sliced
+
+def crc16_many(buffers, l_crc=0xffff):
+    """Calculate the CRC of each buffer independently, all starting from l_crc"""
+    return [crc16(b, l_crc) for b in buffers]
 
+def crc_ccitt(data):
+    """CRC as transmitted in UECP frames: crc16 inverted"""
+    return crc16(data) ^ 0xFFFF
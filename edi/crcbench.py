@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+#
+# Compare the speed of the crc16 implementations in crc.py against the
+# byte-by-byte implementations that were used before.
+#
+# Usage: crcbench.py [buffer size] [iterations]
+
+import sys
+import timeit
+
+import crc
+
+def legacy_crc16(data, l_crc=0xffff):
+    # Former edi/crc.py implementation, for py2 str
+    for d in data:
+        l_crc = (l_crc << 8) ^ crc.crc16tab[(l_crc >> 8) ^ ord(d)]
+        l_crc = l_crc & 0xFFFF
+
+    return l_crc
+
+def legacy_crc16_int(data, l_crc=0xffff):
+    # Former uecpparse/crc.py implementation, for sequences of int
+    for d in data:
+        l_crc = (l_crc << 8) ^ crc.crc16tab[(l_crc >> 8) ^ d]
+        l_crc = l_crc & 0xFFFF
+
+    return l_crc
+
+def legacy_crc_ccitt(data):
+    # Former uecpparse/crc.py implementation
+    l_crc = 0xFFFF
+
+    for d in data:
+        l_crc = (((l_crc >> 8) & 0xFF) | (l_crc << 8)) & 0xFFFF
+        l_crc ^= d
+        l_crc ^= ((l_crc & 0xff) >> 4) & 0xFFFF
+        l_crc ^= ((l_crc << 8) << 4) & 0xFFFF
+        l_crc ^= (((l_crc & 0xff) << 4) << 1) & 0xFFFF
+
+    return ((l_crc ^ 0xFFFF) & 0xFFFF)
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 6144
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    data = bytearray((i * 7 + 3) & 0xFF for i in range(size))
+    data_str = bytes(data)
+    if isinstance(data_str[0], int):
+        legacy = lambda: legacy_crc16_int(data)
+    else:
+        legacy = lambda: legacy_crc16(data_str)
+
+    expected = legacy()
+    candidates = [
+            ("legacy byte loop", legacy),
+            ("legacy crc_ccitt", lambda: legacy_crc_ccitt(data) ^ 0xFFFF),
+            ("slicing-by-8", lambda: crc.crc16_sliced(data)),
+            ("crc16 bytearray", lambda: crc.crc16(data)),
+            ("crc16 memoryview", lambda: crc.crc16(memoryview(data)[1:])),
+            ]
+
+    print("{} bytes, {} iterations".format(size, iterations))
+    for name, fn in candidates:
+        if name.endswith("memoryview"):
+            ok = fn() == legacy_crc16_int(data[1:])
+        else:
+            ok = fn() == expected
+        t = timeit.timeit(fn, number=iterations) / iterations
+        print("{:20s} {:10.1f} us/call {:8.1f} MB/s {}".format(
+            name, t * 1e6, size / t / 1e6, "ok" if ok else "MISMATCH"))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python2
+#
+# Benchmarks for the EDI decoder in edidecoder.py, on synthetic captures from
+# edigen.py. Every stage of the decoder is measured on its own:
+#
+#  sync      finding the packets in a capture, as done for --jobs and the index
+#  crc       the PFT header and AF packet CRCs
+#  defrag    PFT parsing and reassembly of the AF packets, without decoding
+#            them, including the erasure correction for lost fragments
+#  rs-verify recalculation of the RS protection of complete fragment sets
+#  eti       building the ETI frames from the decoded data
+#  fic       decoding the FIC of the frames into the ensemble database
+#  pipeline  everything together, what edidebug -o does
+#
+# The rates are given in packets/s and frames/s. For rs-verify, the packets
+# are the RS chunks. The results can be saved as JSON baseline, and later
+# runs compared to it by frames/s.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import os
+import sys
+import json
+import struct
+import timeit
+import argparse
+import platform
+
+import edidebug
+import edidecoder
+import edigen
+import edisync
+from crc import crc16
+from ficdecoder import FicDecoder
+from udpreceiver import DatagramStream
+
+# name: edigen.generate() options
+CORPORA = [
+        ("af", dict(mode="af")),
+        ("pft", dict(mode="pft", fragments=6)),
+        ("pft-rs", dict(mode="pft-rs", fragments=6)),
+        ("pft-rs-loss", dict(mode="pft-rs", fragments=12, loss=0.02)),
+        ("pft-rs-reorder", dict(mode="pft-rs", fragments=12, reorder=5)),
+        ]
+
+STAGES = ("sync", "crc", "defrag", "rs-verify", "eti", "fic", "pipeline")
+
+class Corpus:
+    def __init__(self, name, num_frames, seed, options):
+        self.name = name
+        self.options = options
+        self.af_packets, self.packets = edigen.generate(num_frames, seed=seed, **options)
+        self.capture = b"".join(self.packets)
+        self.num_frames = num_frames
+
+    def stream(self):
+        return DatagramStream(memoryview(self.capture), persistent=True)
+
+
+def bench_sync(corpus):
+    data = corpus.capture
+    pos = edisync.find_packet(data, 0)
+    num = 0
+    while pos is not None:
+        pos = edisync.find_packet(data, pos + edisync.packet_at(data, pos)[2])
+        num += 1
+    return num, corpus.num_frames
+
+def bench_crc(corpus):
+    num = 0
+    for packet in corpus.packets:
+        if packet[:2] == b"PF":
+            plen = struct.unpack_from("!H", packet, 10)[0]
+            header_len = 12 + (2 if plen & 0x8000 else 0) + (4 if plen & 0x4000 else 0)
+            crc = crc16(packet[:header_len]) ^ 0xFFFF
+            if crc != struct.unpack_from("!H", packet, header_len)[0]:
+                raise ValueError("PFT header CRC error")
+            num += 1
+    for packet in corpus.af_packets:
+        crc = crc16(memoryview(packet)[:-2]) ^ 0xFFFF
+        if crc != struct.unpack_from("!H", packet, len(packet) - 2)[0]:
+            raise ValueError("AF CRC error")
+        num += 1
+    return num, len(corpus.af_packets)
+
+def bench_defrag(corpus):
+    if corpus.options["mode"] == "af":
+        return None
+
+    num_frames = [0]
+    def count_af(in_data, is_stream=False):
+        num_frames[0] += 1
+        return True
+
+    decoder = edidecoder.EdiDecoder(verify_protection=False)
+    decoder.decode_af = count_af
+    for _ in edidebug.decode_stream(decoder, corpus.stream()):
+        pass
+    return len(corpus.packets), num_frames[0]
+
+def bench_rs_verify(corpus):
+    if corpus.options["mode"] != "pft-rs":
+        return None
+
+    rs_k = corpus.options.get("rs_k", edigen.RS_MAX_K)
+    zero_pad = 255 - 48 - rs_k
+    num = 0
+    for af in corpus.af_packets:
+        view = memoryview(af + b"\0" * (-len(af) % rs_k))
+        chunks = [view[i:i + rs_k] for i in range(0, len(view), rs_k)]
+        edidecoder.rs_codec.parity(chunks, zero_pad)
+        num += len(chunks)
+    return num, len(corpus.af_packets)
+
+def decode_frames(corpus):
+    """The decoded ETI data of all frames"""
+    frames = []
+    decoder = edidecoder.EdiDecoder(on_frame=lambda eti_data: frames.append(eti_data.copy()))
+    for _ in edidebug.decode_stream(decoder, corpus.stream()):
+        pass
+    return frames
+
+def bench_eti(frames):
+    buf = bytearray(edidecoder.ETI_FRAME_SIZE)
+    for frame in frames:
+        frame.build_eti(buf, 0)
+    return len(frames), len(frames)
+
+def bench_fic(frames):
+    fic_decoder = FicDecoder()
+    for frame in frames:
+        fic_decoder.decode_frame(frame)
+    return len(frames), len(frames)
+
+def bench_pipeline(corpus, devnull):
+    decoder = edidecoder.EdiDecoder()
+    num, first_fct, last_fct = edidebug.convert(decoder,
+            edidebug.decode_stream(decoder, corpus.stream()), devnull, 0)
+    return len(corpus.packets), num
+
+def measure(fn, repeat):
+    """Run fn repeat times, and return the rates of the fastest run"""
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        result = fn()
+        duration = timeit.default_timer() - start
+        if result is None:
+            return None
+        if best is None or duration < best[0]:
+            best = (duration, result)
+
+    duration, (num_packets, num_frames) = best
+    return {'packets_per_s': round(num_packets / duration, 1),
+            'frames_per_s': round(num_frames / duration, 1)}
+
+def run(num_frames, seed, repeat, corpora, stages):
+    results = {}
+    with open(os.devnull, "wb") as devnull:
+        for name, options in CORPORA:
+            if name not in corpora:
+                continue
+            corpus = Corpus(name, num_frames, seed, options)
+            frames = decode_frames(corpus) if "eti" in stages or "fic" in stages else None
+            benches = {
+                    "sync": lambda: bench_sync(corpus),
+                    "crc": lambda: bench_crc(corpus),
+                    "defrag": lambda: bench_defrag(corpus),
+                    "rs-verify": lambda: bench_rs_verify(corpus),
+                    "eti": lambda: bench_eti(frames),
+                    "fic": lambda: bench_fic(frames),
+                    "pipeline": lambda: bench_pipeline(corpus, devnull),
+                    }
+            results[name] = {}
+            for stage in STAGES:
+                if stage not in stages:
+                    continue
+                rates = measure(benches[stage], repeat)
+                if rates is not None:
+                    results[name][stage] = rates
+                    print("{:14s} {:10s} {:12.1f} packets/s {:10.1f} frames/s".format(
+                        name, stage, rates['packets_per_s'], rates['frames_per_s']))
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print the change against the baseline, returns the number of
+    regressions"""
+    num_regressions = 0
+    for name, stages in sorted(results.items()):
+        for stage, rates in sorted(stages.items()):
+            base = baseline.get(name, {}).get(stage)
+            if not base or not base.get('frames_per_s'):
+                continue
+            ratio = rates['frames_per_s'] / base['frames_per_s']
+            regression = ratio < 1.0 - tolerance
+            num_regressions += regression
+            print("{:14s} {:10s} {:+7.1f}% {}".format(name, stage,
+                (ratio - 1.0) * 100, "REGRESSION" if regression else ""))
+    return num_regressions
+
+
+if __name__ == "__main__":
+    program_description = """
+        Benchmark the stages of the EDI decoder on synthetic captures."""
+    parser = argparse.ArgumentParser(description=program_description)
+    parser.add_argument('-n','--frames', help='Number of ETI frames per capture',type=int,default=500)
+    parser.add_argument('-r','--repeat', help='Run every benchmark N times, and keep the fastest',type=int,default=3,metavar='N')
+    parser.add_argument('--seed', help='Seed for the synthetic captures',type=int,default=0)
+    parser.add_argument('-c','--corpus', help='Only run on this capture type, can be repeated',
+            action='append',choices=[name for name, options in CORPORA])
+    parser.add_argument('-s','--stage', help='Only run this stage, can be repeated',
+            action='append',choices=STAGES)
+    parser.add_argument('--save', help='Save the results as JSON baseline to FILE',metavar='FILE')
+    parser.add_argument('-b','--baseline', help='Compare to the JSON baseline in FILE, exit with 1 on regressions',metavar='FILE')
+    parser.add_argument('-t','--tolerance', help='Slowdown against the baseline that counts as regression',type=float,default=0.15)
+
+    cli_args = parser.parse_args()
+
+    if cli_args.frames < 1 or cli_args.repeat < 1:
+        parser.error("Invalid number of frames or repetitions")
+
+    corpora = cli_args.corpus or [name for name, options in CORPORA]
+    stages = cli_args.stage or STAGES
+
+    print("{} frames per capture, best of {} runs, {} {}, RS backend {}".format(
+        cli_args.frames, cli_args.repeat, platform.python_implementation(),
+        platform.python_version(), edidecoder.rs_codec.backend.name))
+
+    results = run(cli_args.frames, cli_args.seed, cli_args.repeat, corpora, stages)
+
+    if cli_args.save:
+        report = {'frames': cli_args.frames,
+                'seed': cli_args.seed,
+                'python': platform.python_version(),
+                'rs_backend': edidecoder.rs_codec.backend.name,
+                'results': results}
+        with open(cli_args.save, "w") as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+
+    if cli_args.baseline:
+        with open(cli_args.baseline) as fd:
+            baseline = json.load(fd)
+        if baseline.get('frames') != cli_args.frames or baseline.get('seed') != cli_args.seed:
+            print("Warning: the baseline was measured with {} frames and seed {}".format(
+                baseline.get('frames'), baseline.get('seed')))
+        print("Compared to {}:".format(cli_args.baseline))
+        if compare(results, baseline['results'], cli_args.tolerance):
+            sys.exit(1)
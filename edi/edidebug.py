@@ -4,6 +4,8 @@
 #
 # File format: concatenated data from UDP messages, no framing whatsoever
 #
+# The decoder itself is the EdiDecoder in edidecoder.py
+#
 # The MIT License (MIT)
 #
 # Copyright (c) 2019 Matthias P. Braendli
@@ -29,637 +31,489 @@
 import io
 import os
 import sys
+import mmap
+import time
 import struct
+import shutil
 import argparse
+import json
+import tempfile
+import collections
+import multiprocessing
+
+from bufferedfile import BufferedFile
+from ediindex import EdiIndex, EdiIndexError
+from udpreceiver import UdpReceiver, DatagramStream, parse_address
+from jitterbuffer import JitterBuffer, seq_distance
+from edisync import packet_at, find_packet
+from edidecoder import (EdiDecoder, EtiWriter, Printer, pft_head_struct,
+        QUIET, SUMMARY, HEADERS)
+from ficdecoder import FicDecoder
+from pacer import Pacer, FRAME_INTERVAL
+import zmqeti
+
+
+# Packets looked at before a cut point, to know the newest pseq before it
+SPLIT_HISTORY = 64
+# After a cut point, the fragments of this many pseqs must all be newer
+# than those before it
+SPLIT_LOOKAHEAD = 16
+
+def is_pft_cut(data, pos, newest):
+    """Check that no fragment of newest or of an earlier pseq comes at or
+    after pos, until the pseq has moved SPLIT_LOOKAHEAD past newest"""
+    while pos is not None:
+        sync, pseq, length = packet_at(data, pos)
+        if sync == "AF":
+            return True
+        distance = seq_distance(newest, pseq)
+        if distance == 0 or distance >= 0x8000:
+            return False
+        if distance > SPLIT_LOOKAHEAD:
+            return True
+        pos = find_packet(data, pos + length)
+    return True
 
-from crc import crc16
-from reedsolo import RSCodec
-
-class Printer:
-    def __init__(self):
-        self.indent = 0
-
-    def pr(self, s):
-        sys.stderr.write(" " * self.indent + s + "\n")
-
-    def hexpr(self, header, seq):
-        if isinstance(seq, str):
-            seq = bytearray(seq)
-
-        sys.stderr.write(" " * self.indent +
-                header +
-                " ({}): ".format(len(seq)) +
-                " ".join("{0:02x}".format(el) for el in seq) +
-                "\n")
-
-    def inc(self):
-        self.indent += 1
-    def dec(self):
-        self.indent -= 1
-
-class BufferedFile:
-    def __init__(self, fname):
-        self.buf = []
-
-        if fname == "-":
-            self.fd = sys.stdin
-        else:
-            self.fd = open(fname, "rb")
-
-    def read(self, n):
-        if not self.buf:
-            return self.fd.read(n)
-        else:
-            if len(self.buf) < n:
-                self.buf.extend(self.fd.read(n - len(self.buf)))
-
-            if len(self.buf) == n:
-                ret = b"".join(self.buf)
-                self.buf = []
+def split_capture(fname, num_chunks):
+    """Cut the capture file into at most num_chunks byte ranges, which
+    start either on an AF packet, or on a PFT fragment such that the
+    fragments after it all belong to newer pseqs than those before it.
+    Then every fragment set is in one range, even when the fragments are
+    reordered. Returns a list of (start, end) tuples."""
+    with io.open(fname, "rb") as fd:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    size = len(data)
+
+    starts = [0]
+    for i in range(1, num_chunks):
+        pos = find_packet(data, max(size * i // num_chunks, starts[-1] + 1))
+        newest = None
+        num_packets = 0
+        while pos is not None:
+            sync, pseq, length = packet_at(data, pos)
+            if sync == "AF":
+                break
+            if num_packets >= SPLIT_HISTORY and is_pft_cut(data, pos, newest):
+                break
+            if newest is None or 0 < seq_distance(newest, pseq) < 0x8000:
+                newest = pseq
+            num_packets += 1
+            pos = find_packet(data, pos + length)
+
+        if pos is None:
+            break
+        starts.append(pos)
+
+    data.close()
+    return list(zip(starts, starts[1:] + [size]))
+
+def convert_range(args):
+    """Worker for parallel conversion: convert a byte range of the EDI file
+    into an ETI file, with its own decoder"""
+    filename, start, end, eti_filename, decoder_options = args
+
+    decoder = EdiDecoder(**decoder_options)
+
+    stream = BufferedFile(filename, start=start, end=end)
+    with open(eti_filename, "wb") as fd:
+        num, first_fct, last_fct = convert(decoder, decode_stream(decoder, stream), fd, 0)
+    return num, first_fct, last_fct, decoder.stats.as_dict()
+
+def convert_parallel(decoder, filename, num_jobs, eti_fd, tmpdir):
+    """Convert the EDI file in num_jobs processes, and concatenate their
+    ETI output in file order. The statistics are added to those of
+    decoder, whose settings the workers use."""
+    p = decoder.p
+    ranges = split_capture(filename, num_jobs)
+    p.summary("Converting {} chunks in {} processes", len(ranges), num_jobs)
+
+    decoder_options = {'verify_protection': decoder.verify_protection,
+            'defrag_max': decoder.defragmenters.max_count,
+            'defrag_timeout': decoder.defragmenters.timeout,
+            'reorder_window': decoder.reorder_window}
+
+    jobs = []
+    for start, end in ranges:
+        tmpfd, tmpname = tempfile.mkstemp(prefix="edidebug-", suffix=".eti", dir=tmpdir)
+        os.close(tmpfd)
+        jobs.append((filename, start, end, tmpname, decoder_options))
+
+    pool = multiprocessing.Pool(num_jobs)
+    try:
+        results = pool.map(convert_range, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    total = 0
+    prev_fct = None
+    for (filename, start, end, tmpname, options), (num, first_fct, last_fct, job_stats) in zip(jobs, results):
+        decoder.stats.merge(job_stats)
+        if prev_fct is not None and first_fct is not None and first_fct != (prev_fct + 1) % 5000:
+            decoder.stats.fct_discontinuities += 1
+            p.summary("FCT discontinuity at offset {}: {} followed by {}",
+                start, prev_fct, first_fct)
+        if last_fct is not None:
+            prev_fct = last_fct
+
+        with open(tmpname, "rb") as fd:
+            shutil.copyfileobj(fd, eti_fd)
+        os.unlink(tmpname)
+        total += num
+
+    return total
+
+def build_index(fname, defrag_max=64, defrag_timeout=2.0, reorder_window=4):
+    """Decode the whole capture without output, and record the offset of
+    every packet, and where decoding has to start to get every frame"""
+    index = EdiIndex(fname)
+
+    # (pseq, FCT) of the frames decoded by the last decode() call
+    frames = []
+    decoder = EdiDecoder(verify_protection=False, defrag_max=defrag_max,
+            defrag_timeout=defrag_timeout, reorder_window=reorder_window)
+    decoder.on_frame = lambda eti_data: frames.append(
+            (decoder.decoding_pseq, eti_data.fc['FCT']))
+    stats = decoder.stats
+
+    stream = BufferedFile(fname)
+
+    # offset of the first fragment of each pseq being defragmented
+    pseq_start = collections.OrderedDict()
+
+    while True:
+        pos = stream.tell()
+        header = stream.peek(12)
+        resyncs = stats.resyncs
+
+        more = decoder.decode(stream)
+
+        # Nothing to index when decode() skipped over garbage
+        if stream.tell() != pos and stats.resyncs == resyncs:
+            if header[:2] == "PF":
+                header = struct.unpack_from(pft_head_struct, header)
+                pseq = header[1]
+                findex = (header[2] << 16) | (header[3] << 8) | header[4]
+                fcount = (header[5] << 16) | (header[6] << 8) | header[7]
+                index.add_packet(pos, pseq, findex, fcount)
+
+                if pseq not in pseq_start:
+                    pseq_start[pseq] = pos
+                    while len(pseq_start) > 1024:
+                        pseq_start.popitem(last=False)
             else:
-                ret = b"".join(self.buf[:n])
-                del self.buf[:n]
-
-            return ret
-
-    def peek(self, n):
-        dat = self.fd.read(n)
-        self.buf.extend(dat)
-        return dat
-
-def tobyte(xs):
-    return bytes(bytearray([xs]))
-
-class EtiData:
-    def __init__(self):
-        self.clear()
-
-    def new_subchannel(self):
-        new_stc = {}
-        self.stc.append(new_stc)
-        return new_stc
-
-    def clear(self):
-        self.fc = {}
-        self.stc = []
-        self.mnsc = 0
-        self.complete = False
-        self.fic = []
-
-    def generate_eti(self):
-        # generate ETI(NI)
-        # SYNC
-        buf = io.BytesIO()
-        buf.write("\xff") # ERR
-        # FSYNC
-        if self.fc['FCT'] % 2 == 1:
-            buf.write("\xf8\xc5\x49")
-        else:
-            buf.write("\x07\x3a\xb6")
-
-        # LIDATA
-        # FC
-        buf.write(tobyte(self.fc['FCT'] & 0xff))
-
-        NST = len(self.stc)
-        buf.write(tobyte((self.fc['FICF'] << 7) | NST))
-
-        if self.fc['FICF'] == 0:
-            FICL = 0
-        elif self.fc['MID'] == 3:
-            FICL = 32
-        else:
-            FICL = 24
-
-        # EN 300 799 5.3.6
-        FL = NST + 1 + FICL + sum(subch['STL'] * 2 for subch in self.stc)
-
-        p.pr("********** NST {}, FICL {}, stl {}, sum, {}".format(
-            NST, FICL, [subch['STL']  for subch in self.stc],
-                sum(subch['STL'] * 2 for subch in self.stc)))
-
-        buf.write(tobyte( (self.fc['FP'] << 5) |
-                          (self.fc['MID'] << 3) |
-                          ((FL & 0x700) >> 8)))
-
-        buf.write(tobyte(FL & 0xff))
-
-        # STC
-        for subch in self.stc:
-            buf.write(tobyte( (subch['SCID'] << 2) | ((subch['SAD'] & 0x300) >> 8) ))
-            buf.write(tobyte( subch['SAD'] & 0xff ))
-            buf.write(tobyte( (subch['TPL'] << 2) | ((subch['STL'] & 0x300) >> 8)))
-            buf.write(tobyte( subch['STL'] & 0xff ))
-
-        # EOH
-        # MNSC
-        buf.write(tobyte( self.mnsc & 0xff ))
-        buf.write(tobyte( (self.mnsc & 0xff00) >> 8 ))
-        # CRC
-        buf.seek(4)
-        headerdata = buf.read()
-        crc_calc = crc16(headerdata)
-        crc_calc ^= 0xFFFF
-        buf.write(tobyte( (crc_calc & 0xff00) >> 8))
-        buf.write(tobyte( crc_calc & 0xff ))
-
-        mst_start = buf.tell()
-        # MST
-        # FIC data
-        buf.write(bytes(bytearray(self.fic)))
-
-        # Data stream
-        for subch in self.stc:
-            buf.write(bytes(bytearray(subch['data'])))
-
-        # EOF
-        # CRC
-        buf.seek(mst_start)
-        mst_data = buf.read()
-        crc_calc = crc16(mst_data)
-        crc_calc ^= 0xFFFF
-        buf.write(tobyte( (crc_calc & 0xff00) >> 8))
-        buf.write(tobyte( crc_calc & 0xff ))
+                index.add_packet(pos, 0, 0, 0)
 
-        buf.write("\xff\xff") # RFU
+        # A fragment can release several frames, of earlier pseqs
+        for pseq, fct in frames:
+            frame_start = pos if pseq is None else pseq_start.pop(pseq, pos)
+            index.add_frame(frame_start, fct)
+        del frames[:]
 
-        # TIST
-        buf.write("\xff\xff\xff\xff") # TODO TIST in EDI is awful
-
-        length = buf.tell()
-
-        padding = 6144 - length
-
-        buf.write(bytes(bytearray("\x55" * padding)))
-
-        buf.seek(0)
-        return buf.read()
-
-
-eti_data = EtiData()
-p = Printer()
-
-# keys=findex
-defragmenters = {}
-
-def decode(stream):
-    p.pr("start")
-    success = False
-
-    sync = stream.peek(2)
-
-    if len(sync) < 2:
-        p.pr("EOF")
-        return False
+        if not more:
+            break
 
-    if sync == "PF":
-        if decode_pft(stream):
-            p.pr("PFT decode success")
-            success = True
+    stream.close()
+    return index
+
+def load_index(decoder, fname):
+    """Load the index of the capture file, build and save it if needed,
+    with the defragmenter settings of decoder"""
+    p = decoder.p
+    try:
+        index = EdiIndex.load(fname)
+        p.summary("Using index with {} packets, {} frames",
+            index.num_packets, index.num_frames)
+    except EdiIndexError as e:
+        p.summary("Building index ({})", e)
+        index = build_index(fname, decoder.defragmenters.max_count,
+                decoder.defragmenters.timeout, decoder.reorder_window)
+        index.save()
+        p.summary("Index built with {} packets, {} frames",
+            index.num_packets, index.num_frames)
+    return index
+
+def decode_stream(decoder, stream):
+    """Decode the stream, yields after every packet"""
+    while decoder.decode(stream):
+        yield
+
+def decode_datagrams(decoder, receiver, jitter_buffer=None):
+    """Decode the datagrams from the UdpReceiver, yields after every packet.
+    Without jitter buffer, every datagram is decoded directly from the
+    receive buffer."""
+    while True:
+        if jitter_buffer is None:
+            streams = receiver.receive()
         else:
-            p.pr("PFT decode fail")
-    elif sync == "AF":
-        if decode_af(stream, is_stream=True):
-            p.pr("AF decode success")
-            success = True
-        else:
-            p.pr("AF decode fail")
-    else:
-        p.pr("sync unknown {}".format(sync))
-    return success
-
-
-pft_head_struct = "!2sH3B3BH"
-pft_rs_head_struct = "!2B"
-pft_addr_head_struct = "!2H"
-def decode_pft(stream):
-    p.inc()
-    p.pr("start decoding PF")
-
-    headerdata = stream.read(12)
-    header = struct.unpack(pft_head_struct, headerdata)
-
-    psync, pseq, findex1, findex2, findex3, fcount1, fcount2, fcount3, fec_ad_plen = header
-
-    findex = (findex1 << 16) | (findex2 << 8) | findex3
-    fcount = (fcount1 << 16) | (fcount2 << 8) | fcount3
-
-    fec = (fec_ad_plen & 0x8000) != 0x00
-    addr = (fec_ad_plen & 0x4000) != 0x00
-    plen = fec_ad_plen & 0x3FFF
-
-    # try to sync according to TS 102 821 Clause 7.4.1
-    if psync != "PF":
-        p.pr("No PF Sync")
-        p.dec()
-        return False
-
-    rs_k = 0
-    rs_z = 0
-    if fec:
-        rs_head = stream.read(2)
-        rs_k, rs_z = struct.unpack(pft_rs_head_struct, rs_head)
-        headerdata += rs_head
-
-    addr_source = 0
-    addr_dest   = 0
-    if addr:
-        addr_head = stream.read(4)
-        addr_source, addr_dest = struct.unpack(pft_addr_head_struct, addr_head)
-        headerdata += addr_head
-
-    # read CRC
-    crc = struct.unpack("!H", stream.read(2))[0]
-
-    crc_calc = crc16(headerdata)
-    crc_calc ^= 0xFFFF
-
-    crc_ok = crc_calc == crc
-
-    if crc_ok:
-        p.pr("CRC ok")
-    else:
-        p.pr("CRC not ok!")
-        p.pr("  read 0x{:04x}, calculated 0x{:04x}".format(crc, crc_calc))
-
-    p.pr("pseq {}".format(pseq))
-    p.pr("findex {}".format(findex))
-    p.pr("fcount {}".format(fcount))
-    if fec:
-        p.pr("with fec:")
-        p.pr(" RSk={}".format(rs_k))
-        p.pr(" RSz={}".format(rs_z))
-    if addr:
-        p.pr("with transport header:")
-        p.pr(" source={}".format(addr_source))
-        p.pr(" dest={}".format(addr_dest))
-    p.pr("payload length={}".format(plen))
-
-    payload = stream.read(plen)
-
-    success = False
-    if crc_ok and fec:
-        # Fragmentation and
-        # Reed solomon decode
-        if pseq not in defragmenters:
-            defragmenters[pseq] = Defragmenter(fcount, get_rs_decoder(rs_k, rs_z))
-        success = defragmenters[pseq].push_fragment(findex, payload)
-    elif crc_ok and fcount > 1:
-        # Fragmentation
-        if pseq not in defragmenters:
-            defragmenters[pseq] = Defragmenter(fcount, decode_af_fragments)
-        success = defragmenters[pseq].push_fragment(findex, payload)
-    elif crc_ok and fcount == 1:
-        success = decode_af(payload)
-
-    p.dec()
-    return success
-
-class Defragmenter():
-    def __init__(self, fcount, callback):
-        self.fragments = [None for i in range(fcount)]
-        self.fcount = fcount
-        self.cb = callback
-
-    def push_fragment(self, findex, fragment):
-        self.fragments[findex] = fragment
-
-        received_fragments = [f for f in self.fragments if f is not None]
-        p.pr("Fragments: {} (need {})".format(len(received_fragments), self.fcount))
-        if len(received_fragments) >= self.fcount:
-            p.inc()
-            r = self.cb(received_fragments)
-            p.dec()
-            return r
-            # The RS decoder should be able to handle partial lists
-            # of fragments. The AF decoder cannot
-
-        return True
-
-    def __repr__(self):
-        return "<Defragmenter with fcount={}>".format(self.fcount)
-
-def get_rs_decoder(chunk_size, zeropad):
-    p.pr("Build RS decoder for chunk size={}, zero pad={}".format(chunk_size, zeropad))
-    def decode_rs(fragments):
-        fragment_lengths = ", ".join(["{}:{}".format(i, len(f)) for i,f in enumerate(fragments)])
-        p.pr("RS decode {} fragments of length {}".format(
-            len(fragments), fragment_lengths))
-
-        #for f in fragments:
-        #    p.hexpr("  ZE FRAGMENT", f);
-
-        # Transpose fragments to get an RS block
-        rs_block = "".join("".join(f) for f in zip(*fragments))
-
-        # chunks before protection have size chunk_size
-        # protection adds 48 bytes
-        # The tuples here are (data, parity)
-
-        #p.hexpr("  ZE RS BLOCK", "".join(rs_block))
-
-        num_chunks = len(rs_block) / chunk_size
-
-        data_size = chunk_size + 48
-
-        af_packet_size = num_chunks * chunk_size
-        p.pr("AF Packet size {}".format(af_packet_size))
-
-        # Cut the block into list of (data, protection) tuples
-        rs_chunks = [ (rs_block[i*data_size:i*data_size + chunk_size],
-                       rs_block[i*data_size + chunk_size:(i+1)*data_size])
-                for i in range(num_chunks)]
-
-        chunk_lengths = ", ".join(["{}:{}+{}".format(i, len(c[0]), len(c[1])) for i,c in enumerate(rs_chunks)])
-        p.pr("{} chunks of length {}".format(num_chunks, chunk_lengths))
-
-        #for c in rs_chunks:
-        #    p.hexpr("  ZE CHUNK DATA", c[0]);
-        #    p.hexpr("  ZE CHUNK PROT", c[1]);
-
-        if verify_protection:
-            rs_codec = RSCodec(48, fcr=1)
-
-            protection_ok = True
-            for chunk, protection in rs_chunks:
-                #p.pr(" Protection")
-                #p.hexpr("  OF ZE CHUNK DATA", chunk);
-
-                bchunk = bytearray(chunk)
-                padbytes = 255-(48 + len(chunk))
-                bchunk = bchunk + bytearray(0 for i in range(padbytes))
-                recalc_protection = rs_codec.encode(bchunk)[-48:]
-                if protection != recalc_protection:
-                    p.pr("  PROTECTION ERROR")
-                    p.hexpr("  data", chunk)
-                    p.hexpr("  orig", protection)
-                    p.hexpr("  calc", recalc_protection)
-                    protection_ok = False
-                else:
-                    p.pr("  PROTECTION OK")
-
-            if protection_ok:
-                p.pr("Protection check: OK")
-
-
-
-        afpacket = "".join(data for (data, protection) in rs_chunks)
-
-        #p.hexpr("  ZE AF PACKET", afpacket)
-
-        if zeropad:
-            return decode_af(afpacket[0:-zeropad])
+            streams = receiver.receive(jitter_buffer.timeout(time.time()))
+            now = time.time()
+            for stream in streams:
+                jitter_buffer.push(stream.data, now)
+            streams = [DatagramStream(memoryview(packet), persistent=True)
+                    for packet in jitter_buffer.pop(now)]
+
+        for stream in streams:
+            # decode() treats the end of the stream as the end of the
+            # input, so it must not see the end of a datagram
+            while len(stream.peek(2)) == 2:
+                decoder.decode(stream)
+                yield
+
+def convert(decoder, packets, eti_fd, max_frames, frames_per_write=64,
+        report=None, report_interval=None, fic_decoder=None, writers=()):
+    """Run the packets decoder generator, and write the ETI frames of
+    decoder to eti_fd if it is set, and to the other writers, like the
+    ZmqEtiWriter. If report is set, it gets called every report_interval
+    seconds. The FIC of every frame is given to fic_decoder if it is set.
+    Returns (number of frames, first FCT, last FCT)"""
+    # number of frames, first FCT, last FCT
+    result = [0, None, None]
+    writers = list(writers)
+    if eti_fd:
+        writers.append(EtiWriter(eti_fd, frames_per_write))
+
+    def write_frame(eti_data):
+        for writer in writers:
+            try:
+                writer.write(eti_data)
+            except ValueError as e:
+                decoder.p.summary("Cannot build ETI frame: {}", e)
+        if fic_decoder:
+            fic_decoder.decode_frame(eti_data)
+        if result[1] is None:
+            result[1] = eti_data.fc['FCT']
+        result[2] = eti_data.fc['FCT']
+        result[0] += 1
+
+    decoder.on_frame = write_frame
+    next_report = time.time() + report_interval if report and report_interval else None
+    for _ in packets:
+        if next_report is not None and time.time() >= next_report:
+            report()
+            next_report += report_interval
+        if max_frames != 0 and result[0] >= max_frames:
+            break
+    for writer in writers:
+        writer.flush()
+    return tuple(result)
+
+def print_stats(decoder, fd, **extra):
+    """Write the statistics as one line of JSON"""
+    summary = decoder.summary()
+    summary.update(extra)
+    fd.write(json.dumps(summary, sort_keys=True) + "\n")
+    fd.flush()
+
+
+if __name__ == "__main__":
+    program_description = """
+        Opendigitalradio EDI Debug utility.
+        Read in EDI data and analyse."""
+    parser = argparse.ArgumentParser(description=program_description)
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-f','--edi-file', help='EDI input file name')
+    input_group.add_argument('-u','--udp', help='Receive EDI over UDP on [IP:]PORT. If IP is a multicast group, join it')
+    parser.add_argument('--udp-interface', help='Local address of the interface to join the multicast group on',default="0.0.0.0")
+    parser.add_argument('--udp-batch', help='Maximum number of datagrams received at once',type=int,default=64)
+    parser.add_argument('--jitter-buffer', help='Reorder the received packets, waiting up to MS milliseconds for missing ones',type=float,metavar='MS')
+    parser.add_argument('--jitter-adaptive', help='Reduce the jitter buffer latency according to the measured jitter',action="store_true")
+    parser.add_argument('-o','--output', help='Enable EDI to ETI converter and write to file')
+    parser.add_argument('--zmq', help='Publish the ETI frames for ODR-DabMod on the ZeroMQ ENDPOINT, e.g. tcp://*:9100. An EDI file is published in real time',metavar='ENDPOINT')
+    parser.add_argument('-n','--max-frames', help='Stop converstion after N frames',type=int)
+    parser.add_argument('-v','--verbosity', help='Output level: 0 quiet, 1 errors and summary, 2 packet headers, 3 also hex dumps of the data. Default 2, or 0 with --stats',type=int,choices=range(4))
+    parser.add_argument('--stats', help='Statistics mode: print the error counters and throughput as JSON at the end, instead of the packets',action="store_true")
+    parser.add_argument('--stats-interval', help='In statistics mode, also print them every SEC seconds',type=float,metavar='SEC')
+    parser.add_argument('--fic', help='Decode the FIC, print the changes of the ensemble and add it to the statistics',action="store_true")
+    parser.add_argument('-V','--no-rs-verify', help='Do not verify Reed-Solomon encoding (faster)',action="store_true")
+    parser.add_argument('--defrag-max', help='Maximum number of AF packets being defragmented at the same time',type=int,default=64)
+    parser.add_argument('--defrag-timeout', help='Drop incomplete AF packets that received no fragment for this many seconds of the stream, 24ms per AF packet',type=float,default=2.0)
+    parser.add_argument('--defrag-window', help='Wait for late fragments of an incomplete AF packet until fragments of N newer ones arrived',type=int,default=4,metavar='N')
+    parser.add_argument('-j','--jobs', help='Convert to ETI using N processes in parallel. Needs -o and an EDI file',type=int,default=1)
+    parser.add_argument('-i','--index', help='Build the packet index FILE.idx next to the EDI file if needed, and use it',action="store_true")
+    parser.add_argument('--start-frame', help='Start decoding at frame N of the EDI file, using the index',type=int)
+    parser.add_argument('--start-fct', help='Start decoding at the first frame with this FCT, using the index',type=int)
+
+    cli_args = parser.parse_args()
+
+    if cli_args.jobs > 1:
+        if not cli_args.output or cli_args.edi_file in (None, "-"):
+            parser.error("--jobs needs an EDI file and -o")
+        if cli_args.max_frames:
+            parser.error("--jobs cannot be combined with --max-frames")
+        if cli_args.fic:
+            parser.error("--jobs cannot be combined with --fic")
+        if cli_args.zmq:
+            parser.error("--jobs cannot be combined with --zmq")
+
+    if cli_args.zmq and zmqeti.zmq is None:
+        parser.error("--zmq needs the pyzmq module")
+
+    use_index = cli_args.index or cli_args.start_frame is not None or cli_args.start_fct is not None
+    if use_index:
+        if cli_args.edi_file in (None, "-"):
+            parser.error("The index needs an EDI file")
+
+        if cli_args.jobs > 1:
+            parser.error("--jobs cannot be combined with the index options")
+
+    if (cli_args.jitter_buffer or cli_args.jitter_adaptive) and not cli_args.udp:
+        parser.error("The jitter buffer needs UDP input")
+
+    if cli_args.stats_interval is not None:
+        if not cli_args.stats:
+            parser.error("--stats-interval needs --stats")
+        if cli_args.stats_interval <= 0:
+            parser.error("Invalid statistics interval")
+        if cli_args.jobs > 1:
+            parser.error("--jobs cannot be combined with --stats-interval")
+
+
+    filename = cli_args.edi_file
+
+    eti_fd = None
+    if cli_args.output:
+        if cli_args.output == "-":
+            eti_fd = sys.stdout
         else:
-            return decode_af(afpacket)
-
-    return decode_rs
-
-
-af_head_struct = "!2sLHBc"
-def decode_af_fragments(fragments):
-    return decode_af("".join(fragments))
-
-def decode_af(in_data, is_stream=False):
-    p.pr("AF Packet")
-    p.inc()
-
-    if is_stream:
-        headerdata = in_data.read(10)
-    else:
-        headerdata = in_data[:10]
-
-    if len(headerdata) != 10:
-        p.hexpr("AF Header", headerdata)
-
-    sync, plen, seq, ar, pt = struct.unpack(af_head_struct, headerdata)
-
-    if sync != "AF":
-        p.pr("No AF Sync")
-        p.hexpr("in", in_data)
-        p.dec()
-        return False
-
-    crc_flag = (ar & 0x80) != 0x00
-    revision = ar & 0x7F
-
-    if is_stream:
-        payload = in_data.read(plen)
-        crc = struct.unpack("!H", in_data.read(2))[0]
-    else:
-        payload = in_data[10:10+plen]
-        crc = struct.unpack("!H", in_data[10+plen:10+plen+2])[0]
-
-    crc_calc = crc16(headerdata)
-    crc_calc = crc16(payload, crc_calc)
-    crc_calc ^= 0xFFFF
+            eti_fd = open(cli_args.output, "wb")
 
-    crc_ok = crc_calc == crc
+    num_eti = 0
+    if cli_args.max_frames:
+        num_eti = int(cli_args.max_frames)
 
-    if crc_flag and crc_ok:
-        p.pr("CRC ok 0x{0:04x}".format(crc))
-    elif crc_flag:
-        p.pr("CRC not ok!")
-        p.pr(" CRC: is 0x{0:04x}, calculated 0x{1:04x}".format(crc, crc_calc))
+    if cli_args.verbosity is not None:
+        p = Printer(level=cli_args.verbosity)
+    elif cli_args.stats:
+        p = Printer(level=QUIET)
     else:
-        p.pr("No CRC")
-
-    p.pr("plen {}".format(plen))
-    p.pr("seq {}".format(seq))
-    p.pr("revision {}".format(revision))
-    p.pr("protocol type {}".format(pt))
-
-    success = False
-    if pt == "T":
-        success = decode_tag(payload)
-
-    p.dec()
-    return success
-
-tag_item_head_struct = "!4sL"
-def tagitems(tagpacket):
-    i = 0
-    while i+8 < len(tagpacket):
-        name, length = struct.unpack(tag_item_head_struct, tagpacket[i:i+8])
-
-        # length is in bits, because it's more annoying this way
-        if length % 8 != 0:
-            sys.stderr.write("ASSERTION ERROR: length of tagpacket is not multiple of 8: {}".format(length))
-        length /= 8
-
-        tag_value = tagpacket[i+8:i+8+length]
-        yield {'name': name, 'length': length, 'value': tag_value}
-
-        i += 8 + length
-    p.pr("Completed decoding all TAG items after {} bytes".format(i))
-    eti_data.complete = True
-
-def decode_tag(tagpacket):
-    p.pr("Tag packet len={}".format(len(tagpacket)))
-    p.inc()
-    for item in tagitems(tagpacket):
-        if item['name'].startswith("*ptr"):
-            decode_starptr(item)
-        elif item['name'] == "deti":
-            decode_deti(item)
-        elif item['name'].startswith("est"):
-            decode_estn(item)
-        elif item['name'] == "*dmy":
-            decode_stardmy(item)
+        p = Printer(level=HEADERS)
+
+    decoder = EdiDecoder(printer=p, verify_protection=not cli_args.no_rs_verify,
+            defrag_max=cli_args.defrag_max, defrag_timeout=cli_args.defrag_timeout,
+            reorder_window=cli_args.defrag_window)
+
+    fic_decoder = FicDecoder(p) if cli_args.fic else None
+
+    zmq_writer = None
+    if cli_args.zmq:
+        # UDP input arrives in real time, a file has to be slowed down
+        pacer = None if cli_args.udp else Pacer(
+                zmqeti.NUM_FRAMES_PER_ZMQ_MESSAGE * FRAME_INTERVAL)
+        try:
+            zmq_writer = zmqeti.ZmqEtiWriter(cli_args.zmq, pacer)
+        except zmqeti.zmq.ZMQError as e:
+            parser.error("Cannot publish on {}: {}".format(cli_args.zmq, e))
+        p.summary("Publishing ETI on {}", cli_args.zmq)
+    writers = [zmq_writer] if zmq_writer else []
+
+    def output_stats():
+        extra = {}
+        if fic_decoder:
+            extra['fic'] = fic_decoder.summary()
+        if zmq_writer:
+            extra['zmq'] = zmq_writer.stats()
+        return extra
+
+    # The JSON statistics go to stdout, unless the ETI output is there
+    stats_fd = sys.stderr if cli_args.output == "-" else sys.stdout
+    report = None
+
+    start_offset = 0
+    if use_index:
+        index = load_index(decoder, filename)
+        try:
+            if cli_args.start_frame is not None:
+                start_offset = index.frame(cli_args.start_frame)[0]
+            elif cli_args.start_fct is not None:
+                start_offset = index.frame(index.find_fct(cli_args.start_fct))[0]
+        except EdiIndexError as e:
+            parser.error(str(e))
+        p.summary("Starting at offset {}", start_offset)
+
+    if cli_args.udp:
+        try:
+            ip, port = parse_address(cli_args.udp)
+        except ValueError:
+            parser.error("Invalid UDP address {}".format(cli_args.udp))
+        receiver = UdpReceiver(ip, port, cli_args.udp_interface, cli_args.udp_batch)
+        p.summary("Receiving EDI on {}:{}", ip, port)
+
+        jitter_buffer = None
+        if cli_args.jitter_buffer:
+            jitter_buffer = JitterBuffer(cli_args.jitter_buffer / 1000.0,
+                    cli_args.jitter_adaptive)
+
+        def udp_stats():
+            extra = output_stats()
+            extra['receiver'] = receiver.stats()
+            if jitter_buffer:
+                extra['jitter_buffer'] = jitter_buffer.stats()
+            return extra
+
+        if cli_args.stats:
+            report = lambda: print_stats(decoder, stats_fd, **udp_stats())
+
+        try:
+            # Write every frame immediately, for real-time output
+            convert(decoder, decode_datagrams(decoder, receiver, jitter_buffer), eti_fd, num_eti,
+                    frames_per_write=1, report=report,
+                    report_interval=cli_args.stats_interval, fic_decoder=fic_decoder,
+                    writers=writers)
+        except KeyboardInterrupt:
+            pass
+
+        if cli_args.stats:
+            print_stats(decoder, stats_fd, **udp_stats())
+
+        if p.enabled(SUMMARY):
+            p.summary("Receiver: {}", ", ".join("{}={}".format(k, v)
+                for k, v in sorted(receiver.stats().items())))
+            if jitter_buffer:
+                p.summary("Jitter buffer: {}", ", ".join("{}={}".format(k, v)
+                    for k, v in sorted(jitter_buffer.stats().items())))
+            p.summary("Defragmenters: {}", ", ".join("{}={}".format(k, v)
+                for k, v in sorted(decoder.defragmenters.stats().items())))
+            if fic_decoder:
+                p.summary("FIC: {}", ", ".join("{}={}".format(k, getattr(fic_decoder, k))
+                    for k in fic_decoder.counter_names))
+                fic_decoder.print_ensemble()
+            if zmq_writer:
+                p.summary("ZeroMQ: {}", ", ".join("{}={}".format(k, v)
+                    for k, v in sorted(zmq_writer.stats().items())))
+        receiver.close()
+    elif cli_args.jobs > 1:
+        if cli_args.output == "-":
+            tmpdir = None
         else:
-            p.hexpr("Unknown TAG item '{}'".format(item['name']), item['value'])
-
-    p.dec()
-    return True
-
-item_starptr_header_struct = "!4sHH"
-def decode_starptr(item):
-    p.pr("TAG item {} ({})".format(item['name'], item['length']))
-    p.inc()
-    tag_value = item['value']
-
-    unpacked = struct.unpack(item_starptr_header_struct, tag_value)
-    protocol, major, minor = unpacked
-
-    p.pr("Protocol {}, Ver {} {}".format(
-        protocol, major, minor) )
-
-    p.dec()
-
-def decode_stardmy(item):
-    p.pr("TAG item {} ({})".format(item['name'], item['length']))
-
-
-item_deti_header_struct = "!BBBBH"
-def decode_deti(item):
-    p.pr("TAG item {} ({})".format(item['name'], item['length']))
-    p.inc()
-    tag_value = item['value']
-
-    unpacked = struct.unpack(item_deti_header_struct, tag_value[:6])
-    flag_fcth, fctl, stat, mid_fp, mnsc = unpacked
-    eti_data.mnsc = mnsc
-
-    atstf = flag_fcth & 0x80 != 0
-    eti_data.fc['ATSTF'] = int(atstf)
-    if atstf:
-        utco, seconds, tsta1, tsta2, tsta3 = struct.unpack("!BL3B", tag_value[6:6+8])
-        tsta = (tsta1 << 16) | (tsta2 << 8) | tsta3
-        eti_data.fc['TSTA'] = tsta
-
-    ficf  = flag_fcth & 0x40 != 0
-    eti_data.fc['FICF'] = int(ficf)
+            tmpdir = os.path.dirname(os.path.abspath(cli_args.output))
+        c = convert_parallel(decoder, filename, cli_args.jobs, eti_fd, tmpdir)
+        p.summary("Converted {} frames", c)
 
-    rfudf = flag_fcth & 0x20 != 0
-
-    fcth  = flag_fcth & 0x1F
-    fct = (fcth * 250) + fctl
-    eti_data.fc['FCT'] = fct
-
-    mid = (mid_fp >> 6) & 0x03
-    eti_data.fc['MID'] = mid
-
-    fp  = (mid_fp >> 3) & 0x07
-    eti_data.fc['FP'] = fp
-
-
-    p.pr("FICF        = {}".format(ficf))
-    p.pr("ATST        = {}".format(atstf))
-    p.pr("RFUDF       = {}".format(rfudf))
-    p.pr("FCT         = {} (0x{:02x} 0x{:02x})".format(fct, fcth, fctl))
-    p.pr("STAT        = 0x{:02x}".format(stat))
-    p.pr("Mode id     = {}".format(mid))
-    p.pr("Frame phase = {}".format(fp))
-    p.pr("MNSC        = 0x{:02x}".format(mnsc))
-    if atstf:
-        p.pr("UTCOffset   = {}".format(utco))
-        p.pr("Seconds     = {}".format(seconds))
-        p.pr("TSTA        = {} ms".format(tsta / 16384.0))
-
-
-    len_fic = len(tag_value) - 2 - 4
-
-    if atstf:
-        len_fic -= 8
-
-    if rfudf:
-        len_fic -= 3
-
-    fic_offset = len(tag_value) - len_fic
-
-    eti_data.fic = tag_value[fic_offset:]
-
-    p.pr("FIC data len  {}".format(len_fic))
-
-    p.dec()
-
-item_estn_head_struct = "!BBB"
-def decode_estn(item):
-    estN = chr(ord("0") + ord(item['name'][3]))
-    p.pr("TAG item EST{} (len={})".format(estN, item['length']))
-    p.inc()
-    tag_value = item['value']
-
-    scid_sad, sad_low, tpl_rfa = struct.unpack(item_estn_head_struct, tag_value[:3])
-    scid = scid_sad >> 2
-    sad  = ((scid_sad << 8) | sad_low) & 0x3FF
-    tpl  = tpl_rfa >> 2
-
-    stc = eti_data.new_subchannel()
-    stc['SCID'] = scid
-    stc['SAD']  = sad
-    stc['TPL']  = tpl
-    stl = len(tag_value) - 3
-    stc['STL']  = stl / 8
-
-    p.pr("SCID = {}".format(scid))
-    p.pr("SAD  = {}".format(sad))
-    p.pr("TPL  = {}".format(tpl))
-
-    assert(item['length'] == len(tag_value))
-
-    p.pr("MST len = {}".format(stl))
-    p.hexpr("MST {} data".format(scid), tag_value[3:])
-    stc['data'] = tag_value[3:]
-
-    p.dec()
-
-
-program_description = """
-    Opendigitalradio EDI Debug utility.
-    Read in EDI data and analyse."""
-parser = argparse.ArgumentParser(description=program_description)
-parser.add_argument('-f','--edi-file', help='EDI input file name',required=True)
-parser.add_argument('-o','--output', help='Enable EDI to ETI converter and write to file')
-parser.add_argument('-n','--max-frames', help='Stop converstion after N frames',type=int)
-parser.add_argument('-V','--no-rs-verify', help='Do not verify Reed-Solomon encoding (faster)',action="store_true")
-
-cli_args = parser.parse_args()
-
-
-filename = cli_args.edi_file
-edi_fd = BufferedFile(filename)
-
-eti_fd = None
-if cli_args.output:
-    if cli_args.output == "-":
-        eti_fd = sys.stdout
+        if cli_args.stats:
+            print_stats(decoder, stats_fd, jobs=cli_args.jobs)
     else:
-        eti_fd = open(cli_args.output, "wb")
-
-num_eti = 0
-if cli_args.max_frames:
-    num_eti = int(cli_args.max_frames)
-
-verify_protection = 1
-if cli_args.no_rs_verify:
-    verify_protection = 0
-
-c = 0
-while decode(edi_fd):
-    if eti_data.complete and eti_fd:
-        eti_fd.write(eti_data.generate_eti())
-        c += 1
-        if num_eti != 0 and c >= num_eti:
-            break
-        eti_data.clear()
-
+        if cli_args.stats:
+            report = lambda: print_stats(decoder, stats_fd, **output_stats())
+
+        edi_fd = BufferedFile(filename, start=start_offset)
+        c, first_fct, last_fct = convert(decoder, decode_stream(decoder, edi_fd), eti_fd, num_eti,
+                report=report, report_interval=cli_args.stats_interval,
+                fic_decoder=fic_decoder, writers=writers)
+
+        if cli_args.stats:
+            print_stats(decoder, stats_fd, **output_stats())
+
+        if p.enabled(SUMMARY):
+            p.summary("Defragmenters: {}", ", ".join("{}={}".format(k, v)
+                for k, v in sorted(decoder.defragmenters.stats().items())))
+            if fic_decoder:
+                p.summary("FIC: {}", ", ".join("{}={}".format(k, getattr(fic_decoder, k))
+                    for k in fic_decoder.counter_names))
+                fic_decoder.print_ensemble()
+            if zmq_writer:
+                p.summary("ZeroMQ: {}", ", ".join("{}={}".format(k, v)
+                    for k, v in sorted(zmq_writer.stats().items())))
+
+    if zmq_writer:
+        zmq_writer.close()
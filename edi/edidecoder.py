@@ -0,0 +1,1326 @@
+#!/usr/bin/env python2
+#
+# EDI to ETI decoder library
+#
+# An EdiDecoder decodes one EDI stream, and calls on_frame for every ETI
+# frame. All decoder state is kept in the instance, so that one process can
+# decode many streams at the same time.
+#
+# The input is either pushed into the decoder, as bytes of a stream without
+# framing with push_bytes(), or as complete UDP datagrams with
+# push_datagram(), or read from a file with decode().
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import sys
+import time
+import struct
+import collections
+
+from crc import crc16
+from reedsolo import RSCodec, ReedSolomonError
+from udpreceiver import DatagramStream
+from edisync import (packet_length, find_sync, resync, is_truncated,
+        PFT_MAX_HEADER, MAX_AF_LENGTH)
+from jitterbuffer import seq_distance, FRAME_DURATION, RESYNC_DISTANCE
+
+# Verbosity levels of the Printer
+QUIET = 0
+SUMMARY = 1
+HEADERS = 2
+FULL_HEX = 3
+
+class Printer:
+    """Debug output with a verbosity level. Messages above the level are
+    not formatted at all: pr() and summary() take the format string and its
+    arguments separately, and callers that print a whole block check
+    enabled() first."""
+    def __init__(self, fd=None, level=HEADERS):
+        self.indent = 0
+        self.fd = fd if fd is not None else sys.stderr
+        self.level = level
+
+    def enabled(self, level):
+        return self.level >= level
+
+    def _write(self, s, args):
+        if args:
+            s = s.format(*args)
+        self.fd.write(" " * self.indent + s + "\n")
+
+    def summary(self, s, *args):
+        """Errors and statistics"""
+        if self.level >= SUMMARY:
+            self._write(s, args)
+
+    def pr(self, s, *args):
+        """Details of every packet"""
+        if self.level >= HEADERS:
+            self._write(s, args)
+
+    def hexpr(self, header, seq):
+        if self.level < FULL_HEX:
+            return
+
+        if not isinstance(seq, bytearray):
+            seq = bytearray(seq)
+
+        self.fd.write(" " * self.indent +
+                header +
+                " ({}): ".format(len(seq)) +
+                " ".join("{0:02x}".format(el) for el in seq) +
+                "\n")
+
+    def inc(self):
+        self.indent += 1
+    def dec(self):
+        self.indent -= 1
+
+ETI_FRAME_SIZE = 6144
+
+# ERR, FSYNC, FCT, FICF and NST, FP MID and FL high bits, FL low bits
+eti_head_struct = "!B3sBBBB"
+eti_stc_struct = "!BBBB"
+eti_fsync = (b"\x07\x3a\xb6", b"\xf8\xc5\x49")
+# RFU and TIST
+eti_eof_tist_struct = "!HL"
+# TIST without timestamp. With one, the high byte is 0xff and the 24 low bits
+# carry the TSTA of the EDI deti TAG item, in units of 1/16384 ms
+ETI_NO_TIST = 0xFFFFFFFF
+eti_padding = memoryview(bytearray(b"\x55" * ETI_FRAME_SIZE))
+
+class EtiData:
+    def __init__(self):
+        self.clear()
+        # Reused by generate_eti
+        self.frame = bytearray(ETI_FRAME_SIZE)
+
+    def new_subchannel(self):
+        new_stc = {}
+        self.stc.append(new_stc)
+        return new_stc
+
+    def clear(self):
+        self.fc = {}
+        self.stc = []
+        self.mnsc = 0
+        self.fic = b""
+
+    def copy(self):
+        """A copy that stays valid after the decoder reuses this EtiData.
+        The FIC and subchannel data get copied out of the AF packet."""
+        frame = EtiData()
+        frame.fc = dict(self.fc)
+        frame.stc = [dict(subch) for subch in self.stc]
+        for subch in frame.stc:
+            subch['data'] = bytes(bytearray(subch['data']))
+        frame.mnsc = self.mnsc
+        frame.fic = bytes(bytearray(self.fic))
+        return frame
+
+    def generate_eti(self):
+        """Returns the ETI(NI) frame, in a buffer that gets overwritten by
+        the next call"""
+        self.build_eti(self.frame, 0)
+        return self.frame
+
+    def build_eti(self, buf, offset):
+        """Write the ETI(NI) frame into the bytearray buf at offset"""
+        fc = self.fc
+
+        NST = len(self.stc)
+
+        if fc['FICF'] == 0:
+            FICL = 0
+        elif fc['MID'] == 3:
+            FICL = 32
+        else:
+            FICL = 24
+
+        # EN 300 799 5.3.6
+        stl_sum = sum(subch['STL'] for subch in self.stc)
+        FL = NST + 1 + FICL + stl_sum * 2
+
+        mst_len = len(self.fic) + sum(len(subch['data']) for subch in self.stc)
+        # SYNC, FC, STC, EOH, MST, EOF and TIST
+        if 8 + 4 * NST + 4 + mst_len + 8 > ETI_FRAME_SIZE:
+            raise ValueError("ETI frame too large, MST length {}".format(mst_len))
+
+        # SYNC and LIDATA FC
+        struct.pack_into(eti_head_struct, buf, offset,
+                0xff, eti_fsync[fc['FCT'] % 2],
+                fc['FCT'] % 250,
+                (fc['FICF'] << 7) | NST,
+                (fc['FP'] << 5) | (fc['MID'] << 3) | ((FL & 0x700) >> 8),
+                FL & 0xff)
+        pos = offset + 8
+
+        # STC
+        for subch in self.stc:
+            struct.pack_into(eti_stc_struct, buf, pos,
+                    (subch['SCID'] << 2) | ((subch['SAD'] & 0x300) >> 8),
+                    subch['SAD'] & 0xff,
+                    (subch['TPL'] << 2) | ((subch['STL'] & 0x300) >> 8),
+                    subch['STL'] & 0xff)
+            pos += 4
+
+        # EOH
+        # MNSC
+        struct.pack_into("<H", buf, pos, self.mnsc & 0xffff)
+        pos += 2
+
+        view = memoryview(buf)
+
+        # CRC
+        struct.pack_into("!H", buf, pos, crc16(view[offset+4:pos]) ^ 0xFFFF)
+        pos += 2
+
+        mst_start = pos
+        # MST
+        # FIC data
+        buf[pos:pos+len(self.fic)] = self.fic
+        pos += len(self.fic)
+
+        # Data stream, the subchannel data are views into the received
+        # AF packet, and only get copied here
+        for subch in self.stc:
+            data = subch['data']
+            buf[pos:pos+len(data)] = data
+            pos += len(data)
+
+        # EOF
+        # CRC
+        struct.pack_into("!H", buf, pos, crc16(view[mst_start:pos]) ^ 0xFFFF)
+        pos += 2
+
+        tist = 0xFF000000 | fc['TSTA'] if fc.get('ATSTF') else ETI_NO_TIST
+        struct.pack_into(eti_eof_tist_struct, buf, pos, 0xFFFF, tist)
+        pos += 6
+
+        end = offset + ETI_FRAME_SIZE
+        buf[pos:end] = eti_padding[:end-pos]
+
+class EtiWriter:
+    """Writes ETI frames to fd, frames_per_write at a time in a single
+    write() call. The frames are built in place in the output buffer."""
+    def __init__(self, fd, frames_per_write=64):
+        self.fd = fd
+        self.frames_per_write = frames_per_write
+        self.buf = bytearray(frames_per_write * ETI_FRAME_SIZE)
+        self.num = 0
+
+    def write(self, eti_data):
+        eti_data.build_eti(self.buf, self.num * ETI_FRAME_SIZE)
+        self.num += 1
+        if self.num == self.frames_per_write:
+            self.flush()
+
+    def flush(self):
+        if self.num == self.frames_per_write:
+            self.fd.write(self.buf)
+        elif self.num:
+            self.fd.write(self.buf[:self.num * ETI_FRAME_SIZE])
+        self.num = 0
+        self.fd.flush()
+
+
+class DecoderStats:
+    """Error counters and throughput of one EdiDecoder. They are always
+    updated, edidebug prints them as JSON with --stats"""
+
+    counter_names = ("packets", "input_bytes",
+            "pft_fragments", "pft_crc_errors", "invalid_findex", "duplicate_fragments",
+            "pseq_gaps", "pseq_missing",
+            "af_packets", "af_crc_errors", "af_seq_gaps", "tag_errors",
+            "sync_errors", "resyncs", "skipped_bytes",
+            "rs_chunks_checked", "rs_mismatches", "rs_corrected",
+            "incomplete_sets", "missing_fragments", "recovered_sets",
+            "frames", "fct_discontinuities")
+
+    def __init__(self):
+        for name in self.counter_names:
+            setattr(self, name, 0)
+        # SCID: number of bytes
+        self.subchannel_bytes = {}
+        self.last_pseq = None
+        self.last_af_seq = None
+        self.last_fct = None
+        self.start_time = time.time()
+
+    def new_pseq(self, pseq):
+        if self.last_pseq is not None:
+            distance = (pseq - self.last_pseq) & 0xFFFF
+            if distance != 1:
+                self.pseq_gaps += 1
+                if distance < 0x8000:
+                    self.pseq_missing += distance - 1
+        self.last_pseq = pseq
+
+    def new_af_seq(self, seq):
+        if self.last_af_seq is not None and seq != (self.last_af_seq + 1) & 0xFFFF:
+            self.af_seq_gaps += 1
+        self.last_af_seq = seq
+
+    def new_frame(self, eti_data):
+        self.frames += 1
+        fct = eti_data.fc['FCT']
+        if self.last_fct is not None and fct != (self.last_fct + 1) % 5000:
+            self.fct_discontinuities += 1
+        self.last_fct = fct
+
+        for subch in eti_data.stc:
+            scid = subch['SCID']
+            self.subchannel_bytes[scid] = self.subchannel_bytes.get(scid, 0) + len(subch['data'])
+
+    def merge(self, other):
+        """Add the counters of the dict from as_dict()"""
+        for name in self.counter_names:
+            setattr(self, name, getattr(self, name) + other[name])
+        for scid, num in other['subchannel_bytes'].items():
+            scid = int(scid)
+            self.subchannel_bytes[scid] = self.subchannel_bytes.get(scid, 0) + num
+
+    def as_dict(self):
+        d = dict((name, getattr(self, name)) for name in self.counter_names)
+        d['subchannel_bytes'] = dict(self.subchannel_bytes)
+        return d
+
+    def summary(self):
+        d = self.as_dict()
+        duration = time.time() - self.start_time
+        d['duration'] = round(duration, 3)
+        if duration > 0:
+            d['frames_per_second'] = round(self.frames / duration, 1)
+            d['realtime_factor'] = round(self.frames * 24e-3 / duration, 2)
+            d['input_mbit_per_second'] = round(self.input_bytes * 8 / duration / 1e6, 3)
+        return d
+
+
+class Defragmenter():
+    """Collects the fragments of one AF packet. The callbacks receive the
+    list of fragments indexed by findex, where missing fragments are None.
+    callback is called by decode() once all fragments are there,
+    partial_callback by flush() to recover the AF packet from an
+    incomplete set. When that fails, the fragments that arrive late are
+    still collected."""
+    def __init__(self, printer, stats, fcount, callback, partial_callback=None):
+        self.p = printer
+        self.stats = stats
+        self.fragments = [None for i in range(fcount)]
+        self.fcount = fcount
+        self.received = 0
+        self.cb = callback
+        self.partial_cb = partial_callback
+        # The AF packet was decoded or recovered
+        self.done = False
+        # Recovery was attempted
+        self.flushed = False
+
+    def num_received(self):
+        if self.fragments is None:
+            return self.fcount
+        return self.received
+
+    def complete(self):
+        """All fragments are there, and the AF packet is not decoded yet"""
+        return not self.done and self.received == self.fcount
+
+    def push_fragment(self, findex, fragment):
+        """Returns False for duplicates and fragments that arrive after the
+        AF packet was decoded"""
+        p = self.p
+        if self.done:
+            self.stats.duplicate_fragments += 1
+            p.pr("Fragment {} arrived after AF packet was decoded", findex)
+            return False
+
+        if self.fragments[findex] is not None:
+            # The first copy is kept, as it could already be in use
+            self.stats.duplicate_fragments += 1
+            p.pr("Duplicate fragment {}", findex)
+            return False
+
+        self.fragments[findex] = fragment
+        self.received += 1
+        p.pr("Fragments: {} (need {})", self.received, self.fcount)
+        return True
+
+    def decode(self):
+        """Decode the complete set"""
+        self.done = True
+        self.p.inc()
+        r = self.cb(self.fragments)
+        self.p.dec()
+        # Only keep the done flag, to ignore duplicate fragments
+        self.fragments = None
+        return r
+
+    def flush(self):
+        """Try to recover the AF packet from the fragments received so far"""
+        p = self.p
+        self.flushed = True
+        p.summary("Incomplete fragment set: {} of {}", self.received, self.fcount)
+        if self.partial_cb is None:
+            # The AF decoder cannot handle partial lists
+            return False
+
+        p.inc()
+        r = self.partial_cb(self.fragments)
+        p.dec()
+        if r:
+            self.done = True
+            self.fragments = None
+        return r
+
+    def __repr__(self):
+        return "<Defragmenter with fcount={}>".format(self.fcount)
+
+class DefragmenterStore():
+    """The Defragmenters, keyed by pseq. The store holds at most max_count
+    of them, and evicts those that have not received a fragment for
+    timeout seconds, least recently used first. The time is that of the
+    stream, every pseq carries one 24ms frame, so that reading a capture
+    faster or slower than real time does not change which sets expire. Done Defragmenters are kept
+    until they expire, so that late duplicates of their fragments are
+    ignored, and the wrapped-around pseq gets a new Defragmenter.
+    on_evict(pseq, defrag) is called for Defragmenters that get evicted
+    before their AF packet was decoded."""
+    def __init__(self, printer, max_count=64, timeout=2.0, on_evict=None):
+        self.p = printer
+        self.max_count = max_count
+        self.timeout = timeout
+        self.on_evict = on_evict
+        # pseq: (time of last fragment, Defragmenter), in order of last use
+        self.entries = collections.OrderedDict()
+
+        # Stream time, and the newest pseq that advanced it
+        self.now = 0.0
+        self.newest_pseq = None
+
+        self.num_created = 0
+        self.num_evicted = 0
+        self.num_evicted_incomplete = 0
+
+    def __contains__(self, pseq):
+        return pseq in self.entries
+
+    def __getitem__(self, pseq):
+        return self.entries[pseq][1]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, pseq, factory):
+        """Return the Defragmenter for pseq, after creating it with factory()
+        if needed"""
+        self.advance(pseq)
+        self.expire()
+
+        if pseq in self.entries:
+            defrag = self.entries.pop(pseq)[1]
+        else:
+            defrag = factory()
+            self.num_created += 1
+
+        self.entries[pseq] = (self.now, defrag)
+
+        while len(self.entries) > self.max_count:
+            self.evict(next(iter(self.entries)))
+
+        return defrag
+
+    def advance(self, pseq):
+        if self.newest_pseq is None:
+            self.newest_pseq = pseq
+        elif seq_distance(self.newest_pseq, pseq) < 0x8000:
+            self.now += seq_distance(self.newest_pseq, pseq) * FRAME_DURATION
+            self.newest_pseq = pseq
+
+    def expire(self):
+        while self.entries:
+            pseq = next(iter(self.entries))
+            if self.now - self.entries[pseq][0] <= self.timeout:
+                break
+            self.evict(pseq)
+
+    def evict(self, pseq):
+        defrag = self.entries.pop(pseq)[1]
+        self.num_evicted += 1
+        if not defrag.done:
+            self.num_evicted_incomplete += 1
+            self.p.summary("Evicted incomplete {} for pseq {}, {} fragments received",
+                defrag, pseq, defrag.num_received())
+            if self.on_evict:
+                self.on_evict(pseq, defrag)
+
+    def clear(self):
+        while self.entries:
+            self.evict(next(iter(self.entries)))
+
+    def items(self):
+        return [(pseq, entry[1]) for pseq, entry in self.entries.items()]
+
+    def stats(self):
+        return {'created': self.num_created,
+                'evicted': self.num_evicted,
+                'evicted_incomplete': self.num_evicted_incomplete,
+                'size': len(self.entries)}
+
+
+# RS(255, 207) as used by PFT, see ETSI TS 102 821 Clause 7.3.1. The codec
+# keeps no state between calls, all decoders share it.
+rs_codec = RSCodec(48, fcr=1)
+
+pft_head_struct = "!2sH3B3BH"
+pft_rs_head_struct = "!2B"
+pft_addr_head_struct = "!2H"
+af_head_struct = "!2sLHBc"
+tag_item_head_struct = "!4sL"
+item_starptr_header_struct = "!4sHH"
+item_deti_header_struct = "!BBBBH"
+item_estn_head_struct = "!BBB"
+
+class EdiDecoder:
+    """Decodes one EDI stream into ETI frames.
+
+    on_frame(eti_data) is called for every decoded frame. The EtiData and
+    its FIC and subchannel data, which are views into the received AF
+    packet, are only valid during the call: use eti_data.copy() or
+    build_eti() to keep the frame. on_frame can be changed at any time.
+
+    printer receives the debug output, it is QUIET by default.
+    verify_protection enables the check of the RS protection of complete
+    fragment sets. defrag_max and defrag_timeout configure the
+    DefragmenterStore.
+
+    Fragment sets are decoded in order of pseq. An incomplete set is
+    recovered once reorder_window newer sets have started, when it gets
+    evicted from the DefragmenterStore, or at the end of the input. Until
+    then, it waits for late fragments, and holds back the newer sets."""
+
+    def __init__(self, on_frame=None, printer=None, verify_protection=True,
+            defrag_max=64, defrag_timeout=2.0, reorder_window=4):
+        self.on_frame = on_frame
+        self.p = printer if printer is not None else Printer(level=QUIET)
+        self.verify_protection = verify_protection
+        self.stats = DecoderStats()
+        self.eti_data = EtiData()
+        # keys=pseq
+        self.defragmenters = DefragmenterStore(self.p, defrag_max, defrag_timeout,
+                on_evict=self.evicted)
+
+        # pseq of the last PFT fragment, for the statistics
+        self.last_pseq = None
+
+        # next_pseq is the first fragment set that was not released yet,
+        # newest_pseq the newest one that received a fragment
+        self.reorder_window = reorder_window
+        self.next_pseq = None
+        self.newest_pseq = None
+
+        # pseq of the fragment set whose AF packet is being decoded, None
+        # for AF packets without PFT
+        self.decoding_pseq = None
+
+        # Incomplete packet at the end of the data given to push_bytes()
+        self.pending = bytearray()
+        self.resyncing = False
+
+    def summary(self):
+        """The statistics, with those of the Defragmenters"""
+        d = self.stats.summary()
+        d['defragmenters'] = self.defragmenters.stats()
+        return d
+
+    def push_bytes(self, data):
+        """Decode the bytes of a stream without framing, as received over
+        TCP or read from a pipe, in pieces of any size. Packets that are
+        not complete yet wait for the next call. A packet is only decoded
+        once the start of the next one is there, to detect truncated
+        packets like decode() does, or at flush()."""
+        buf = self.pending + data if self.pending else bytearray(data)
+        self.pending = self.decode_buffer(buf, final=False)
+
+    def decode_buffer(self, buf, final):
+        """Decode the packets in the bytearray buf, returns the data left
+        for the next call"""
+        # buf is never modified, the fragments can keep views into it
+        view = memoryview(buf)
+        pos = 0
+        while len(buf) - pos >= 2:
+            length = packet_length(buf, pos)
+            if length is None:
+                break
+            if len(buf) - pos < length + (0 if final else 2):
+                break
+
+            if length:
+                stream = DatagramStream(view[pos:], persistent=True)
+                self.decode_packet(stream)
+                if stream.tell():
+                    pos += stream.tell()
+                    self.resyncing = False
+                    continue
+
+            # Skip to the next sync, the last byte can be the start of one
+            next_sync = find_sync(buf, pos + 1)
+            if next_sync == -1:
+                next_sync = len(buf) - 1
+            if not self.resyncing:
+                self.resyncing = True
+                self.stats.resyncs += 1
+            self.stats.skipped_bytes += next_sync - pos
+            self.p.summary("Skipped {} bytes to resync", next_sync - pos)
+            pos = next_sync
+
+        del view
+        return buf[pos:]
+
+    def push_datagram(self, data):
+        """Decode one UDP datagram, containing one or more complete
+        packets. bytes are used in place, other buffers like bytearray or
+        memoryview get copied where needed, and can be reused after the
+        call."""
+        stream = DatagramStream(memoryview(data), persistent=isinstance(data, bytes))
+        # decode() treats the end of the stream as the end of the input,
+        # so it must not see the end of the datagram
+        while len(stream.peek(2)) == 2:
+            self.decode(stream)
+
+    def flush(self):
+        """The input has ended, decode the incomplete fragment sets, and
+        drop what is left of an incomplete packet"""
+        if self.pending:
+            pending = self.decode_buffer(self.pending, final=True)
+            if pending:
+                self.stats.skipped_bytes += len(pending)
+                self.p.summary("Dropped {} bytes of an incomplete packet", len(pending))
+            self.pending = bytearray()
+        self.flush_sets()
+
+    def decode(self, stream):
+        """Decode the packet at the current position of the stream, which
+        has the peek(), read() and tell() methods of BufferedFile. Packets
+        that fail the header check are not consumed, and the stream gets
+        resynchronised to the next valid packet. Returns False at the end
+        of the stream, after decoding the incomplete fragment sets."""
+        self.p.pr("start")
+
+        sync = stream.peek(2)
+
+        if len(sync) < 2:
+            self.flush_sets()
+            self.p.pr("EOF")
+            return False
+
+        pos = stream.tell()
+        self.decode_packet(stream)
+
+        if stream.tell() == pos:
+            skipped = resync(stream)
+            self.stats.resyncs += 1
+            self.stats.skipped_bytes += skipped
+            self.p.summary("Skipped {} bytes to resync", skipped)
+        return True
+
+    def decode_packet(self, stream):
+        """Decode the packet at the current position of the stream, without
+        resynchronisation"""
+        p = self.p
+        sync = stream.peek(2)
+        if sync == "PF":
+            if self.decode_pft(stream):
+                p.pr("PFT decode success")
+            else:
+                p.summary("PFT decode fail")
+        elif sync == "AF":
+            if self.decode_af(stream, is_stream=True):
+                p.pr("AF decode success")
+            else:
+                p.summary("AF decode fail")
+        else:
+            self.stats.sync_errors += 1
+            p.summary("sync unknown {}", sync)
+
+    def push_fragment(self, pseq, findex, payload, factory):
+        """Give a fragment to the Defragmenter of pseq, created with
+        factory() if needed, and decode the fragment sets that are ready.
+        Returns False for duplicate fragments."""
+        if self.next_pseq is None:
+            self.next_pseq = self.newest_pseq = pseq
+        elif seq_distance(self.newest_pseq, pseq) < 0x8000:
+            if seq_distance(self.newest_pseq, pseq) > RESYNC_DISTANCE:
+                self.restart(pseq)
+            else:
+                self.newest_pseq = pseq
+        elif RESYNC_DISTANCE < seq_distance(pseq, self.next_pseq) < 0x8000:
+            self.restart(pseq)
+
+        defrag = self.defragmenters.get(pseq, factory)
+        if not defrag.push_fragment(findex, payload):
+            return False
+
+        if 0 < seq_distance(pseq, self.next_pseq) < 0x8000:
+            # A late fragment of a set that was already released
+            if defrag.complete():
+                self.decode_set(pseq, defrag)
+            elif defrag.flushed:
+                # Try again with one more fragment
+                self.flush_defragmenter(pseq, defrag)
+        else:
+            self.release()
+        return True
+
+    def release(self, final=False):
+        """Decode the fragment sets in order of pseq, up to the first one
+        that can still wait for fragments. With final, the incomplete sets
+        are all recovered."""
+        while seq_distance(self.next_pseq, self.newest_pseq) < 0x8000:
+            pseq = self.next_pseq
+            expired = final or seq_distance(pseq, self.newest_pseq) >= self.reorder_window
+            if pseq in self.defragmenters:
+                defrag = self.defragmenters[pseq]
+                if defrag.done:
+                    pass
+                elif defrag.complete():
+                    self.decode_set(pseq, defrag)
+                elif expired:
+                    self.flush_defragmenter(pseq, defrag)
+                else:
+                    break
+            elif not expired:
+                # No fragment yet, the set can still arrive
+                break
+            self.next_pseq = (pseq + 1) & 0xFFFF
+
+    def restart(self, pseq):
+        """The pseq jumped, the sets of the old sequence will not receive
+        more fragments"""
+        self.p.summary("pseq jump from {} to {}", self.newest_pseq, pseq)
+        self.flush_sets()
+        self.defragmenters.clear()
+        self.next_pseq = self.newest_pseq = pseq
+
+    def flush_sets(self):
+        """Decode all fragment sets, recovering the incomplete ones"""
+        if self.next_pseq is not None:
+            self.release(final=True)
+        for pseq, defrag in self.defragmenters.items():
+            if not defrag.done and not defrag.flushed:
+                self.flush_defragmenter(pseq, defrag)
+
+    def evicted(self, pseq, defrag):
+        if defrag.complete():
+            self.decode_set(pseq, defrag)
+        elif not defrag.flushed:
+            self.flush_defragmenter(pseq, defrag)
+
+    def decode_set(self, pseq, defrag):
+        """Decode the AF packet of a complete fragment set"""
+        self.decoding_pseq = pseq
+        r = defrag.decode()
+        self.decoding_pseq = None
+        return r
+
+    def flush_defragmenter(self, pseq, defrag):
+        """Try to recover the AF packet from an incomplete fragment set"""
+        p = self.p
+        p.inc()
+        if not defrag.flushed:
+            self.stats.incomplete_sets += 1
+            self.stats.missing_fragments += defrag.fcount - defrag.num_received()
+        self.decoding_pseq = pseq
+        r = defrag.flush()
+        self.decoding_pseq = None
+        if r:
+            self.stats.recovered_sets += 1
+            p.summary("PFT recovery of pseq {} success", pseq)
+        else:
+            p.summary("PFT recovery of pseq {} fail", pseq)
+        p.dec()
+        return r
+
+    def decode_pft(self, stream):
+        p = self.p
+        stats = self.stats
+        p.inc()
+        p.pr("start decoding PF")
+
+        # The header is only consumed once its CRC is checked
+        headerdata = stream.peek(PFT_MAX_HEADER)
+        if len(headerdata) < 14:
+            p.summary("Truncated PF header")
+            p.dec()
+            return False
+        header = struct.unpack_from(pft_head_struct, headerdata)
+
+        psync, pseq, findex1, findex2, findex3, fcount1, fcount2, fcount3, fec_ad_plen = header
+
+        findex = (findex1 << 16) | (findex2 << 8) | findex3
+        fcount = (fcount1 << 16) | (fcount2 << 8) | fcount3
+
+        fec = (fec_ad_plen & 0x8000) != 0x00
+        addr = (fec_ad_plen & 0x4000) != 0x00
+        plen = fec_ad_plen & 0x3FFF
+
+        # try to sync according to TS 102 821 Clause 7.4.1
+        if psync != "PF":
+            p.summary("No PF Sync")
+            p.dec()
+            return False
+
+        header_len = 12 + (2 if fec else 0) + (4 if addr else 0)
+        if len(headerdata) < header_len + 2:
+            p.summary("Truncated PF header")
+            p.dec()
+            return False
+
+        rs_k = 0
+        rs_z = 0
+        if fec:
+            rs_k, rs_z = struct.unpack_from(pft_rs_head_struct, headerdata, 12)
+
+        addr_source = 0
+        addr_dest   = 0
+        if addr:
+            addr_source, addr_dest = struct.unpack_from(pft_addr_head_struct,
+                    headerdata, header_len - 4)
+
+        crc = struct.unpack_from("!H", headerdata, header_len)[0]
+        crc_calc = crc16(headerdata[:header_len]) ^ 0xFFFF
+
+        crc_ok = crc_calc == crc
+
+        stats.packets += 1
+        stats.pft_fragments += 1
+
+        if crc_ok:
+            p.pr("CRC ok")
+        else:
+            stats.pft_crc_errors += 1
+            p.summary("PF CRC not ok!")
+            p.summary("  read 0x{:04x}, calculated 0x{:04x}", crc, crc_calc)
+
+        if p.enabled(HEADERS):
+            p.pr("pseq {}", pseq)
+            p.pr("findex {}", findex)
+            p.pr("fcount {}", fcount)
+            if fec:
+                p.pr("with fec:")
+                p.pr(" RSk={}", rs_k)
+                p.pr(" RSz={}", rs_z)
+            if addr:
+                p.pr("with transport header:")
+                p.pr(" source={}", addr_source)
+                p.pr(" dest={}", addr_dest)
+            p.pr("payload length={}", plen)
+
+        if not crc_ok:
+            # Neither the length nor the rest of the header can be trusted
+            p.dec()
+            return False
+
+        if pseq != self.last_pseq:
+            stats.new_pseq(pseq)
+            self.last_pseq = pseq
+
+        if is_truncated(stream, header_len + 2 + plen):
+            p.summary("Truncated PF packet")
+            p.dec()
+            return False
+
+        stream.read(header_len + 2)
+        stats.input_bytes += header_len + 2 + plen
+        payload = stream.read(plen)
+        if len(payload) < plen:
+            p.summary("Truncated PF payload, {} of {} bytes", len(payload), plen)
+            p.dec()
+            return False
+        if not stream.persistent:
+            # The fragment may have to wait for the others
+            payload = bytearray(payload)
+
+        success = False
+        if findex >= fcount:
+            stats.invalid_findex += 1
+            p.summary("Invalid findex")
+        elif fec:
+            # Fragmentation and
+            # Reed solomon decode, which can also recover from missing fragments
+            def make_defragmenter():
+                rs_decoder = self.get_rs_decoder(rs_k, rs_z)
+                return Defragmenter(p, stats, fcount, rs_decoder, rs_decoder)
+            success = self.push_fragment(pseq, findex, payload, make_defragmenter)
+        elif fcount > 1:
+            # Fragmentation
+            success = self.push_fragment(pseq, findex, payload,
+                    lambda: Defragmenter(p, stats, fcount, self.decode_af_fragments))
+        elif fcount == 1:
+            success = self.decode_af(payload)
+
+        p.dec()
+        return success
+
+    def get_rs_decoder(self, chunk_size, zeropad):
+        p = self.p
+        p.pr("Build RS decoder for chunk size={}, zero pad={}", chunk_size, zeropad)
+        def decode_rs(fragments):
+            if p.enabled(HEADERS):
+                fragment_lengths = ", ".join(["{}:{}".format(i, len(f))
+                    for i,f in enumerate(fragments) if f is not None])
+                p.pr("RS decode {} fragments of length {}",
+                    len(fragments), fragment_lengths)
+
+            #for f in fragments:
+            #    p.hexpr("  ZE FRAGMENT", f);
+
+            # Transpose fragments to get an RS block. Every fragment is
+            # copied once with an extended slice assignment, the chunks below
+            # are views into this block. Missing fragments leave zeros, and
+            # their positions are erasures for the RS decoder.
+            fcount = len(fragments)
+            missing = [i for i, f in enumerate(fragments) if f is None]
+            fragment_len = min(len(f) for f in fragments if f is not None)
+            rs_block = bytearray(fcount * fragment_len)
+            for i, f in enumerate(fragments):
+                if f is not None:
+                    rs_block[i::fcount] = memoryview(f)[:fragment_len]
+            rs_block_view = memoryview(rs_block)
+
+            # chunks before protection have size chunk_size
+            # protection adds 48 bytes
+            # The tuples here are (data, parity)
+
+            #p.hexpr("  ZE RS BLOCK", "".join(rs_block))
+
+            data_size = chunk_size + 48
+
+            # The fragments may carry padding after the last chunk
+            num_chunks = len(rs_block) // data_size
+
+            af_packet_size = num_chunks * chunk_size
+            p.pr("AF Packet size {}", af_packet_size)
+
+            # Cut the block into list of (data, protection) tuples
+            rs_chunks = [ (rs_block_view[i*data_size:i*data_size + chunk_size],
+                           rs_block_view[i*data_size + chunk_size:(i+1)*data_size])
+                    for i in range(num_chunks)]
+
+            if p.enabled(HEADERS):
+                chunk_lengths = ", ".join(["{}:{}+{}".format(i, len(c[0]), len(c[1])) for i,c in enumerate(rs_chunks)])
+                p.pr("{} chunks of length {}", num_chunks, chunk_lengths)
+
+            #for c in rs_chunks:
+            #    p.hexpr("  ZE CHUNK DATA", c[0]);
+            #    p.hexpr("  ZE CHUNK PROT", c[1]);
+
+            if missing:
+                rs_chunks = self.correct_erasures(rs_chunks, fcount, missing)
+                if rs_chunks is None:
+                    return False
+            elif self.verify_protection:
+                # All chunks of the packet are encoded in one call
+                padbytes = 255-(48 + chunk_size)
+                recalc_protections = rs_codec.parity(
+                        [chunk for chunk, protection in rs_chunks], padbytes)
+
+                protection_ok = True
+                self.stats.rs_chunks_checked += len(rs_chunks)
+                for (chunk, protection), recalc_protection in zip(rs_chunks, recalc_protections):
+                    #p.pr(" Protection")
+                    #p.hexpr("  OF ZE CHUNK DATA", chunk);
+
+                    if protection != recalc_protection:
+                        self.stats.rs_mismatches += 1
+                        p.summary("  PROTECTION ERROR")
+                        p.hexpr("  data", chunk)
+                        p.hexpr("  orig", protection)
+                        p.hexpr("  calc", recalc_protection)
+                        protection_ok = False
+                    else:
+                        p.pr("  PROTECTION OK")
+
+                if protection_ok:
+                    p.pr("Protection check: OK")
+                else:
+                    corrected = self.correct_erasures(rs_chunks, fcount, [])
+                    if corrected is None:
+                        p.summary("Decoding the AF packet without RS correction")
+                    else:
+                        self.stats.rs_corrected += 1
+                        rs_chunks = corrected
+
+            afpacket = bytearray()
+            for data, protection in rs_chunks:
+                afpacket += data
+
+            #p.hexpr("  ZE AF PACKET", afpacket)
+
+            if zeropad:
+                return self.decode_af(memoryview(afpacket)[0:-zeropad])
+            else:
+                return self.decode_af(afpacket)
+
+        return decode_rs
+
+    def correct_erasures(self, rs_chunks, fcount, missing):
+        """Correct the (data, protection) tuples in rs_chunks, where the bytes
+        of the missing fragments are erased, and the errors in the other
+        bytes. Returns the corrected chunks as (data, None) tuples, or None
+        if correction is not possible."""
+        p = self.p
+        if not rs_chunks:
+            return None
+
+        chunk_size = len(rs_chunks[0][0])
+        data_size = chunk_size + 48
+        padbytes = 255 - data_size
+        missing = set(missing)
+
+        codewords = []
+        erase_pos = []
+        for c, (chunk, protection) in enumerate(rs_chunks):
+            # Position in the RS block, and position in the codeword
+            # that has zero padding between data and protection
+            erasures = [i if i < chunk_size else i + padbytes
+                    for i in range(data_size)
+                    if (c * data_size + i) % fcount in missing]
+            if len(erasures) > 48:
+                p.summary("Too many missing fragments to correct chunk {}: {} erasures",
+                    c, len(erasures))
+                return None
+            codewords.append(bytes(bytearray(chunk) + bytearray(padbytes) + bytearray(protection)))
+            erase_pos.append(erasures)
+
+        p.pr("Correcting {} erasures in {} chunks",
+            sum(len(e) for e in erase_pos), len(codewords))
+
+        try:
+            messages = rs_codec.decode_many(codewords, erase_pos)
+        except ReedSolomonError as e:
+            p.summary("RS correction failed: {}", e)
+            return None
+
+        return [(memoryview(m)[:chunk_size], None) for m in messages]
+
+    def decode_af_fragments(self, fragments):
+        afpacket = bytearray()
+        for f in fragments:
+            afpacket += f
+        return self.decode_af(afpacket)
+
+    def decode_af(self, in_data, is_stream=False):
+        """Decode an AF packet, either read from a stream or given as a buffer.
+        The packet is parsed through memoryview slices, nothing gets copied.
+        From a stream, the packet is only consumed if its CRC is correct."""
+        p = self.p
+        stats = self.stats
+        p.pr("AF Packet")
+        p.inc()
+
+        if is_stream:
+            header = memoryview(in_data.peek(10))
+        else:
+            header = memoryview(in_data)[:10]
+
+        if len(header) != 10:
+            p.hexpr("AF Header", header)
+            p.dec()
+            return False
+
+        sync, plen, seq, ar, pt = struct.unpack_from(af_head_struct, header)
+
+        if sync != "AF":
+            stats.sync_errors += 1
+            p.summary("No AF Sync")
+            p.hexpr("in", header)
+            p.dec()
+            return False
+
+        if is_stream:
+            if plen > MAX_AF_LENGTH:
+                p.summary("AF packet length {} too large", plen)
+                p.dec()
+                return False
+            body = memoryview(in_data.peek(10 + plen + 2))[10:]
+        else:
+            body = memoryview(in_data)[10:]
+
+        if len(body) < plen + 2:
+            p.summary("Truncated AF packet")
+            p.dec()
+            return False
+
+        crc_flag = (ar & 0x80) != 0x00
+        revision = ar & 0x7F
+
+        payload = body[:plen]
+        crc = struct.unpack_from("!H", body, plen)[0]
+
+        crc_calc = crc16(header)
+        crc_calc = crc16(payload, crc_calc)
+        crc_calc ^= 0xFFFF
+
+        crc_ok = crc_calc == crc
+
+        if crc_flag and crc_ok:
+            p.pr("CRC ok 0x{0:04x}", crc)
+        elif crc_flag:
+            stats.af_crc_errors += 1
+            p.summary("AF CRC not ok!")
+            p.summary(" CRC: is 0x{0:04x}, calculated 0x{1:04x}", crc, crc_calc)
+            # From a stream, the length cannot be trusted either, and
+            # decode() resyncs
+            p.dec()
+            return False
+        else:
+            p.pr("No CRC")
+
+        if is_stream:
+            in_data.read(10 + plen + 2)
+            stats.packets += 1
+            stats.input_bytes += 12 + plen
+        stats.af_packets += 1
+        stats.new_af_seq(seq)
+
+        if p.enabled(HEADERS):
+            p.pr("plen {}", plen)
+            p.pr("seq {}", seq)
+            p.pr("revision {}", revision)
+            p.pr("protocol type {}", pt)
+
+        success = False
+        if pt == "T":
+            success = self.decode_tag(payload)
+
+        p.dec()
+        return success
+
+    def tagitems(self, tagpacket):
+        """Iterate over the TAG items in tagpacket, which must be a memoryview.
+        The values are slices into it."""
+        i = 0
+        while i+8 < len(tagpacket):
+            name, length = struct.unpack_from(tag_item_head_struct, tagpacket, i)
+
+            # length is in bits, because it's more annoying this way
+            if length % 8 != 0:
+                sys.stderr.write("ASSERTION ERROR: length of tagpacket is not multiple of 8: {}".format(length))
+            length /= 8
+
+            tag_value = tagpacket[i+8:i+8+length]
+            yield {'name': name, 'length': length, 'value': tag_value}
+
+            i += 8 + length
+        self.p.pr("Completed decoding all TAG items after {} bytes", i)
+
+    def decode_tag(self, tagpacket):
+        p = self.p
+        p.pr("Tag packet len={}", len(tagpacket))
+        p.inc()
+        for item in self.tagitems(tagpacket):
+            if len(item['value']) != item['length']:
+                p.summary("Truncated TAG item '{}', {} of {} bytes",
+                    item['name'], len(item['value']), item['length'])
+                ok = False
+            elif item['name'].startswith("*ptr"):
+                ok = self.decode_starptr(item)
+            elif item['name'] == "deti":
+                ok = self.decode_deti(item)
+            elif item['name'].startswith("est"):
+                ok = self.decode_estn(item)
+            elif item['name'] == "*dmy":
+                ok = self.decode_stardmy(item)
+            else:
+                p.summary("Unknown TAG item '{}' ({})", item['name'], item['length'])
+                p.hexpr(" value", item['value'])
+                ok = True
+
+            if not ok:
+                # Drop the frame
+                self.stats.tag_errors += 1
+                self.eti_data.clear()
+                p.dec()
+                return False
+
+        p.dec()
+        self.frame_complete()
+        return True
+
+    def frame_complete(self):
+        """Hand the decoded frame to on_frame, and start the next one"""
+        eti_data = self.eti_data
+        if not eti_data.fc:
+            self.p.summary("TAG packet without deti item")
+            eti_data.clear()
+            return
+
+        self.stats.new_frame(eti_data)
+
+        if self.p.enabled(HEADERS):
+            self.p.pr("********** NST {}, stl {}, sum {}", len(eti_data.stc),
+                [subch['STL'] for subch in eti_data.stc],
+                sum(subch['STL'] for subch in eti_data.stc) * 2)
+
+        try:
+            if self.on_frame is not None:
+                self.on_frame(eti_data)
+        finally:
+            # Drop the views into the AF packet
+            eti_data.clear()
+
+    def decode_starptr(self, item):
+        p = self.p
+        p.pr("TAG item {} ({})", item['name'], item['length'])
+        p.inc()
+        tag_value = item['value']
+
+        if len(tag_value) < struct.calcsize(item_starptr_header_struct):
+            p.summary("*ptr TAG item too short: {} bytes", len(tag_value))
+            p.dec()
+            return False
+
+        unpacked = struct.unpack_from(item_starptr_header_struct, tag_value)
+        protocol, major, minor = unpacked
+
+        p.pr("Protocol {}, Ver {} {}", protocol, major, minor)
+
+        p.dec()
+        return True
+
+    def decode_stardmy(self, item):
+        self.p.pr("TAG item {} ({})", item['name'], item['length'])
+        return True
+
+    def decode_deti(self, item):
+        p = self.p
+        eti_data = self.eti_data
+        p.pr("TAG item {} ({})", item['name'], item['length'])
+        p.inc()
+        tag_value = item['value']
+
+        if len(tag_value) < struct.calcsize(item_deti_header_struct):
+            p.summary("deti TAG item too short: {} bytes", len(tag_value))
+            p.dec()
+            return False
+
+        unpacked = struct.unpack_from(item_deti_header_struct, tag_value)
+        flag_fcth, fctl, stat, mid_fp, mnsc = unpacked
+        eti_data.mnsc = mnsc
+
+        atstf = flag_fcth & 0x80 != 0
+        rfudf = flag_fcth & 0x20 != 0
+
+        len_fic = len(tag_value) - 2 - 4
+
+        if atstf:
+            len_fic -= 8
+
+        if rfudf:
+            len_fic -= 3
+
+        if len_fic < 0:
+            p.summary("deti TAG item too short: {} bytes", len(tag_value))
+            p.dec()
+            return False
+
+        eti_data.fc['ATSTF'] = int(atstf)
+        if atstf:
+            utco, seconds, tsta1, tsta2, tsta3 = struct.unpack_from("!BL3B", tag_value, 6)
+            tsta = (tsta1 << 16) | (tsta2 << 8) | tsta3
+            eti_data.fc['TSTA'] = tsta
+            eti_data.fc['UTCO'] = utco
+            eti_data.fc['SECONDS'] = seconds
+
+        ficf  = flag_fcth & 0x40 != 0
+        eti_data.fc['FICF'] = int(ficf)
+
+        fcth  = flag_fcth & 0x1F
+        fct = (fcth * 250) + fctl
+        eti_data.fc['FCT'] = fct
+
+        mid = (mid_fp >> 6) & 0x03
+        eti_data.fc['MID'] = mid
+
+        fp  = (mid_fp >> 3) & 0x07
+        eti_data.fc['FP'] = fp
+
+
+        if p.enabled(HEADERS):
+            p.pr("FICF        = {}", ficf)
+            p.pr("ATST        = {}", atstf)
+            p.pr("RFUDF       = {}", rfudf)
+            p.pr("FCT         = {} (0x{:02x} 0x{:02x})", fct, fcth, fctl)
+            p.pr("STAT        = 0x{:02x}", stat)
+            p.pr("Mode id     = {}", mid)
+            p.pr("Frame phase = {}", fp)
+            p.pr("MNSC        = 0x{:02x}", mnsc)
+            if atstf:
+                p.pr("UTCOffset   = {}", utco)
+                p.pr("Seconds     = {}", seconds)
+                p.pr("TSTA        = {} ms", tsta / 16384.0)
+
+        fic_offset = len(tag_value) - len_fic
+
+        eti_data.fic = tag_value[fic_offset:]
+
+        p.pr("FIC data len  {}", len_fic)
+
+        p.dec()
+        return True
+
+    def decode_estn(self, item):
+        p = self.p
+        estN = chr(ord("0") + ord(item['name'][3]))
+        p.pr("TAG item EST{} (len={})", estN, item['length'])
+        p.inc()
+        tag_value = item['value']
+
+        if len(tag_value) < struct.calcsize(item_estn_head_struct):
+            p.summary("EST{} TAG item too short: {} bytes", estN, len(tag_value))
+            p.dec()
+            return False
+
+        scid_sad, sad_low, tpl_rfa = struct.unpack_from(item_estn_head_struct, tag_value)
+        scid = scid_sad >> 2
+        sad  = ((scid_sad << 8) | sad_low) & 0x3FF
+        tpl  = tpl_rfa >> 2
+
+        stc = self.eti_data.new_subchannel()
+        stc['SCID'] = scid
+        stc['SAD']  = sad
+        stc['TPL']  = tpl
+        stl = len(tag_value) - 3
+        stc['STL']  = stl / 8
+
+        if p.enabled(HEADERS):
+            p.pr("SCID = {}", scid)
+            p.pr("SAD  = {}", sad)
+            p.pr("TPL  = {}", tpl)
+            p.pr("MST len = {}", stl)
+        if p.enabled(FULL_HEX):
+            p.hexpr("MST {} data".format(scid), tag_value[3:])
+        stc['data'] = tag_value[3:]
+
+        p.dec()
+        return True
@@ -0,0 +1,219 @@
+#!/usr/bin/env python2
+#
+# Generate synthetic EDI captures, for tests and benchmarks of the EDI tools
+#
+# The ETI frames carry pseudo-random subchannel data, and a FIC that
+# describes an ensemble with one DAB+ service per subchannel. Everything is
+# derived from the seed, the same options always give the same capture.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import sys
+import struct
+import random
+import binascii
+import argparse
+
+from crc import crc16
+from eti2edi import EdiEncoder, ETI_FRAME_SIZE, ETI_FSYNC, eti_head_struct, RS_MAX_K
+
+MODES = ("af", "pft", "pft-rs")
+
+# Subchannel sizes in 64-bit words per frame: 128, 192 and 48 kbit/s
+DEFAULT_SUBCHANNELS = (48, 72, 18)
+
+# FIC length in bytes for mode I
+FIC_SIZE = 96
+FIB_DATA_SIZE = 30
+
+ENSEMBLE_ID = 0x4FFF
+FIRST_SID = 0x4001
+
+def random_bytes(rng, n):
+    if n == 0:
+        return b""
+    return binascii.unhexlify("%0*x" % (2 * n, rng.getrandbits(8 * n)))
+
+def fib(figs):
+    """A FIB containing the FIGs, with end marker, padding and CRC"""
+    data = b"".join(figs)
+    if len(data) > FIB_DATA_SIZE:
+        raise ValueError("Too many subchannels for the synthetic FIC")
+    if len(data) < FIB_DATA_SIZE:
+        data += b"\xff" + b"\0" * (FIB_DATA_SIZE - len(data) - 1)
+    return data + struct.pack("!H", crc16(data) ^ 0xFFFF)
+
+def fig(fig_type, body):
+    return struct.pack("!B", (fig_type << 5) | len(body)) + body
+
+def label(text):
+    """Label field with character flags, the first 8 characters are the
+    short label"""
+    return struct.pack("!16sH", text.ljust(16).encode("ascii"), 0xFF00)
+
+def synthetic_fic(frame_number, subchannels):
+    """The FIC of one frame. FIG 0/0 is in every frame, the labels are
+    sent one after the other."""
+    cif_count = frame_number % 5000
+    fig0_0 = fig(0, struct.pack("!BHBB", 0, ENSEMBLE_ID,
+        cif_count // 250, cif_count % 250))
+
+    # Long form EEP 1-A, with STL 64-bit words per 24ms frame
+    body = b""
+    sad = 0
+    for scid, stl in enumerate(subchannels):
+        size = stl * 4
+        body += struct.pack("!HH", ((scid + 1) << 10) | sad, 0x8000 | size)
+        sad += size
+    fig0_1 = fig(0, struct.pack("!B", 1) + body)
+
+    # One DAB+ service per subchannel
+    body = b""
+    for scid in range(len(subchannels)):
+        body += struct.pack("!HBBB", FIRST_SID + scid, 1, 63, ((scid + 1) << 2) | 0x02)
+    fig0_2 = fig(0, struct.pack("!B", 2) + body)
+
+    num_labels = len(subchannels) + 1
+    n = frame_number % num_labels
+    if n == 0:
+        fig1 = fig(1, struct.pack("!BH", 0, ENSEMBLE_ID) + label("Synthetic"))
+    else:
+        fig1 = fig(1, struct.pack("!BH", 1, FIRST_SID + n - 1) +
+                label("Service {}".format(n)))
+
+    return fib([fig0_0, fig0_1]) + fib([fig0_2]) + fib([fig1])
+
+def synthetic_eti(num_frames, subchannels=DEFAULT_SUBCHANNELS, seed=0):
+    """Iterate over num_frames ETI(NI) frames in mode I, with one
+    subchannel for each STL in subchannels"""
+    rng = random.Random(seed)
+    nst = len(subchannels)
+    fl = nst + 1 + FIC_SIZE // 4 + sum(subchannels) * 2
+
+    stc = b""
+    sad = 0
+    for scid, stl in enumerate(subchannels):
+        # UEP or EEP does not matter here, TPL 0x10 is EEP 1-A, which
+        # needs 4 CU per 64-bit word
+        stc += struct.pack("!HH", ((scid + 1) << 10) | sad, (0x10 << 10) | stl)
+        sad += stl * 4
+
+    for n in range(num_frames):
+        fct = n % 250
+        head = struct.pack(eti_head_struct, 0xff, ETI_FSYNC[fct % 2], fct,
+                0x80 | nst, ((n % 8) << 5) | (1 << 3) | (fl >> 8), fl & 0xff)
+        eoh = head + stc + struct.pack("<H", n & 0xFFFF)
+        eoh += struct.pack("!H", crc16(eoh[4:]) ^ 0xFFFF)
+
+        mst = synthetic_fic(n, subchannels) + random_bytes(rng, sum(subchannels) * 8)
+        eof = struct.pack("!HH", crc16(mst) ^ 0xFFFF, 0xFFFF)
+        tist = b"\xff\xff\xff\xff"
+
+        frame = eoh + mst + eof + tist
+        yield frame + b"\x55" * (ETI_FRAME_SIZE - len(frame))
+
+def impair(packets, loss=0.0, reorder=0, seed=0):
+    """Drop every packet with probability loss, and shuffle the packets
+    within windows of reorder packets"""
+    rng = random.Random(seed)
+    if loss:
+        packets = [pkt for pkt in packets if rng.random() >= loss]
+    if reorder > 1:
+        shuffled = []
+        for i in range(0, len(packets), reorder):
+            window = packets[i:i + reorder]
+            rng.shuffle(window)
+            shuffled.extend(window)
+        packets = shuffled
+    return packets
+
+def generate(num_frames, mode="af", fragments=6, rs_k=RS_MAX_K, loss=0.0,
+        reorder=0, subchannels=DEFAULT_SUBCHANNELS, seed=0):
+    """Returns (AF packets, EDI packets) for num_frames synthetic ETI
+    frames. The AF packets are the ones before fragmentation and
+    impairments, the EDI packets are what would be sent"""
+    if mode not in MODES:
+        raise ValueError("Unknown mode {}".format(mode))
+    if mode == "af":
+        fragments = 1
+    encoder = EdiEncoder(pft=mode != "af", fragments=fragments,
+            fec=mode == "pft-rs", rs_k=rs_k)
+
+    af_packets = []
+    packets = []
+    for frame in synthetic_eti(num_frames, subchannels, seed):
+        af = encoder.af_packet(encoder.tag_packet(frame))
+        af_packets.append(af)
+        packets.extend(encoder.fragment(af))
+
+    return af_packets, impair(packets, loss, reorder, seed + 1)
+
+
+if __name__ == "__main__":
+    program_description = """
+        Opendigitalradio synthetic EDI generator.
+        Write a deterministic EDI capture with pseudo-random content."""
+    parser = argparse.ArgumentParser(description=program_description)
+    parser.add_argument('-o','--output', help='EDI output file name, - for stdout',required=True)
+    parser.add_argument('-n','--frames', help='Number of ETI frames',type=int,default=1000)
+    parser.add_argument('-m','--mode', help='Packet format',choices=MODES,default="pft-rs")
+    parser.add_argument('-F','--fragments', help='Number of PFT fragments per AF packet',type=int,default=6)
+    parser.add_argument('--rs-k', help='Reed-Solomon chunk size, at most {}'.format(RS_MAX_K),type=int,default=RS_MAX_K)
+    parser.add_argument('--loss', help='Drop packets with this probability',type=float,default=0.0)
+    parser.add_argument('--reorder', help='Shuffle the packets within windows of N packets',type=int,default=0,metavar='N')
+    parser.add_argument('--subchannels', help='Comma separated sizes of the subchannels, in 64-bit words',
+            default=",".join(str(stl) for stl in DEFAULT_SUBCHANNELS))
+    parser.add_argument('--seed', help='Seed for the content, loss and reordering',type=int,default=0)
+    parser.add_argument('--eti', help='Also write the ETI frames to this file')
+
+    cli_args = parser.parse_args()
+
+    if cli_args.fragments < 1:
+        parser.error("Invalid number of fragments")
+    if not 0 < cli_args.rs_k <= RS_MAX_K:
+        parser.error("Invalid Reed-Solomon chunk size")
+    if not 0.0 <= cli_args.loss < 1.0:
+        parser.error("Invalid loss probability")
+    try:
+        subchannels = [int(stl) for stl in cli_args.subchannels.split(",") if stl]
+    except ValueError:
+        parser.error("Invalid subchannel sizes")
+
+    af_packets, packets = generate(cli_args.frames, cli_args.mode,
+            cli_args.fragments, cli_args.rs_k, cli_args.loss, cli_args.reorder,
+            subchannels, cli_args.seed)
+
+    if cli_args.output == "-":
+        edi_fd = sys.stdout
+    else:
+        edi_fd = open(cli_args.output, "wb")
+    edi_fd.write(b"".join(packets))
+    edi_fd.flush()
+
+    if cli_args.eti:
+        with open(cli_args.eti, "wb") as fd:
+            for frame in synthetic_eti(cli_args.frames, subchannels, cli_args.seed):
+                fd.write(frame)
+
+    sys.stderr.write("Generated {} frames in {} packets, {} AF packets\n".format(
+        cli_args.frames, len(packets), len(af_packets)))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+#
+# Packet index for EDI capture files, stored as a sidecar file next to the
+# capture, to seek to a given ETI frame without decoding everything before it.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#
+# File format, all little endian:
+#  header:  magic "EDIX", version, capture size, capture mtime,
+#           number of packet records, number of frame records
+#  packets: one record per PF or AF packet: offset, pseq, findex, fcount
+#           (fcount is 0 for AF packets)
+#  frames:  one record per decoded AF packet: offset where decoding has to
+#           start to get this frame, FCT
+
+import os
+import mmap
+import struct
+
+INDEX_MAGIC = b"EDIX"
+INDEX_VERSION = 1
+
+index_header_struct = "<4sHQQQQ"
+index_packet_struct = "<QHII"
+index_frame_struct = "<QH"
+
+class EdiIndexError(Exception):
+    pass
+
+def index_filename(capture_filename):
+    return capture_filename + ".idx"
+
+class EdiIndex:
+    def __init__(self, capture_filename):
+        self.capture_filename = capture_filename
+        st = os.stat(capture_filename)
+        self.capture_size = st.st_size
+        self.capture_mtime = int(st.st_mtime)
+        # The records, at these offsets. A loaded index maps the index file
+        # and unpacks the records when they are needed.
+        self.packets = bytearray()
+        self.frames = bytearray()
+        self.packets_offset = 0
+        self.frames_offset = 0
+        self.num_packets = 0
+        self.num_frames = 0
+
+    def add_packet(self, offset, pseq, findex, fcount):
+        self.packets += struct.pack(index_packet_struct, offset, pseq, findex, fcount)
+        self.num_packets += 1
+
+    def add_frame(self, offset, fct):
+        self.frames += struct.pack(index_frame_struct, offset, fct)
+        self.num_frames += 1
+
+    def packet(self, n):
+        """Returns (offset, pseq, findex, fcount) of packet n"""
+        return struct.unpack_from(index_packet_struct, self.packets,
+                self.packets_offset + n * struct.calcsize(index_packet_struct))
+
+    def frame(self, n):
+        """Returns (offset, fct) of frame n"""
+        if n < 0 or n >= self.num_frames:
+            raise EdiIndexError("Frame {} not in index of {} frames".format(n, self.num_frames))
+        return struct.unpack_from(index_frame_struct, self.frames,
+                self.frames_offset + n * struct.calcsize(index_frame_struct))
+
+    def find_fct(self, fct, first_frame=0):
+        """Number of the first frame at or after first_frame with the given
+        FCT. The FCT counts the frames modulo 5000, the search starts where
+        the frame would be if none were lost, and goes back to first_frame.
+        After a discontinuity, the rest of the index is searched."""
+        if first_frame >= self.num_frames:
+            raise EdiIndexError("FCT {} not found in index".format(fct))
+        guess = first_frame + (fct - self.frame(first_frame)[1]) % 5000
+        for n in range(min(guess, self.num_frames - 1), first_frame - 1, -1):
+            if self.frame(n)[1] == fct:
+                return n
+        for n in range(guess + 1, self.num_frames):
+            if self.frame(n)[1] == fct:
+                return n
+        raise EdiIndexError("FCT {} not found in index".format(fct))
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = index_filename(self.capture_filename)
+        tmpname = filename + ".tmp"
+        with open(tmpname, "wb") as fd:
+            fd.write(struct.pack(index_header_struct, INDEX_MAGIC, INDEX_VERSION,
+                self.capture_size, self.capture_mtime,
+                self.num_packets, self.num_frames))
+            fd.write(self.packets[self.packets_offset:self.packets_offset +
+                self.num_packets * struct.calcsize(index_packet_struct)])
+            fd.write(self.frames[self.frames_offset:self.frames_offset +
+                self.num_frames * struct.calcsize(index_frame_struct)])
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def load(cls, capture_filename, filename=None):
+        """Load the index for the capture file. Raises EdiIndexError if it
+        does not exist, or if it was built for another version of the
+        capture. Only the header is read, the records are mapped."""
+        if filename is None:
+            filename = index_filename(capture_filename)
+
+        index = cls(capture_filename)
+        header_len = struct.calcsize(index_header_struct)
+        try:
+            with open(filename, "rb") as fd:
+                header = fd.read(header_len)
+                if len(header) < header_len:
+                    raise EdiIndexError("Index truncated")
+
+                magic, version, size, mtime, num_packets, num_frames = struct.unpack(
+                        index_header_struct, header)
+                if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                    raise EdiIndexError("Unknown index format")
+                if size != index.capture_size or mtime != index.capture_mtime:
+                    raise EdiIndexError("Index does not match capture file")
+
+                packets_len = num_packets * struct.calcsize(index_packet_struct)
+                frames_len = num_frames * struct.calcsize(index_frame_struct)
+                if os.fstat(fd.fileno()).st_size != header_len + packets_len + frames_len:
+                    raise EdiIndexError("Index truncated")
+
+                # The mapping stays valid after the file is closed
+                data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except EnvironmentError as e:
+            raise EdiIndexError("Cannot read index: {}".format(e))
+
+        index.packets = data
+        index.frames = data
+        index.packets_offset = header_len
+        index.frames_offset = header_len + packets_len
+        index.num_packets = num_packets
+        index.num_frames = num_frames
+        return index
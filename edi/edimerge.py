@@ -0,0 +1,325 @@
+#!/usr/bin/env python2
+#
+# Merge the copies of an EDI stream received over several network paths into
+# one stream
+#
+# Every PFT fragment, or AF packet without PFT, is forwarded as soon as its
+# first valid copy arrives, from whichever path. The copies from the other
+# paths are dropped. Per path, the loss and the delay behind the first copy are
+# measured. Optionally, the merged stream is put back in order with a
+# JitterBuffer, for receivers that cannot handle reordering.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import sys
+import json
+import errno
+import select
+import socket
+import argparse
+import collections
+
+from udpreceiver import UdpReceiver, parse_address
+from udpsender import Destination, parse_destination
+from jitterbuffer import JitterBuffer, JitterEstimator, packet_key
+from edisync import packet_at
+from pacer import monotonic
+
+class PathStats:
+    """Counters of one input path. A packet is lost on a path if it arrived
+    on another path only."""
+    def __init__(self, name):
+        self.name = name
+        self.received = 0
+        self.first = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.lost = 0
+        self.late = 0
+        # Delay behind the first copy, over the packets that were not late
+        self.delay_sum = 0.0
+        self.delay_max = 0.0
+        self.jitter = JitterEstimator()
+
+    def stats(self):
+        return {'received': self.received,
+                'first': self.first,
+                'duplicates': self.duplicates,
+                'invalid': self.invalid,
+                'lost': self.lost,
+                'late': self.late,
+                'delay_ms_mean': round(self.delay_sum / (self.first + self.duplicates) * 1000, 3)
+                    if self.first + self.duplicates else 0.0,
+                'delay_ms_max': round(self.delay_max * 1000, 3),
+                'jitter_ms': round(self.jitter.jitter * 1000, 2)}
+
+class MergeGroup:
+    """The copies of the fragments of one AF packet, or of the AF packet
+    itself, that arrived so far"""
+    def __init__(self, fcount, arrival):
+        self.fcount = fcount
+        self.arrival = arrival
+        # findex: arrival time of the first copy
+        self.first_arrival = {}
+        # findex: bitmask of the paths a copy arrived on
+        self.paths = {}
+
+class Merger:
+    """Deduplicates the EDI packets arriving on the paths named in
+    path_names. push() tells if a packet is the first copy, which has to be
+    forwarded.
+
+    Packets are identified by PFT pseq and findex, or by the AF sequence
+    number. AF packets with a wrong CRC count as invalid, so that a later
+    copy from another path can be forwarded instead. A group of fragments is kept until max_delay seconds after its
+    first packet arrived, or until history newer groups arrived. Then the
+    paths without a copy of a fragment count it as lost, and copies that
+    arrive later are counted as late and dropped. max_delay has to be
+    larger than the delay between the paths. Once a group has been expired
+    for twice max_delay, its sequence number counts as new again, like after
+    a restart of the sender."""
+
+    def __init__(self, path_names, max_delay=0.5, history=1000):
+        self.paths = [PathStats(name) for name in path_names]
+        self.max_delay = max_delay
+        self.history = history
+
+        # (sync, sequence number): MergeGroup, in order of arrival
+        self.groups = collections.OrderedDict()
+        # (sync, sequence number): arrival of the groups that were expired
+        self.expired = collections.OrderedDict()
+
+        self.num_forwarded = 0
+        self.num_groups = 0
+        # Fragments that arrived on no path, in groups that arrived
+        self.num_lost = 0
+
+    def push(self, path, packet, now):
+        """Returns True if the packet, received on path number path at time
+        now, has to be forwarded"""
+        stats = self.paths[path]
+        self.expire(now)
+
+        key = packet_key(packet)
+        if key is None:
+            stats.invalid += 1
+            return False
+        seq, findex, fcount = key
+        pft = packet[:2] == b"PF"
+        if not pft and packet_at(packet, 0) is None:
+            # The CRC of PF fragments only covers the header, which
+            # packet_key() checked
+            stats.invalid += 1
+            return False
+        key = (pft, seq)
+        stats.received += 1
+
+        group = self.groups.get(key)
+        if group is None:
+            expired = self.expired.get(key)
+            if expired is not None and now - expired < 2 * self.max_delay:
+                stats.late += 1
+                return False
+
+            group = MergeGroup(fcount, now)
+            self.groups[key] = group
+            self.num_groups += 1
+            while len(self.groups) > self.history:
+                self.finish(*self.groups.popitem(last=False))
+
+        stats.jitter.update(seq, now)
+        mask = 1 << path
+        first_arrival = group.first_arrival.get(findex)
+        if first_arrival is None:
+            group.first_arrival[findex] = now
+            group.paths[findex] = mask
+            stats.first += 1
+            self.num_forwarded += 1
+            return True
+
+        delay = now - first_arrival
+        stats.delay_sum += delay
+        stats.delay_max = max(stats.delay_max, delay)
+        group.paths[findex] |= mask
+        stats.duplicates += 1
+        return False
+
+    def expire(self, now):
+        """Finish the groups that will not receive more copies"""
+        while self.groups:
+            key = next(iter(self.groups))
+            if now - self.groups[key].arrival <= self.max_delay:
+                break
+            self.finish(key, self.groups.pop(key))
+
+        while self.expired:
+            key = next(iter(self.expired))
+            if now - self.expired[key] <= 2 * self.max_delay:
+                break
+            del self.expired[key]
+
+    def finish(self, key, group):
+        for path, stats in enumerate(self.paths):
+            mask = 1 << path
+            stats.lost += sum(1 for paths in group.paths.values() if not paths & mask)
+        self.num_lost += group.fcount - len(group.first_arrival)
+        self.expired[key] = group.arrival
+
+    def stats(self):
+        return {'forwarded': self.num_forwarded,
+                'groups': self.num_groups,
+                'lost': self.num_lost,
+                'paths': dict((stats.name, stats.stats()) for stats in self.paths)}
+
+
+def print_stats(merger, fd, **extra):
+    """Write the statistics as one line of JSON"""
+    summary = merger.stats()
+    summary.update(extra)
+    fd.write(json.dumps(summary, sort_keys=True) + "\n")
+    fd.flush()
+
+
+if __name__ == "__main__":
+    program_description = """
+        Opendigitalradio EDI merger.
+        Receive the same EDI stream over several paths, and forward the
+        first copy of every packet."""
+    parser = argparse.ArgumentParser(description=program_description)
+    parser.add_argument('-i','--input', help='Receive one path on [IP:]PORT. If IP is a multicast group, join it on the interface with address IFACE. Give it once per path',
+            action='append',required=True,metavar='[IP:]PORT[,iface=IFACE]')
+    parser.add_argument('-d','--dest', help='Send the merged stream to IP:PORT[,ttl=N][,iface=IP][,src=PORT]. Can be given several times',action="append",default=[])
+    parser.add_argument('-o','--output', help='Write the merged stream to FILE, as capture for edidebug',metavar='FILE')
+    parser.add_argument('--max-delay', help='Longest delay in MS milliseconds between the paths, later copies are dropped',type=float,default=500.0,metavar='MS')
+    parser.add_argument('--reorder', help='Send the packets in order, waiting up to MS milliseconds for missing ones. By default, every packet is sent when its first copy arrives',type=float,metavar='MS')
+    parser.add_argument('--udp-batch', help='Maximum number of datagrams received at once per path',type=int,default=64)
+    parser.add_argument('--stats-interval', help='Print the statistics as JSON every SEC seconds',type=float,metavar='SEC')
+
+    cli_args = parser.parse_args()
+
+    if not cli_args.dest and not cli_args.output:
+        parser.error("Give at least one destination or an output file")
+    if cli_args.max_delay <= 0:
+        parser.error("Invalid maximum delay")
+    if cli_args.reorder is not None and cli_args.reorder <= 0:
+        parser.error("Invalid reordering delay")
+    if cli_args.stats_interval is not None and cli_args.stats_interval <= 0:
+        parser.error("Invalid statistics interval")
+
+    receivers = []
+    for spec in cli_args.input:
+        fields = spec.split(",")
+        interface = "0.0.0.0"
+        try:
+            ip, port = parse_address(fields[0])
+            for field in fields[1:]:
+                key, sep, value = field.partition("=")
+                if key != "iface":
+                    raise ValueError("Unknown input option {}".format(field))
+                interface = value
+            receivers.append(UdpReceiver(ip, port, interface, cli_args.udp_batch))
+        except (ValueError, socket.error) as e:
+            parser.error("Invalid input {}: {}".format(spec, e))
+
+    destinations = []
+    for spec in cli_args.dest:
+        try:
+            address, options = parse_destination(spec)
+            destinations.append(Destination(address, **options))
+        except (ValueError, socket.error) as e:
+            parser.error("Invalid destination {}: {}".format(spec, e))
+
+    output_fd = None
+    if cli_args.output:
+        output_fd = sys.stdout if cli_args.output == "-" else open(cli_args.output, "wb")
+    # The JSON statistics go to stdout, unless the merged stream is there
+    stats_fd = sys.stderr if cli_args.output == "-" else sys.stdout
+
+    path_of = dict((receiver, path) for path, receiver in enumerate(receivers))
+    merger = Merger([spec.split(",")[0] for spec in cli_args.input],
+            cli_args.max_delay / 1000.0)
+
+    jitter_buffer = None
+    if cli_args.reorder:
+        jitter_buffer = JitterBuffer(cli_args.reorder / 1000.0)
+
+    def send(packet):
+        for dest in destinations:
+            dest.send(packet)
+        if output_fd:
+            output_fd.write(packet)
+
+    def all_stats():
+        extra = {'destinations': dict((repr(dest), dest.stats()) for dest in destinations)}
+        if jitter_buffer:
+            extra['jitter_buffer'] = jitter_buffer.stats()
+        return extra
+
+    next_report = None
+    if cli_args.stats_interval:
+        next_report = monotonic() + cli_args.stats_interval
+
+    try:
+        while True:
+            timeout = None
+            if next_report is not None:
+                timeout = max(0.0, next_report - monotonic())
+            if jitter_buffer:
+                release = jitter_buffer.timeout(monotonic())
+                if release is not None and (timeout is None or release < timeout):
+                    timeout = release
+            try:
+                readable, _, _ = select.select(receivers, [], [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            now = monotonic()
+            for receiver in readable:
+                path = path_of[receiver]
+                for stream in receiver.receive(0):
+                    if not merger.push(path, stream.data, now):
+                        continue
+                    if jitter_buffer:
+                        jitter_buffer.push(stream.data, now)
+                    else:
+                        send(stream.data)
+
+            if jitter_buffer:
+                for packet in jitter_buffer.pop(now):
+                    send(packet)
+
+            if next_report is not None and now >= next_report:
+                print_stats(merger, stats_fd, **all_stats())
+                next_report += cli_args.stats_interval
+    except KeyboardInterrupt:
+        pass
+
+    if jitter_buffer:
+        for packet in jitter_buffer.pop(monotonic() + jitter_buffer.latency):
+            send(packet)
+    if output_fd:
+        output_fd.flush()
+    merger.expire(monotonic() + 2 * merger.max_delay + 1)
+    print_stats(merger, stats_fd, **all_stats())
@@ -0,0 +1,326 @@
+#!/usr/bin/env python2
+#
+# Monitor many EDI feeds in one process, and serve their health as JSON over
+# HTTP
+#
+# All feeds are received and decoded on one select() event loop, each with
+# its own EdiDecoder. GET / returns the state of all feeds, GET /feeds/NAME
+# the state of one of them.
+#
+# Feeds file format: one feed per line, "NAME [IP:]PORT [INTERFACE]". Empty
+# lines and lines starting with # are ignored.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import time
+import json
+import errno
+import select
+import argparse
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from edidecoder import EdiDecoder, DecoderStats, Printer, QUIET
+from udpreceiver import UdpReceiver, parse_address
+from jitterbuffer import JitterEstimator, packet_key
+
+# The windowed rates and the feed status are updated this often
+TICK_INTERVAL = 1.0
+
+def parse_feed(spec):
+    """Parse "NAME=[IP:]PORT[,iface=IP]" into (name, ip, port, interface)"""
+    name, sep, rest = spec.partition("=")
+    if not name or not rest:
+        raise ValueError("Feed {} has no name or address".format(spec))
+    fields = rest.split(",")
+    ip, port = parse_address(fields[0])
+    interface = "0.0.0.0"
+    for field in fields[1:]:
+        key, sep, value = field.partition("=")
+        if key == "iface":
+            interface = value
+        else:
+            raise ValueError("Unknown feed option {}".format(field))
+    return name, ip, port, interface
+
+def read_feeds(fd):
+    """Read the feeds file, returns a list of (name, ip, port, interface)"""
+    feeds = []
+    for num, line in enumerate(fd, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        if len(fields) not in (2, 3):
+            raise ValueError("Line {}: expected NAME [IP:]PORT [INTERFACE]".format(num))
+        try:
+            ip, port = parse_address(fields[1])
+        except ValueError:
+            raise ValueError("Line {}: invalid address {}".format(num, fields[1]))
+        interface = fields[2] if len(fields) == 3 else "0.0.0.0"
+        feeds.append((fields[0], ip, port, interface))
+    return feeds
+
+def ratio(num, den):
+    return round(float(num) / den, 6) if den else 0.0
+
+def window_rates(before, after, duration):
+    """The health figures from the difference between two DecoderStats
+    dicts, taken duration seconds apart"""
+    d = dict((name, after[name] - before[name]) for name in DecoderStats.counter_names)
+    return {'duration': round(duration, 3),
+            'frames_per_second': round(d['frames'] / duration, 2),
+            'pft_crc_error_rate': ratio(d['pft_crc_errors'], d['pft_fragments']),
+            'af_crc_error_rate': ratio(d['af_crc_errors'], d['af_packets'] + d['af_crc_errors']),
+            'rs_error_rate': ratio(d['rs_mismatches'], d['rs_chunks_checked']),
+            'fragment_loss': ratio(d['missing_fragments'],
+                d['pft_fragments'] + d['missing_fragments']),
+            'pseq_missing': d['pseq_missing'],
+            'unrecovered_sets': d['incomplete_sets'] - d['recovered_sets'],
+            'fct_discontinuities': d['fct_discontinuities'],
+            'skipped_bytes': d['skipped_bytes']}
+
+class Feed:
+    """One EDI feed: its receiver, decoder, and health state. The error
+    rates are calculated over windows of window seconds."""
+
+    def __init__(self, name, ip, port, interface="0.0.0.0", batch_size=8,
+            verify_protection=True, window=10.0):
+        self.name = name
+        self.address = "{}:{}".format(ip, port)
+        self.receiver = UdpReceiver(ip, port, interface, batch_size)
+        self.decoder = EdiDecoder(on_frame=self.new_frame,
+                verify_protection=verify_protection)
+        self.jitter = JitterEstimator()
+
+        self.now = time.time()
+        self.last_fct = None
+        self.last_frame_time = None
+        self.last_packet_time = None
+        self.status = "waiting"
+
+        self.window = window
+        self.window_start = self.now
+        self.window_counters = self.decoder.stats.as_dict()
+        self.rates = None
+
+    def fileno(self):
+        """For select()"""
+        return self.receiver.fileno()
+
+    def new_frame(self, eti_data):
+        self.last_fct = eti_data.fc['FCT']
+        self.last_frame_time = self.now
+
+    def receive(self, now):
+        """Decode everything that was received"""
+        self.now = now
+        streams = self.receiver.receive(0)
+        for stream in streams:
+            key = packet_key(stream.data)
+            if key is not None:
+                self.jitter.update(key[0], now)
+            self.decoder.push_datagram(stream.data)
+        if streams:
+            self.last_packet_time = now
+
+    def tick(self, now, stale_timeout):
+        """Update the rates and the status, returns True if the status
+        changed"""
+        if now - self.window_start >= self.window:
+            counters = self.decoder.stats.as_dict()
+            self.rates = window_rates(self.window_counters, counters, now - self.window_start)
+            self.window_counters = counters
+            self.window_start = now
+
+        if self.last_packet_time is None:
+            status = "waiting"
+        elif self.last_frame_time is None or now - self.last_frame_time > stale_timeout:
+            status = "stale"
+        elif self.rates and (self.rates['pft_crc_error_rate'] or
+                self.rates['af_crc_error_rate'] or self.rates['rs_error_rate'] or
+                self.rates['unrecovered_sets'] or self.rates['fct_discontinuities']):
+            status = "degraded"
+        else:
+            status = "ok"
+
+        changed = status != self.status
+        self.status = status
+        return changed
+
+    def state(self, now):
+        def age(t):
+            return round(now - t, 3) if t is not None else None
+
+        return {'name': self.name,
+                'address': self.address,
+                'status': self.status,
+                'last_fct': self.last_fct,
+                'last_frame_age': age(self.last_frame_time),
+                'last_packet_age': age(self.last_packet_time),
+                'jitter_ms': round(self.jitter.jitter * 1000, 2),
+                'window': self.rates,
+                'totals': self.decoder.summary(),
+                'receiver': self.receiver.stats()}
+
+    def close(self):
+        self.receiver.close()
+
+class StateHandler(BaseHTTPRequestHandler):
+    """Serves the state of the Monitor of the server"""
+
+    # The event loop must not hang on a slow client
+    timeout = 1.0
+
+    def do_GET(self):
+        monitor = self.server.monitor
+        now = time.time()
+        path = self.path.split("?")[0].rstrip("/")
+        if path in ("", "/feeds"):
+            state = monitor.state(now)
+        elif path.startswith("/feeds/") and path[7:] in monitor.feeds:
+            state = monitor.feeds[path[7:]].state(now)
+        else:
+            self.send_error(404)
+            return
+
+        body = (json.dumps(state, sort_keys=True) + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.monitor.p.pr("HTTP {} {}", self.client_address[0], format % args)
+
+class Monitor:
+    """Runs the event loop for the feeds and the HTTP server"""
+
+    def __init__(self, feeds, http_address=None, stale_timeout=1.0, printer=None):
+        self.feeds = dict((feed.name, feed) for feed in feeds)
+        self.stale_timeout = stale_timeout
+        self.p = printer if printer is not None else Printer(level=QUIET)
+        self.start_time = time.time()
+
+        self.http = None
+        if http_address is not None:
+            self.http = HTTPServer(http_address, StateHandler)
+            self.http.timeout = 0
+            self.http.monitor = self
+
+    def state(self, now):
+        return {'uptime': round(now - self.start_time, 3),
+                'feeds': dict((name, feed.state(now)) for name, feed in self.feeds.items())}
+
+    def run(self):
+        inputs = list(self.feeds.values())
+        if self.http:
+            inputs.append(self.http)
+
+        next_tick = time.time() + TICK_INTERVAL
+        while True:
+            try:
+                readable, _, _ = select.select(inputs, [], [],
+                        max(0.0, next_tick - time.time()))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            now = time.time()
+            for ready in readable:
+                if ready is self.http:
+                    self.http.handle_request()
+                else:
+                    ready.receive(now)
+
+            if now >= next_tick:
+                for name, feed in sorted(self.feeds.items()):
+                    if feed.tick(now, self.stale_timeout):
+                        self.p.summary("Feed {} ({}) is {}", name, feed.address, feed.status)
+                next_tick = max(next_tick + TICK_INTERVAL, now)
+
+    def close(self):
+        for feed in self.feeds.values():
+            feed.close()
+        if self.http:
+            self.http.server_close()
+
+
+if __name__ == "__main__":
+    program_description = """
+        Opendigitalradio EDI monitor.
+        Receive and decode many EDI feeds, and serve their health as JSON
+        over HTTP."""
+    parser = argparse.ArgumentParser(description=program_description)
+    parser.add_argument('-c','--feeds', help='Read the feeds from FILE, one "NAME [IP:]PORT [INTERFACE]" per line',metavar='FILE')
+    parser.add_argument('-F','--feed', help='Receive the feed NAME on [IP:]PORT, joining the multicast group on the interface with address IFACE. Can be repeated',
+            action='append',default=[],metavar='NAME=[IP:]PORT[,iface=IFACE]')
+    parser.add_argument('--http', help='Serve the state on [IP:]PORT',default="127.0.0.1:8080")
+    parser.add_argument('-w','--window', help='Calculate the error rates over SEC seconds',type=float,default=10.0,metavar='SEC')
+    parser.add_argument('--stale', help='A feed without frames for SEC seconds is stale',type=float,default=1.0,metavar='SEC')
+    parser.add_argument('--udp-batch', help='Maximum number of datagrams received at once per feed',type=int,default=8)
+    parser.add_argument('-V','--no-rs-verify', help='Do not verify Reed-Solomon encoding (faster)',action="store_true")
+    parser.add_argument('-v','--verbosity', help='Output level: 0 quiet, 1 feed status changes, 2 also HTTP requests',type=int,choices=range(3),default=1)
+
+    cli_args = parser.parse_args()
+
+    try:
+        specs = [parse_feed(spec) for spec in cli_args.feed]
+        if cli_args.feeds:
+            with open(cli_args.feeds) as fd:
+                specs.extend(read_feeds(fd))
+    except (ValueError, IOError) as e:
+        parser.error(str(e))
+
+    if not specs:
+        parser.error("No feeds given")
+    names = [spec[0] for spec in specs]
+    if len(set(names)) != len(names):
+        parser.error("The feed names must be unique")
+    if cli_args.window <= 0 or cli_args.stale <= 0:
+        parser.error("Invalid window or stale timeout")
+
+    try:
+        http_address = parse_address(cli_args.http)
+    except ValueError:
+        parser.error("Invalid HTTP address {}".format(cli_args.http))
+
+    p = Printer(level=cli_args.verbosity)
+
+    feeds = [Feed(name, ip, port, interface, cli_args.udp_batch,
+        not cli_args.no_rs_verify, cli_args.window)
+        for name, ip, port, interface in specs]
+
+    monitor = Monitor(feeds, http_address, cli_args.stale, p)
+    p.summary("Monitoring {} feeds, state on http://{}:{}/", len(feeds),
+            http_address[0] or "0.0.0.0", http_address[1])
+
+    try:
+        monitor.run()
+    except KeyboardInterrupt:
+        pass
+    monitor.close()
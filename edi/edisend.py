@@ -26,77 +26,135 @@
 
 import sys
 import struct
+import argparse
 
 from crc import crc16
 from reedsolo import RSCodec
+from bufferedfile import BufferedFile
+from pacer import Pacer, FRAME_INTERVAL, monotonic
+from udpsender import Destination, parse_destination
+from edisync import resync, is_truncated, MAX_AF_LENGTH
+from jitterbuffer import seq_distance, RESYNC_DISTANCE
 
 import socket
-import time
 
 UDP_IP = "239.20.64.1"
 UDP_PORT = 12002
 
-class BufferedFile:
-    def __init__(self, fname):
-        self.buf = []
-
-        if fname == "-":
-            self.fd = sys.stdin
-        else:
-            self.fd = open(fname, "rb")
-
-    def read(self, n):
-        if not self.buf:
-            return self.fd.read(n)
-        else:
-            if len(self.buf) < n:
-                self.buf.extend(self.fd.read(n - len(self.buf)))
-
-            if len(self.buf) == n:
-                ret = b"".join(self.buf)
-                self.buf = []
-            else:
-                ret = b"".join(self.buf[:n])
-                del self.buf[:n]
-
-            return ret
-
-    def peek(self, n):
-        dat = self.fd.read(n)
-        self.buf.extend(dat)
-        return dat
-
-
 pft_head_struct = "!2sH3B3BH"
 pft_rs_head_struct = "!2B"
 pft_addr_head_struct = "!2H"
 af_head_struct = "!2sLHBc"
+# Print the statistics every minute
+STATS_INTERVAL = 2500
+
 class EDI:
-    def __init__(self):
-        self.last_send_time = time.time()
-        self.sock = socket.socket(socket.AF_INET, # Internet
-                         socket.SOCK_DGRAM) # UDP
+    def __init__(self, destinations, speed=1.0):
+        """speed is the replay speed factor, 0 to send as fast as possible"""
+        self.pacer = Pacer(FRAME_INTERVAL / speed) if speed else None
+        self.destinations = destinations
+
+        # The packets of the AF packet being read, all sent at the same
+        # deadline. With PFT, a frame starts at the first fragment of a
+        # pseq newer than newest_pseq, late fragments of older pseqs are
+        # sent in the frame they arrive in.
+        self.batch = []
+        self.newest_pseq = None
+        self.on_frame = self.send_frame
+
+        self.num_frames = 0
+        self.num_packets = 0
+        self.num_bytes = 0
+        self.start_time = None
+
+        # Corrupt data skipped in the input
+        self.num_resync = 0
+        self.num_skipped = 0
 
     def send_udp(self, message):
-        self.sock.sendto(message, (UDP_IP, UDP_PORT))
-
+        for dest in self.destinations:
+            dest.send(message)
+
+    def end_frame(self):
+        """The packets in the batch are complete"""
+        if self.batch:
+            self.on_frame(self.batch)
+            self.batch = []
+
+    def send_frame(self, packets):
+        """Wait for the deadline of the next frame, and send all its packets
+        back to back"""
+        if self.pacer:
+            self.pacer.wait()
+
+        if self.start_time is None:
+            self.start_time = monotonic()
+
+        for packet in packets:
+            self.send_udp(packet)
+            self.num_bytes += len(packet)
+        self.num_packets += len(packets)
+        self.num_frames += 1
+
+        if self.num_frames % STATS_INTERVAL == 0:
+            self.print_stats()
+
+    def load(self, stream):
+        """Read and check all packets of the stream. Returns the list of
+        frames, each a list of packets, to be sent with send_frame()"""
+        frames = []
+        self.on_frame = frames.append
+        while self.decode(stream):
+            pass
+        self.end_frame()
+        self.on_frame = self.send_frame
+        return frames
+
+    def print_stats(self):
+        if self.pacer:
+            print("Pacing: {}".format(", ".join("{}={}".format(k, v)
+                for k, v in sorted(self.pacer.stats().items()))))
+
+        if self.start_time is not None:
+            duration = max(monotonic() - self.start_time, 1e-9)
+            print("Sent {} frames, {} packets: {:.1f} packets/s, {:.3f} Mbit/s".format(
+                self.num_frames, self.num_packets,
+                self.num_packets / duration, self.num_bytes * 8 / duration / 1e6))
+
+        if self.num_resync:
+            print("Skipped {} bytes of invalid data in {} places".format(
+                self.num_skipped, self.num_resync))
+
+        for dest in self.destinations:
+            print("{}: {}".format(dest, ", ".join("{}={}".format(k, v)
+                for k, v in sorted(dest.stats().items()))))
 
     def decode(self, stream):
+        """Read the next packet. Invalid packets are not consumed, and the
+        stream gets resynchronised to the next valid one. Returns False at
+        the end of the stream."""
         sync = stream.peek(2)
 
         if len(sync) < 2:
             return False
 
         if sync == "PF":
-            return self.decode_pft(stream)
+            ok = self.decode_pft(stream)
         elif sync == "AF":
-            return self.decode_af(stream, is_stream=True)
-
+            ok = self.decode_af(stream, is_stream=True)
+        else:
+            ok = False
 
+        if not ok:
+            self.num_resync += 1
+            self.num_skipped += resync(stream)
+        return True
 
     def decode_pft(self, stream):
-        headerdata = stream.read(12)
-        header = struct.unpack(pft_head_struct, headerdata)
+        headerdata = stream.peek(12)
+        if len(headerdata) < 12:
+            return False
+        header = struct.unpack_from(pft_head_struct, headerdata)
 
         psync, pseq, findex1, findex2, findex3, fcount1, fcount2, fcount3, fec_ad_plen = header
 
@@ -107,52 +165,62 @@ class EDI:
         addr = (fec_ad_plen & 0x4000) != 0x00
         plen = fec_ad_plen & 0x3FFF
 
+        header_len = 12
+        if fec:
+            header_len += 2
+        if addr:
+            header_len += 4
+
+        headerdata = stream.peek(header_len + 2)
+        if len(headerdata) < header_len + 2:
+            return False
+
         rs_k = 0
         rs_z = 0
         if fec:
-            rs_head = stream.read(2)
-            rs_k, rs_z = struct.unpack(pft_rs_head_struct, rs_head)
-            headerdata += rs_head
+            rs_k, rs_z = struct.unpack_from(pft_rs_head_struct, headerdata, 12)
 
         addr_source = 0
         addr_dest   = 0
         if addr:
-            addr_head = stream.read(4)
-            addr_source, addr_dest = struct.unpack(pft_addr_head_struct, addr_head)
-            headerdata += addr_head
+            addr_source, addr_dest = struct.unpack_from(pft_addr_head_struct,
+                    headerdata, header_len - 4)
 
-        # read CRC
-        crc_data = stream.read(2)
-        crc = struct.unpack("!H", crc_data)[0]
+        crc = struct.unpack_from("!H", headerdata, header_len)[0]
 
-        crc_calc = crc16(headerdata)
+        crc_calc = crc16(headerdata[:header_len])
         crc_calc ^= 0xFFFF
 
-        crc_ok = crc_calc == crc
-
-        time_now = time.time()
-        if findex == 0:
-            if self.last_send_time + 24e-3 > time_now:
-                delay = self.last_send_time + 24e-3 - time_now
-                print("Sleeping for {} ms".format(1000 * delay))
-                time.sleep(delay)
-            self.last_send_time = time_now
+        if crc_calc != crc or is_truncated(stream, header_len + 2 + plen):
+            return False
 
+        # The whole fragment is read at once, and transmitted without
+        # being copied again
+        packet = stream.read(header_len + 2 + plen)
+        if len(packet) < header_len + 2 + plen:
+            return False
 
-        if crc_ok:
-            payload = stream.read(plen)
-            self.send_udp(headerdata + crc_data + payload)
+        if (self.newest_pseq is None or
+                0 < seq_distance(self.newest_pseq, pseq) < 0x8000 or
+                # The sender restarted
+                RESYNC_DISTANCE < seq_distance(pseq, self.newest_pseq) < 0x8000):
+            self.end_frame()
+            self.newest_pseq = pseq
+        self.batch.append(packet)
 
-        return crc_ok
+        return True
 
 
     def decode_af(self, in_data, is_stream=False):
         if is_stream:
-            headerdata = in_data.read(10)
+            headerdata = in_data.peek(10)
         else:
             headerdata = in_data[:10]
 
-        sync, plen, seq, ar, pt = struct.unpack(af_head_struct, headerdata)
+        if len(headerdata) < 10:
+            return False
+
+        sync, plen, seq, ar, pt = struct.unpack_from(af_head_struct, headerdata)
 
         if sync != "AF":
             return False
@@ -160,34 +228,76 @@ class EDI:
         crc_flag = (ar & 0x80) != 0x00
         revision = ar & 0x7F
 
+        if plen > MAX_AF_LENGTH:
+            return False
+
         if is_stream:
-            payload = in_data.read(plen)
-            crc_data = in_data.read(2)
-            crc = struct.unpack("!H", crc_data)[0]
+            # Only consumed once the CRC is checked
+            packet = in_data.peek(10 + plen + 2)
         else:
-            payload = in_data[10:10+plen]
-            crc_data = in_data[10+plen:10+plen+2]
-            crc = struct.unpack("!H", crc_data)[0]
+            packet = in_data[:10 + plen + 2]
 
-        crc_calc = crc16(headerdata)
-        crc_calc = crc16(payload, crc_calc)
-        crc_calc ^= 0xFFFF
-
-        crc_ok = crc_calc == crc
-
-        if crc_ok:
-            self.send_udp(headerdata + payload + crc_data)
+        if len(packet) < 10 + plen + 2:
+            return False
 
-        return crc_ok
+        crc = struct.unpack_from("!H", packet, 10 + plen)[0]
 
-if len(sys.argv) > 1:
-    filename = sys.argv[1]
+        crc_calc = crc16(packet[:10 + plen])
+        crc_calc ^= 0xFFFF
 
-    edi_fd = BufferedFile(filename)
-else:
-    edi_fd = BufferedFile("-")
+        if crc_flag and crc_calc != crc:
+            return False
 
-edi = EDI()
-while edi.decode(edi_fd):
+        if is_stream:
+            in_data.read(10 + plen + 2)
+
+        # Every AF packet is one frame
+        self.end_frame()
+        self.batch.append(packet)
+        self.end_frame()
+
+        return True
+
+parser = argparse.ArgumentParser(description="Read an EDI dump file and transmit over UDP")
+parser.add_argument('edi_file', help='EDI input file name, default stdin',nargs='?',default="-")
+parser.add_argument('-l','--loop', help='Load and check the whole input first, then send it N times, 0 to repeat forever',type=int)
+parser.add_argument('-s','--speed', help='Replay speed factor, 0 to send as fast as possible',type=float,default=1.0)
+parser.add_argument('-d','--dest', help='Destination IP:PORT[,ttl=N][,iface=IP][,src=PORT], iface is the local address of the interface. Can be given several times. Default {}:{}'.format(UDP_IP, UDP_PORT),action="append")
+
+cli_args = parser.parse_args()
+
+if cli_args.speed < 0:
+    parser.error("Invalid speed factor")
+if cli_args.loop is not None and cli_args.loop < 0:
+    parser.error("Invalid loop count")
+
+destinations = []
+for spec in cli_args.dest or ["{}:{}".format(UDP_IP, UDP_PORT)]:
+    try:
+        address, options = parse_destination(spec)
+        destinations.append(Destination(address, **options))
+    except (ValueError, socket.error) as e:
+        parser.error("Invalid destination {}: {}".format(spec, e))
+
+edi_fd = BufferedFile(cli_args.edi_file)
+
+edi = EDI(destinations, cli_args.speed)
+try:
+    if cli_args.loop is None:
+        while edi.decode(edi_fd):
+            pass
+        edi.end_frame()
+    else:
+        frames = edi.load(edi_fd)
+        print("Loaded {} frames".format(len(frames)))
+        if not frames:
+            sys.exit(1)
+
+        num_loops = 0
+        while cli_args.loop == 0 or num_loops < cli_args.loop:
+            for packets in frames:
+                edi.send_frame(packets)
+            num_loops += 1
+except KeyboardInterrupt:
     pass
-
+edi.print_stats()
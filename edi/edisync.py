@@ -0,0 +1,226 @@
+#!/usr/bin/env python2
+#
+# Find EDI packets in captures and streams, and resynchronise on corrupt or
+# truncated data
+#
+# A PF packet is valid if its header CRC is correct, an AF packet if its CRC
+# is correct. AF packets without CRC are accepted if the header looks like a
+# TAG packet of EDI revision 1.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import struct
+
+from crc import crc16
+
+pft_head_struct = "!2sH3B3BH"
+af_head_struct = "!2sLHBc"
+
+# Longest PF header, with RS and transport header, and CRC
+PFT_MAX_HEADER = 20
+
+# Longer AF packets are considered corrupt. AF packets carrying ETI are
+# below 8kB.
+MAX_AF_LENGTH = 0x100000
+
+# The search reads the stream in windows that grow from the first to the
+# second size
+RESYNC_MIN_WINDOW = 4096
+RESYNC_MAX_WINDOW = 1024 * 1024
+
+def find_sync(data, pos, end=None):
+    """Offset of the first "PF" or "AF" in data[pos:end], or -1. data must
+    have a find() method. The search range grows exponentially, so that
+    looking for a sync that does not appear in the rest of the data does
+    not cost more than the distance to the one that does."""
+    if end is None:
+        end = len(data)
+    window = 256
+    while True:
+        stop = min(pos + window, end)
+        pf = data.find(b"PF", pos, stop)
+        af = data.find(b"AF", pos, stop if pf == -1 else pf + 1)
+        if af != -1:
+            return af
+        if pf != -1:
+            return pf
+        if stop == end:
+            return -1
+        # A sync can straddle the window boundary
+        pos = stop - 1
+        window *= 2
+
+def check_length(data, pos):
+    """Number of bytes from pos that packet_at() needs to check the
+    packet"""
+    sync = data[pos:pos+2]
+    if sync == b"PF":
+        header = data[pos:pos+12]
+        if len(header) < 12:
+            return PFT_MAX_HEADER
+        fec_ad_plen = struct.unpack_from("!H", header, 10)[0]
+        return (14 + (2 if fec_ad_plen & 0x8000 else 0) +
+                (4 if fec_ad_plen & 0x4000 else 0))
+    elif sync == b"AF":
+        header = data[pos:pos+10]
+        if len(header) < 10:
+            return 12
+        plen = struct.unpack_from("!L", header, 2)[0]
+        # packet_at() rejects too long packets from the header
+        return 12 + plen if plen <= MAX_AF_LENGTH else 10
+    return 2
+
+def packet_at(data, pos):
+    """Check if a valid EDI packet starts at pos in data. Returns
+    (sync, pseq, length), with pseq None for AF packets, or None"""
+    sync = data[pos:pos+2]
+    if sync == b"PF":
+        header = data[pos:pos+12]
+        if len(header) < 12:
+            return None
+        fec_ad_plen = struct.unpack_from(pft_head_struct, header)[-1]
+        pseq = struct.unpack_from("!H", header, 2)[0]
+        header_len = 12
+        if fec_ad_plen & 0x8000:
+            header_len += 2
+        if fec_ad_plen & 0x4000:
+            header_len += 4
+        header = data[pos:pos+header_len+2]
+        if len(header) < header_len + 2:
+            return None
+        crc = struct.unpack_from("!H", header, header_len)[0]
+        if crc16(header[:header_len]) ^ 0xFFFF != crc:
+            return None
+        return ("PF", pseq, header_len + 2 + (fec_ad_plen & 0x3FFF))
+    elif sync == b"AF":
+        header = data[pos:pos+10]
+        if len(header) < 10:
+            return None
+        sync, plen, seq, ar, pt = struct.unpack_from(af_head_struct, header)
+        if plen > MAX_AF_LENGTH:
+            return None
+        packet = data[pos:pos+10+plen+2]
+        if len(packet) < 10 + plen + 2:
+            return None
+        if ar & 0x80:
+            crc = struct.unpack_from("!H", packet, 10+plen)[0]
+            if crc16(packet[:10+plen]) ^ 0xFFFF != crc:
+                return None
+        elif pt != b"T" or (ar & 0x70) != 0x10:
+            return None
+        return ("AF", None, 10 + plen + 2)
+    return None
+
+def packet_length(data, pos):
+    """Length of the packet at pos according to its header, to know how
+    much data is needed before decoding it. Returns None if data does not
+    contain the whole header yet, and 0 if there is no plausible packet at
+    pos: a PF header with a wrong CRC, or an AF header that is too long or
+    not a TAG packet of revision 1. The AF CRC is left to the decoder."""
+    sync = data[pos:pos+2]
+    if sync == b"PF":
+        if len(data) - pos < check_length(data, pos):
+            return None
+        packet = packet_at(data, pos)
+        return packet[2] if packet is not None else 0
+    elif sync == b"AF":
+        header = data[pos:pos+10]
+        if len(header) < 10:
+            return None
+        sync, plen, seq, ar, pt = struct.unpack_from(af_head_struct, header)
+        if plen > MAX_AF_LENGTH or pt != b"T" or (ar & 0x70) != 0x10:
+            return 0
+        return 10 + plen + 2
+    elif len(sync) < 2:
+        return None
+    return 0
+
+def find_packet(data, pos):
+    """Offset of the first valid EDI packet at or after pos, or None"""
+    while True:
+        pos = find_sync(data, pos)
+        if pos == -1:
+            return None
+        if packet_at(data, pos) is not None:
+            return pos
+        pos += 1
+
+def is_truncated(stream, length):
+    """Check if the packet of length bytes at the current position of the
+    stream is truncated, because it is not followed by a sync or the end of
+    the stream, but another valid packet starts inside it."""
+    following = stream.peek(length + 2)[length:]
+    if len(following) < 2 or following == b"PF" or following == b"AF":
+        return False
+
+    window = stream.peek(length)
+    if isinstance(window, memoryview):
+        window = window.tobytes()
+    pos = find_sync(window, 1)
+    while pos != -1:
+        packet = stream.peek(pos + check_length(stream.peek(pos + 12), pos))
+        if packet_at(packet, pos) is not None:
+            return True
+        pos = find_sync(window, pos + 1)
+    return False
+
+def resync(stream):
+    """Skip over the data in the stream until the next valid packet. The
+    packet at the current position is not considered. stream needs the
+    peek() and read() methods of BufferedFile. Returns the number of bytes
+    skipped, at the end of the stream all of them."""
+    skipped = 0
+    pos = 1
+    size = RESYNC_MIN_WINDOW
+    while True:
+        window = stream.peek(size)
+        if isinstance(window, memoryview):
+            # for find()
+            window = window.tobytes()
+        at_end = len(window) < size
+
+        needed = 0
+        while pos < len(window):
+            pos = find_sync(window, pos)
+            if pos == -1:
+                break
+            needed = check_length(window, pos)
+            if pos + needed > len(window) and not at_end:
+                # Continue with the window starting at this candidate
+                break
+            if packet_at(window, pos) is not None:
+                stream.read(pos)
+                return skipped + pos
+            pos += 1
+
+        if at_end:
+            stream.read(len(window))
+            return skipped + len(window)
+
+        if pos == -1 or pos >= len(window):
+            # Keep the last byte, it can be the start of a sync
+            pos = len(window) - 1
+        stream.read(pos)
+        skipped += pos
+        pos = 0
+        size = max(min(2 * size, RESYNC_MAX_WINDOW), needed)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python2
+#
+# Encode an ETI(NI) file into EDI, as AF packets or PFT fragments
+#
+# Output file format: concatenated EDI packets, like the captures edidebug
+# and edisend read
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import sys
+import time
+import struct
+import argparse
+
+from crc import crc16
+from reedsolo import RSCodec
+from bufferedfile import BufferedFile
+
+ETI_FRAME_SIZE = 6144
+
+ETI_FSYNC = (b"\x07\x3a\xb6", b"\xf8\xc5\x49")
+
+# ERR, FSYNC, FCT, FICF and NST, FP MID and FL high bits, FL low bits
+eti_head_struct = "!B3sBBBB"
+eti_stc_struct = "!HH"
+
+af_head_struct = "!2sLHBc"
+tag_item_head_struct = "!4sL"
+pft_head_struct = "!2sH3s3sH"
+
+# RS(255, 207) as used by PFT, see ETSI TS 102 821 Clause 7.3.1
+RS_NSYM = 48
+RS_MAX_K = 207
+
+class EtiError(Exception):
+    pass
+
+def read_eti_frames(stream):
+    """Iterate over the ETI(NI) frames in the stream, in RAW format (6144
+    bytes per frame) or STREAMED format (two byte length before each
+    frame)"""
+    head = stream.peek(6)
+    if head[1:4] in ETI_FSYNC:
+        streamed = False
+    elif head[3:6] in ETI_FSYNC:
+        streamed = True
+    else:
+        raise EtiError("No ETI sync at the start of the file")
+
+    while True:
+        if streamed:
+            length = stream.read(2)
+            if len(length) < 2:
+                return
+            length = struct.unpack("<H", length)[0]
+        else:
+            length = ETI_FRAME_SIZE
+
+        frame = stream.read(length)
+        if len(frame) < length:
+            return
+        yield frame
+
+def tag_item_head(name, length):
+    """The TAG item header for a value of length bytes"""
+    return struct.pack(tag_item_head_struct, name, length * 8)
+
+class EdiEncoder:
+    """Encodes ETI(NI) frames into EDI. Every frame becomes one AF packet
+    with *ptr, deti and estN TAG items. With pft set, the AF packet gets
+    cut into fragments PFT fragments, protected by Reed-Solomon if fec is
+    set, with chunks of rs_k bytes."""
+
+    def __init__(self, pft=False, fragments=1, fec=False, rs_k=RS_MAX_K):
+        self.pft = pft or fec or fragments > 1
+        self.fragments = fragments
+        self.fec = fec
+        self.rs_k = rs_k
+        if fec:
+            self.rs_codec = RSCodec(RS_NSYM, fcr=1)
+
+        self.seq = 0
+        self.pseq = 0
+
+        # The EDI FCT counts to 5000, ETI only to 250
+        self.fcth = 0
+        self.last_fct = None
+
+        self.ptr_item = tag_item_head(b"*ptr", 8) + b"DETI" + struct.pack("!HH", 0, 0)
+
+    def encode(self, frame):
+        """Returns the list of EDI packets for the ETI frame"""
+        return self.fragment(self.af_packet(self.tag_packet(frame)))
+
+    def fragment(self, af):
+        """Returns the list of EDI packets that carry the AF packet"""
+        if not self.pft:
+            return [af]
+        packets = self.pft_fragments(af)
+        self.pseq = (self.pseq + 1) & 0xFFFF
+        return packets
+
+    def tag_packet(self, frame):
+        err, fsync, fct, ficf_nst, fp_mid_fl, fl_low = struct.unpack_from(eti_head_struct, frame)
+        if fsync not in ETI_FSYNC:
+            raise EtiError("No ETI sync")
+
+        ficf = ficf_nst >> 7
+        nst = ficf_nst & 0x7F
+        fp = fp_mid_fl >> 5
+        mid = (fp_mid_fl >> 3) & 0x03
+
+        eoh = 8 + 4 * nst
+        # edidebug writes the MNSC low byte first
+        mnsc = struct.unpack_from("<H", frame, eoh)[0]
+        header_crc = struct.unpack_from("!H", frame, eoh + 2)[0]
+        if crc16(frame[4:eoh + 2]) ^ 0xFFFF != header_crc:
+            raise EtiError("ETI header CRC error")
+
+        if ficf == 0:
+            ficl = 0
+        elif mid == 3:
+            ficl = 32
+        else:
+            ficl = 24
+
+        if self.last_fct is not None and fct < self.last_fct:
+            self.fcth = (self.fcth + 1) % 20
+        self.last_fct = fct
+
+        mst = eoh + 4
+        fic = frame[mst:mst + ficl * 4]
+
+        # deti without time stamp and RFUD
+        deti_head = struct.pack("!BBBBH",
+                (ficf << 6) | self.fcth, fct, err,
+                (mid << 6) | (fp << 3), mnsc)
+        items = [self.ptr_item,
+                 tag_item_head(b"deti", len(deti_head) + len(fic)), deti_head, fic]
+
+        pos = mst + ficl * 4
+        for n in range(nst):
+            scid_sad, tpl_stl = struct.unpack_from(eti_stc_struct, frame, 8 + 4 * n)
+            tpl = tpl_stl >> 10
+            stl = tpl_stl & 0x3FF
+            data = frame[pos:pos + stl * 8]
+            pos += stl * 8
+            items.append(struct.pack("!3sBLHB", b"est", n + 1, (3 + len(data)) * 8,
+                scid_sad, tpl << 2))
+            items.append(data)
+
+        if pos + 2 > len(frame):
+            raise EtiError("ETI frame truncated")
+
+        # The TAG packet length has to be a multiple of 8 bytes
+        length = sum(len(item) for item in items)
+        if length % 8:
+            padding = 8 - length % 8
+            items.append(tag_item_head(b"*dmy", padding))
+            items.append(b"\0" * padding)
+
+        return b"".join(bytes(item) for item in items)
+
+    def af_packet(self, payload):
+        head = struct.pack(af_head_struct, b"AF", len(payload), self.seq,
+                0x80 | 0x10, b"T") # CRC flag, major revision 1
+        self.seq = (self.seq + 1) & 0xFFFF
+        crc = crc16(payload, crc16(head)) ^ 0xFFFF
+        return head + payload + struct.pack("!H", crc)
+
+    def pft_fragments(self, af):
+        fcount = self.fragments
+        if self.fec:
+            # Cut the AF packet into chunks of rs_k bytes, the last one
+            # padded with rs_z zeros, and append 48 parity bytes to each.
+            # All chunks are encoded in one call.
+            rs_k = self.rs_k
+            num_chunks = (len(af) + rs_k - 1) // rs_k
+            rs_z = num_chunks * rs_k - len(af)
+            padded = bytearray(af) + bytearray(rs_z)
+            chunks = [padded[i * rs_k:(i + 1) * rs_k] for i in range(num_chunks)]
+            parities = self.rs_codec.parity(chunks, 255 - RS_NSYM - rs_k)
+
+            block = bytearray()
+            for chunk, parity in zip(chunks, parities):
+                block += chunk
+                block += parity
+
+            # The fragments interleave the block
+            fragment_len = (len(block) + fcount - 1) // fcount
+            block += bytearray(fragment_len * fcount - len(block))
+            fragments = [block[i::fcount] for i in range(fcount)]
+            fec_head = struct.pack("!BB", rs_k, rs_z)
+        else:
+            fragment_len = (len(af) + fcount - 1) // fcount
+            fragments = [af[i * fragment_len:(i + 1) * fragment_len] for i in range(fcount)]
+            fec_head = b""
+
+        if fragment_len > 0x3FFF:
+            raise EtiError("PFT fragments too large, use more fragments")
+
+        packets = []
+        fcount_bytes = struct.pack("!L", fcount)[1:]
+        for findex, fragment in enumerate(fragments):
+            head = struct.pack(pft_head_struct, b"PF", self.pseq,
+                    struct.pack("!L", findex)[1:], fcount_bytes,
+                    (0x8000 if self.fec else 0) | len(fragment)) + fec_head
+            packets.append(head + struct.pack("!H", crc16(head) ^ 0xFFFF) + bytes(fragment))
+        return packets
+
+
+if __name__ == "__main__":
+    program_description = """
+        Opendigitalradio ETI to EDI encoder.
+        Read an ETI(NI) file in RAW or STREAMED format, and write EDI."""
+    parser = argparse.ArgumentParser(description=program_description)
+    parser.add_argument('-f','--eti-file', help='ETI input file name, - for stdin',required=True)
+    parser.add_argument('-o','--output', help='EDI output file name, - for stdout',required=True)
+    parser.add_argument('-n','--max-frames', help='Stop after N frames',type=int)
+    parser.add_argument('-p','--pft', help='Use PFT',action="store_true")
+    parser.add_argument('-F','--fragments', help='Number of PFT fragments per AF packet, implies -p',type=int,default=1)
+    parser.add_argument('-r','--rs', help='Protect the PFT fragments with Reed-Solomon, implies -p',action="store_true")
+    parser.add_argument('--rs-k', help='Reed-Solomon chunk size, at most {}'.format(RS_MAX_K),type=int,default=RS_MAX_K)
+
+    cli_args = parser.parse_args()
+
+    if cli_args.fragments < 1:
+        parser.error("Invalid number of fragments")
+    if not 0 < cli_args.rs_k <= RS_MAX_K:
+        parser.error("Invalid Reed-Solomon chunk size")
+
+    encoder = EdiEncoder(cli_args.pft, cli_args.fragments, cli_args.rs, cli_args.rs_k)
+
+    eti_fd = BufferedFile(cli_args.eti_file)
+
+    if cli_args.output == "-":
+        edi_fd = sys.stdout
+    else:
+        edi_fd = open(cli_args.output, "wb")
+
+    start_time = time.time()
+    num_frames = 0
+    num_errors = 0
+    output = []
+    try:
+        for frame in read_eti_frames(eti_fd):
+            try:
+                output.extend(encoder.encode(frame))
+            except EtiError as e:
+                sys.stderr.write("Frame {}: {}\n".format(num_frames, e))
+                num_errors += 1
+
+            num_frames += 1
+            # Write the packets of many frames at once
+            if len(output) >= 1024:
+                edi_fd.write(b"".join(output))
+                output = []
+
+            if cli_args.max_frames and num_frames >= cli_args.max_frames:
+                break
+    except EtiError as e:
+        sys.stderr.write("{}\n".format(e))
+        sys.exit(1)
+
+    edi_fd.write(b"".join(output))
+    edi_fd.flush()
+
+    duration = time.time() - start_time
+    sys.stderr.write("Encoded {} frames, {} errors, {:.1f}x real time\n".format(
+        num_frames, num_errors, num_frames * 24e-3 / max(duration, 1e-9)))
@@ -0,0 +1,380 @@
+#!/usr/bin/env python2
+#
+# Decoder for the Fast Information Channel carried in the ETI frames
+#
+# The FIBs are checked with their CRC, and the FIGs that describe the
+# ensemble are decoded into an ensemble database:
+#
+#  FIG 0/0  ensemble identifier, change flags and alarm flag
+#  FIG 0/1  subchannel organisation
+#  FIG 0/2  services and their components
+#  FIG 1/0  ensemble label
+#  FIG 1/1  programme service label
+#  FIG 1/4  service component label
+#  FIG 1/5  data service label
+#
+# The FIC repeats the same FIGs all the time. FIBs and FIGs that have been
+# decoded before are recognised by their content and skipped, so that only
+# changes of the ensemble need to be decoded.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import json
+import struct
+
+from crc import crc16
+from edidecoder import Printer, QUIET
+
+FIB_SIZE = 32
+FIB_DATA_SIZE = 30
+
+# Short form subchannel organisation: (size in CU, protection level,
+# bitrate in kbit/s) for every table index, EN 300 401 table 8
+UEP_TABLE = [
+        (16, 5, 32), (21, 4, 32), (24, 3, 32), (29, 2, 32), (35, 1, 32),
+        (24, 5, 48), (29, 4, 48), (35, 3, 48), (42, 2, 48), (52, 1, 48),
+        (29, 5, 56), (35, 4, 56), (42, 3, 56), (52, 2, 56),
+        (32, 5, 64), (42, 4, 64), (48, 3, 64), (58, 2, 64), (70, 1, 64),
+        (40, 5, 80), (52, 4, 80), (58, 3, 80), (70, 2, 80), (84, 1, 80),
+        (48, 5, 96), (58, 4, 96), (70, 3, 96), (84, 2, 96), (104, 1, 96),
+        (58, 5, 112), (70, 4, 112), (84, 3, 112), (104, 2, 112),
+        (64, 5, 128), (84, 4, 128), (96, 3, 128), (116, 2, 128), (140, 1, 128),
+        (80, 5, 160), (104, 4, 160), (116, 3, 160), (140, 2, 160), (168, 1, 160),
+        (96, 5, 192), (116, 4, 192), (140, 3, 192), (168, 2, 192), (208, 1, 192),
+        (116, 5, 224), (140, 4, 224), (168, 3, 224), (208, 2, 224), (232, 1, 224),
+        (128, 5, 256), (168, 4, 256), (192, 3, 256), (232, 2, 256), (280, 1, 256),
+        (160, 5, 320), (208, 4, 320), (280, 2, 320),
+        (192, 5, 384), (280, 3, 384), (416, 1, 384),
+        ]
+
+# Long form subchannel organisation, number of CU per 8 kbit/s for the
+# protection levels 1-A to 4-A, and per 32 kbit/s for 1-B to 4-B
+EEP_A_CU = (12, 8, 6, 4)
+EEP_B_CU = (27, 21, 18, 15)
+
+CHARSET_UTF8 = 15
+
+# FIGs that carry a counter or the time, and never repeat. The FIBs
+# containing them are not worth remembering.
+NON_REPEATING_FIGS = ((0, 0), (0, 10))
+
+def decode_label(charset, label, flags):
+    """Returns the label and the short label selected by the character flag
+    field. Only the printable ASCII range of the EBU Latin based character
+    set is decoded, other characters are replaced."""
+    if charset == CHARSET_UTF8:
+        text = label.decode("utf-8", "replace")
+    else:
+        text = bytes(bytearray(c if 0x20 <= c < 0x7F else 0x80
+            for c in bytearray(label))).decode("ascii", "replace")
+    short = u"".join(c for i, c in enumerate(text[:16]) if flags & (0x8000 >> i))
+    return text.rstrip(), short.rstrip()
+
+class FicDecoder:
+    """Decodes the FIC of ETI frames into the ensemble database. Every
+    change of the database is printed at the summary level of printer.
+
+    cache_size limits the number of FIBs and FIGs that are remembered as
+    already decoded. The caches are emptied whenever the database
+    changes, because a FIG seen before could then undo the change."""
+
+    counter_names = ("fibs", "fib_crc_errors", "fibs_repeated",
+            "figs", "figs_repeated", "invalid_figs", "unknown_figs",
+            "updates", "subchannel_mismatches")
+
+    def __init__(self, printer=None, cache_size=1024):
+        self.p = printer if printer is not None else Printer(level=QUIET)
+        self.cache_size = cache_size
+        for name in self.counter_names:
+            setattr(self, name, 0)
+
+        self.ensemble = {'subchannels': {}, 'services': {}}
+        self.cif_count = None
+        self.fib_cache = set()
+        self.fig_cache = set()
+
+        # (FIG type, extension): handler returning True if the FIG changed
+        # the database
+        self.fig_handlers = {
+                (0, 0): self.decode_fig0_0,
+                (0, 1): self.decode_fig0_1,
+                (0, 2): self.decode_fig0_2,
+                (1, 0): self.decode_fig1_0,
+                (1, 1): self.decode_fig1_1,
+                (1, 4): self.decode_fig1_4,
+                (1, 5): self.decode_fig1_5,
+                }
+
+    def decode_frame(self, eti_data):
+        """Decode the FIC of the frame, and compare its subchannels to the
+        subchannel organisation"""
+        self.decode(eti_data.fic)
+        self.check_subchannels(eti_data.stc)
+
+    def decode(self, fic):
+        """Decode the FIBs of one frame"""
+        if isinstance(fic, memoryview):
+            fic = fic.tobytes()
+        for pos in range(0, len(fic) - FIB_SIZE + 1, FIB_SIZE):
+            fib = fic[pos:pos+FIB_SIZE]
+            self.fibs += 1
+            if fib in self.fib_cache:
+                self.fibs_repeated += 1
+                continue
+
+            crc = struct.unpack_from("!H", fib, FIB_DATA_SIZE)[0]
+            if crc16(fib[:FIB_DATA_SIZE]) ^ 0xFFFF != crc:
+                self.fib_crc_errors += 1
+                self.p.pr("FIB CRC error")
+                continue
+
+            if self.decode_fib(fib):
+                if len(self.fib_cache) >= self.cache_size:
+                    self.fib_cache.clear()
+                self.fib_cache.add(fib)
+
+    def decode_fib(self, fib):
+        """Decode the FIGs of a FIB with correct CRC. Returns True if the
+        FIB can be skipped when it is repeated"""
+        repeatable = True
+        header = bytearray(fib[:FIB_DATA_SIZE])
+        pos = 0
+        while pos < FIB_DATA_SIZE and header[pos] != 0xFF:
+            fig_type = header[pos] >> 5
+            end = pos + 1 + (header[pos] & 0x1F)
+            if end == pos + 1 or end > FIB_DATA_SIZE:
+                self.invalid_figs += 1
+                return False
+
+            fig = fib[pos:end]
+            pos = end
+            self.figs += 1
+            if fig in self.fig_cache:
+                self.figs_repeated += 1
+                continue
+
+            data = bytearray(fig[1:])
+            if fig_type == 0:
+                extension = data[0] & 0x1F
+            elif fig_type == 1:
+                extension = data[0] & 0x07
+            else:
+                extension = None
+
+            handler = self.fig_handlers.get((fig_type, extension))
+            if handler is None:
+                self.unknown_figs += 1
+                changed = False
+            else:
+                try:
+                    changed = handler(data)
+                except IndexError:
+                    self.invalid_figs += 1
+                    self.p.pr("Truncated FIG {}/{}", fig_type, extension)
+                    repeatable = False
+                    continue
+
+            if changed:
+                self.fib_cache.clear()
+                self.fig_cache.clear()
+            if (fig_type, extension) in NON_REPEATING_FIGS:
+                repeatable = False
+            else:
+                if len(self.fig_cache) >= self.cache_size:
+                    self.fig_cache.clear()
+                self.fig_cache.add(fig)
+        return repeatable
+
+    def update(self, record, key, value, what):
+        """Set record[key] to value, returns True if that is a change"""
+        if key in record and record[key] == value:
+            return False
+        record[key] = value
+        self.updates += 1
+        self.p.summary("Ensemble update: {} = {}", what, json.dumps(value, sort_keys=True))
+        return True
+
+    def service(self, sid):
+        return self.ensemble['services'].setdefault(sid, {})
+
+    def decode_fig0_0(self, data):
+        eid = (data[1] << 8) | data[2]
+        self.cif_count = (data[3] & 0x1F) * 250 + data[4]
+        changed = self.update(self.ensemble, 'eid', eid, "ensemble id")
+        changed |= self.update(self.ensemble, 'change_flags', data[3] >> 6, "change flags")
+        changed |= self.update(self.ensemble, 'al_flag', bool(data[3] & 0x20), "alarm flag")
+        return changed
+
+    def decode_fig0_1(self, data):
+        # Only the current configuration of this ensemble
+        if data[0] & 0xC0:
+            return False
+
+        changed = False
+        pos = 1
+        while pos < len(data):
+            subchid = data[pos] >> 2
+            start_address = ((data[pos] & 0x03) << 8) | data[pos+1]
+            if data[pos+2] & 0x80:
+                option = (data[pos+2] >> 4) & 0x07
+                level = (data[pos+2] >> 2) & 0x03
+                size = ((data[pos+2] & 0x03) << 8) | data[pos+3]
+                pos += 4
+                if option == 0:
+                    protection = "EEP {}-A".format(level + 1)
+                    bitrate = size * 8 // EEP_A_CU[level]
+                elif option == 1:
+                    protection = "EEP {}-B".format(level + 1)
+                    bitrate = size * 32 // EEP_B_CU[level]
+                else:
+                    protection = "EEP option {}".format(option)
+                    bitrate = None
+            else:
+                size, level, bitrate = UEP_TABLE[data[pos+2] & 0x3F]
+                protection = "UEP {}".format(level)
+                pos += 3
+
+            subchannel = {'start_address': start_address, 'size': size,
+                    'protection': protection, 'bitrate': bitrate}
+            changed |= self.update(self.ensemble['subchannels'], subchid, subchannel,
+                    "subchannel {}".format(subchid))
+        return changed
+
+    def decode_fig0_2(self, data):
+        if data[0] & 0xC0:
+            return False
+
+        sid_len = 4 if data[0] & 0x20 else 2
+        changed = False
+        pos = 1
+        while pos < len(data):
+            sid = 0
+            for b in data[pos:pos+sid_len]:
+                sid = (sid << 8) | b
+            pos += sid_len
+            ca_id = (data[pos] >> 4) & 0x07
+            num_components = data[pos] & 0x0F
+            pos += 1
+
+            components = []
+            for i in range(num_components):
+                tmid = data[pos] >> 6
+                component = {'tmid': tmid,
+                        'primary': bool(data[pos+1] & 0x02),
+                        'ca': bool(data[pos+1] & 0x01)}
+                if tmid == 3:
+                    component['scid'] = ((data[pos] & 0x3F) << 6) | (data[pos+1] >> 2)
+                else:
+                    component['ascty' if tmid == 0 else 'dscty'] = data[pos] & 0x3F
+                    component['subchid'] = data[pos+1] >> 2
+                components.append(component)
+                pos += 2
+
+            service = self.service(sid)
+            what = "service 0x{:04x}".format(sid)
+            changed |= self.update(service, 'ca_id', ca_id, what + " CAId")
+            changed |= self.update(service, 'components', components, what + " components")
+        return changed
+
+    def decode_label_field(self, data, pos, record, what):
+        """Decode the label and character flag field at pos into record"""
+        if len(data) < pos + 18:
+            raise IndexError("Truncated label")
+        label, short = decode_label(data[0] >> 4, bytes(data[pos:pos+16]),
+                (data[pos+16] << 8) | data[pos+17])
+        changed = self.update(record, 'label', label, what + " label")
+        changed |= self.update(record, 'short_label', short, what + " short label")
+        return changed
+
+    def decode_fig1_0(self, data):
+        if data[0] & 0x08:
+            return False
+        return self.decode_label_field(data, 3, self.ensemble, "ensemble")
+
+    def decode_fig1_1(self, data):
+        if data[0] & 0x08:
+            return False
+        sid = (data[1] << 8) | data[2]
+        return self.decode_label_field(data, 3, self.service(sid), "service 0x{:04x}".format(sid))
+
+    def decode_fig1_4(self, data):
+        if data[0] & 0x08:
+            return False
+        scids = data[1] & 0x0F
+        sid_len = 4 if data[1] & 0x80 else 2
+        sid = 0
+        for b in data[2:2+sid_len]:
+            sid = (sid << 8) | b
+        labels = self.service(sid).setdefault('component_labels', {})
+        return self.decode_label_field(data, 2 + sid_len, labels.setdefault(scids, {}),
+                "service 0x{:04x} component {}".format(sid, scids))
+
+    def decode_fig1_5(self, data):
+        if data[0] & 0x08:
+            return False
+        sid = (data[1] << 24) | (data[2] << 16) | (data[3] << 8) | data[4]
+        return self.decode_label_field(data, 5, self.service(sid), "service 0x{:08x}".format(sid))
+
+    def check_subchannels(self, stc):
+        """Count the ETI subchannels whose start address or size differs
+        from the subchannel organisation in the FIC"""
+        for subch in stc:
+            subchannel = self.ensemble['subchannels'].get(subch['SCID'])
+            if subchannel is None:
+                continue
+            # STL is in 64-bit words per 24ms frame
+            if (subchannel['start_address'] != subch['SAD'] or
+                    subchannel['bitrate'] is not None and
+                    subch['STL'] * 8 != subchannel['bitrate'] * 3):
+                self.subchannel_mismatches += 1
+                self.p.pr("Subchannel {} differs from FIG 0/1", subch['SCID'])
+
+    def database(self):
+        """The ensemble database, with the SIds as hexadecimal strings"""
+        services = {}
+        for sid, service in self.ensemble['services'].items():
+            services["0x{:04x}".format(sid)] = service
+        d = dict(self.ensemble)
+        d['services'] = services
+        return d
+
+    def summary(self):
+        """The counters and the ensemble database"""
+        d = dict((name, getattr(self, name)) for name in self.counter_names)
+        d['ensemble'] = self.database()
+        return d
+
+    def print_ensemble(self):
+        """Print the ensemble database at summary level"""
+        ensemble = self.ensemble
+        if 'eid' in ensemble:
+            self.p.summary("Ensemble 0x{:04x} {}", ensemble['eid'],
+                    json.dumps(ensemble.get('label')))
+        for subchid, subchannel in sorted(ensemble['subchannels'].items()):
+            self.p.summary("  Subchannel {:2d}: start {:3d}, {:3d} CU, {}, {} kbit/s",
+                    subchid, subchannel['start_address'], subchannel['size'],
+                    subchannel['protection'], subchannel['bitrate'])
+        for sid, service in sorted(ensemble['services'].items()):
+            self.p.summary("  Service 0x{:04x} {}: subchannels {}", sid,
+                    json.dumps(service.get('label')),
+                    [c['subchid'] for c in service.get('components', []) if 'subchid' in c])
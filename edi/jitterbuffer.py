@@ -0,0 +1,264 @@
+#!/usr/bin/env python2
+#
+# Reordering buffer for EDI packets received over an unreliable network
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import struct
+import collections
+
+from crc import crc16
+
+# One AF packet carries one 24ms ETI frame
+FRAME_DURATION = 0.024
+
+# Packets further behind than this mean that the sender was restarted
+RESYNC_DISTANCE = 250
+
+# For the adaptive latency, the longest wait is forgotten by this factor
+# for every received packet
+WAIT_DECAY = 0.999
+
+pft_head_struct = "!2sH3B3BH"
+
+def seq_distance(a, b):
+    """How many packets b is after a, for 16-bit sequence numbers"""
+    return (b - a) & 0xFFFF
+
+def packet_key(packet):
+    """Returns (sequence number, findex, fcount) of a PF packet, the AF
+    sequence number, findex 0 and fcount 1 of an AF packet, or None if the
+    packet cannot be used"""
+    sync = packet[:2]
+    if sync == b"PF":
+        if len(packet) < 14:
+            return None
+        (psync, pseq, findex1, findex2, findex3,
+                fcount1, fcount2, fcount3, fec_ad_plen) = struct.unpack_from(
+                        pft_head_struct, packet)
+        header_len = 12
+        if fec_ad_plen & 0x8000:
+            header_len += 2
+        if fec_ad_plen & 0x4000:
+            header_len += 4
+        if len(packet) < header_len + 2:
+            return None
+        crc = struct.unpack_from("!H", packet, header_len)[0]
+        if crc16(packet[:header_len]) ^ 0xFFFF != crc:
+            return None
+        findex = (findex1 << 16) | (findex2 << 8) | findex3
+        fcount = (fcount1 << 16) | (fcount2 << 8) | fcount3
+        if findex >= fcount:
+            return None
+        return pseq, findex, fcount
+    elif sync == b"AF":
+        if len(packet) < 10:
+            return None
+        seq = struct.unpack_from("!H", packet, 6)[0]
+        return seq, 0, 1
+    return None
+
+class JitterEstimator:
+    """Inter-arrival jitter like in RFC 3550, from the arrival times of
+    the groups of packets with sequence number key, against the nominal
+    24ms per group. Only the first packet of a group counts, and groups
+    that arrive after a later one are ignored."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # key and arrival time of the previous group
+        self.last_key = None
+        self.last_arrival = None
+        self.jitter = 0.0
+
+    def update(self, key, now):
+        if self.last_key is not None:
+            distance = seq_distance(self.last_key, key)
+            if distance == 0 or distance >= 0x8000:
+                return
+            d = (now - self.last_arrival) - distance * FRAME_DURATION
+            self.jitter += (abs(d) - self.jitter) / 16.0
+
+        self.last_key = key
+        self.last_arrival = now
+
+class PacketGroup:
+    """The fragments of one AF packet, or the AF packet itself"""
+    def __init__(self, fcount, arrival):
+        self.fcount = fcount
+        self.arrival = arrival
+        self.packets = {}
+
+    def complete(self):
+        return len(self.packets) >= self.fcount
+
+    def in_order(self):
+        return [self.packets[findex] for findex in sorted(self.packets)]
+
+class JitterBuffer:
+    """Holds received EDI packets for up to latency seconds, and releases
+    them ordered by PFT pseq, or by AF seq when PFT is not used.
+
+    A group of fragments is released as soon as it is complete and all
+    groups before it have been released, or when it has waited for latency
+    seconds. Missing groups are skipped when the group after them expires.
+    Fragments of groups that were already released are late, and dropped.
+
+    The inter-arrival jitter is measured like in RFC 3550. With adaptive
+    set, the latency follows the longest time recent packets had to be
+    held to be in order, within min_latency and the configured latency.
+    Every late packet increases it."""
+
+    def __init__(self, latency, adaptive=False, min_latency=0.005):
+        self.max_latency = latency
+        self.min_latency = min(min_latency, latency)
+        self.latency = latency
+        self.adaptive = adaptive
+
+        # key: PacketGroup
+        self.groups = {}
+        # key of the next group to release
+        self.next_key = None
+        # key: findex of the packets released, for the last RESYNC_DISTANCE
+        # groups, to tell duplicates from late packets
+        self.released = collections.OrderedDict()
+
+        self.jitter = JitterEstimator()
+        # Start with the configured latency
+        self.peak_wait = latency / 1.5
+
+        self.num_released = 0
+        self.num_incomplete = 0
+        self.num_late = 0
+        self.num_duplicate = 0
+        self.num_invalid = 0
+        self.num_lost = 0
+        self.num_resync = 0
+
+    def push(self, packet, now):
+        """Store a copy of the received packet"""
+        key = packet_key(packet)
+        if key is None:
+            self.num_invalid += 1
+            return
+
+        key, findex, fcount = key
+
+        if self.next_key is None:
+            self.next_key = key
+        elif seq_distance(self.next_key, key) >= 0x8000:
+            if seq_distance(key, self.next_key) > RESYNC_DISTANCE:
+                # The packets still in the buffer belong to the old sequence
+                self.num_resync += 1
+                self.groups.clear()
+                self.released.clear()
+                self.jitter.reset()
+                self.next_key = key
+            elif self.num_released == 0:
+                # Nothing released yet, start with the earlier packet
+                self.next_key = key
+            elif findex in self.released.get(key, ()):
+                self.num_duplicate += 1
+                return
+            else:
+                self.num_late += 1
+                self.peak_wait = max(self.peak_wait, self.latency)
+                self.update_latency()
+                return
+
+        group = self.groups.get(key)
+        if group is None:
+            group = PacketGroup(fcount, now)
+            self.groups[key] = group
+            self.jitter.update(key, now)
+        elif findex in group.packets:
+            self.num_duplicate += 1
+            return
+
+        group.packets[findex] = bytearray(packet)
+
+        # The buffer had to hold all groups from this one on since the
+        # first of them arrived
+        first_arrival = min(g.arrival for k, g in self.groups.items()
+                if seq_distance(key, k) < 0x8000)
+        self.peak_wait = max(now - first_arrival, self.peak_wait * WAIT_DECAY)
+        self.update_latency()
+
+    def update_latency(self):
+        if self.adaptive:
+            # With some margin over the longest observed wait
+            self.latency = min(self.max_latency,
+                    max(self.min_latency, 1.5 * self.peak_wait))
+
+    def pop(self, now):
+        """Returns the list of packets that are ready, in order"""
+        released = []
+        while self.groups:
+            group = self.groups.get(self.next_key)
+            if group is None:
+                # Wait for the missing group until the first one after it
+                # expires
+                key = min(self.groups,
+                        key=lambda k: seq_distance(self.next_key, k))
+                if now - self.groups[key].arrival < self.latency:
+                    break
+                self.num_lost += seq_distance(self.next_key, key)
+                self.next_key = key
+                continue
+
+            # The first group waits in any case, an earlier one might
+            # still arrive
+            if not group.complete() or self.num_released == 0:
+                if now - group.arrival < self.latency:
+                    break
+            if not group.complete():
+                self.num_incomplete += 1
+
+            del self.groups[self.next_key]
+            released.extend(group.in_order())
+            self.released[self.next_key] = set(group.packets)
+            if len(self.released) > RESYNC_DISTANCE:
+                self.released.popitem(last=False)
+            self.num_released += 1
+            self.next_key = (self.next_key + 1) & 0xFFFF
+
+        return released
+
+    def timeout(self, now):
+        """Seconds until the next group expires, or None if empty"""
+        if not self.groups:
+            return None
+        first_arrival = min(g.arrival for g in self.groups.values())
+        return max(0.0, first_arrival + self.latency - now)
+
+    def stats(self):
+        return {'released': self.num_released,
+                'incomplete': self.num_incomplete,
+                'late': self.num_late,
+                'duplicate': self.num_duplicate,
+                'invalid': self.num_invalid,
+                'lost': self.num_lost,
+                'resync': self.num_resync,
+                'jitter_ms': round(self.jitter.jitter * 1000, 2),
+                'latency_ms': round(self.latency * 1000, 2)}
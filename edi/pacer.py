@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+#
+# Real-time pacing for EDI transmission, with absolute deadlines
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import math
+import time
+
+# One AF packet carries one 24ms ETI frame
+FRAME_INTERVAL = 24e-3
+
+# The last part of the wait is done by polling the clock, because sleep()
+# can return too late by this much
+SPIN_MARGIN = 0.5e-3
+
+# Frames sent later than this after their deadline are counted as late
+LATE_THRESHOLD = 1e-3
+
+# When the sender is behind by more than this, it does not try to catch
+# up, but restarts the schedule
+RESYNC_THRESHOLD = 1.0
+
+def _monotonic_clock():
+    """time.monotonic, or clock_gettime(CLOCK_MONOTONIC) through ctypes on
+    python 2, or time.time as last resort"""
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1")
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+
+        def monotonic():
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError):
+        return time.time
+
+monotonic = _monotonic_clock()
+
+class Pacer:
+    """Waits for absolute deadlines spaced by interval: the n-th call to
+    wait() returns at start + n * interval, so that errors in the sleep do
+    not accumulate. Records how late each deadline was met."""
+
+    def __init__(self, interval=FRAME_INTERVAL):
+        self.interval = interval
+        self.next_deadline = None
+
+        self.num_frames = 0
+        self.num_late = 0
+        self.num_resync = 0
+        self.sum_error = 0.0
+        self.sum_error2 = 0.0
+        self.max_error = 0.0
+
+    def wait(self):
+        now = monotonic()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        elif now - self.next_deadline > RESYNC_THRESHOLD:
+            self.num_resync += 1
+            self.next_deadline = now
+
+        deadline = self.next_deadline
+        if deadline - now > SPIN_MARGIN:
+            time.sleep(deadline - now - SPIN_MARGIN)
+        while now < deadline:
+            now = monotonic()
+
+        error = now - deadline
+        self.num_frames += 1
+        self.sum_error += error
+        self.sum_error2 += error * error
+        self.max_error = max(self.max_error, error)
+        if error > LATE_THRESHOLD:
+            self.num_late += 1
+
+        self.next_deadline += self.interval
+
+    def stats(self):
+        """Deadline errors in ms"""
+        n = max(self.num_frames, 1)
+        mean = self.sum_error / n
+        jitter = math.sqrt(max(0.0, self.sum_error2 / n - mean * mean))
+        return {'frames': self.num_frames,
+                'late': self.num_late,
+                'resync': self.num_resync,
+                'mean_ms': round(mean * 1000, 3),
+                'jitter_ms': round(jitter * 1000, 3),
+                'max_ms': round(self.max_error * 1000, 3)}
@@ -60,6 +60,13 @@ except NameError:
             obj = [0] * obj
         return array("B", obj)
 
+import binascii
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class ReedSolomonError(Exception):
     pass
@@ -90,6 +97,14 @@ def gf_div(x, y):
         return 0
     return gf_exp[gf_log[x] + 255 - gf_log[y]]
 
+def gf_pow(x, power):
+    if x == 0:
+        return 0
+    return gf_exp[(gf_log[x] * power) % 255]
+
+# gf_mul_table[x][y] == gf_mul(x, y)
+gf_mul_table = [bytearray(gf_mul(x, y) for y in range(256)) for x in range(256)]
+
 def gf_poly_scale(p, x):
     return [gf_mul(p[i], x) for i in range(0, len(p))]
 
@@ -109,9 +124,10 @@ def gf_poly_mul(p, q):
     return r
 
 def gf_poly_eval(p, x):
+    mul_x = gf_mul_table[x]
     y = p[0]
     for i in range(1, len(p)):
-        y = gf_mul(y, x) ^ p[i]
+        y = mul_x[y] ^ p[i]
     return y
 
 def rs_generator_poly(nsym, fcr=0):
@@ -134,10 +150,10 @@ def rs_encode_msg(msg_in, nsym, fcr=0):
     msg_out[:len(msg_in)] = msg_in
     return msg_out
 
-def rs_calc_syndromes(msg, nsym):
-    return [gf_poly_eval(msg, gf_exp[i]) for i in range(nsym)]
+def rs_calc_syndromes(msg, nsym, fcr=0):
+    return [gf_poly_eval(msg, gf_exp[i + fcr]) for i in range(nsym)]
 
-def rs_correct_errata(msg, synd, pos):
+def rs_correct_errata(msg, synd, pos, fcr=0):
     # calculate error locator polynomial
     q = [1]
     for i in range(0, len(pos)):
@@ -155,7 +171,7 @@ def rs_correct_errata(msg, synd, pos):
         x = gf_exp[pos[i] + 256 - len(msg)]
         y = gf_poly_eval(p, x)
         z = gf_poly_eval(q, gf_mul(x, x))
-        msg[pos[i]] ^= gf_div(y, gf_mul(x, z))
+        msg[pos[i]] ^= gf_div(y, gf_mul(gf_pow(x, 1 - fcr), z))
 
 def rs_find_errors(synd, nmess):
     # find error locator polynomial with Berlekamp-Massey algorithm
@@ -193,32 +209,240 @@ def rs_forney_syndromes(synd, pos, nmess):
         fsynd.pop()
     return fsynd
 
-def rs_correct_msg(msg_in, nsym):
+def rs_correct_msg(msg_in, nsym, fcr=0, erase_pos=None, synd=None):
+    """
+    Correct a codeword. Erasures are given as negative values in ``msg_in`` or as a
+    list of positions in ``erase_pos``. ``synd`` may contain already calculated
+    syndromes of ``msg_in``.
+    """
     if len(msg_in) > 255:
         raise ValueError("message too long")
     msg_out = list(msg_in)     # copy of message
     # find erasures
-    erase_pos = []
+    erase_pos = list(erase_pos) if erase_pos else []
     for i in range(0, len(msg_out)):
         if msg_out[i] < 0:
             msg_out[i] = 0
             erase_pos.append(i)
+            synd = None
     if len(erase_pos) > nsym:
         raise ReedSolomonError("Too many erasures to correct")
-    synd = rs_calc_syndromes(msg_out, nsym)
+    if synd is None:
+        synd = rs_calc_syndromes(msg_out, nsym, fcr)
     if max(synd) == 0:
         return msg_out[:-nsym]  # no errors
     fsynd = rs_forney_syndromes(synd, erase_pos, len(msg_out))
     err_pos = rs_find_errors(fsynd, len(msg_out))
     if err_pos is None:
         raise ReedSolomonError("Could not locate error")
-    rs_correct_errata(msg_out, synd, erase_pos + err_pos)
-    synd = rs_calc_syndromes(msg_out, nsym)
+    rs_correct_errata(msg_out, synd, erase_pos + err_pos, fcr)
+    synd = rs_calc_syndromes(msg_out, nsym, fcr)
     if max(synd) > 0:
         raise ReedSolomonError("Could not correct message")
     return msg_out[:-nsym]
 
 
+#===================================================================================================
+# Encoder backends
+#===================================================================================================
+class GFPythonBackend(object):
+    """
+    Reference encoder, calculates the parity with ``rs_encode_msg``.
+
+    All backends calculate the ``nsym`` parity bytes of messages that get
+    ``zero_pad`` zero bytes appended before encoding, and return them as
+    ``bytearray``.
+    """
+    name = "python"
+
+    def __init__(self, nsym, fcr):
+        self.nsym = nsym
+        self.fcr = fcr
+
+    def parity(self, msg, zero_pad=0):
+        msg = bytearray(msg) + bytearray(zero_pad)
+        return rs_encode_msg(msg, self.nsym, self.fcr)[len(msg):]
+
+    def parity_many(self, msgs, zero_pad=0):
+        return [self.parity(msg, zero_pad) for msg in msgs]
+
+    def syndromes_many(self, codewords):
+        """
+        Calculate the ``nsym`` syndromes of each codeword, as list of lists.
+        """
+        return [rs_calc_syndromes(bytearray(cw), self.nsym, self.fcr) for cw in codewords]
+
+class GFTableBackend(GFPythonBackend):
+    """
+    Encodes with a LFSR: the parity register is kept in one integer of ``nsym`` bytes,
+    and the generator polynomial multiplied by every possible feedback byte is
+    taken from a precomputed table.
+    """
+    name = "table"
+
+    def __init__(self, nsym, fcr):
+        GFPythonBackend.__init__(self, nsym, fcr)
+        gen = rs_generator_poly(nsym, fcr)
+        self.feedback = [_bytes_to_int(bytearray(gf_mul_table[fb][g] for g in gen[1:]))
+                         for fb in range(256)]
+        self.shift = 8 * (nsym - 1)
+        self.mask = (1 << (8 * nsym)) - 1
+
+    def parity(self, msg, zero_pad=0):
+        if len(msg) + zero_pad + self.nsym > 255:
+            raise ValueError("message too long")
+        feedback, shift, mask = self.feedback, self.shift, self.mask
+        reg = 0
+        for b in bytearray(msg):
+            reg = ((reg << 8) & mask) ^ feedback[(reg >> shift) ^ b]
+        for i in range(zero_pad):
+            reg = ((reg << 8) & mask) ^ feedback[reg >> shift]
+        return _int_to_bytes(reg, self.nsym)
+
+    def syndromes_many(self, codewords):
+        # A codeword is valid if it is a multiple of the generator, which the
+        # LFSR checks much faster than evaluating the syndromes
+        feedback, shift, mask = self.feedback, self.shift, self.mask
+        zeros = [0] * self.nsym
+        synds = []
+        for cw in codewords:
+            cw = bytearray(cw)
+            reg = 0
+            for b in cw:
+                reg = ((reg << 8) & mask) ^ feedback[(reg >> shift) ^ b]
+            if reg == 0:
+                synds.append(zeros)
+            else:
+                synds.append(rs_calc_syndromes(cw, self.nsym, self.fcr))
+        return synds
+
+class GFNumpyBackend(GFTableBackend):
+    """
+    Encodes many messages of the same length in one vectorised operation.
+
+    The code is linear, so the parity of a message is the sum of the parities of
+    each of its bytes at their position. These are precomputed per message length,
+    and packed into 64-bit words, so that encoding becomes a table lookup and an
+    xor reduction.
+    """
+    name = "numpy"
+
+    def __init__(self, nsym, fcr):
+        GFTableBackend.__init__(self, nsym, fcr)
+        self.parity_tables = {}
+        self.syndrome_tables = {}
+        self.mul = numpy.array([numpy.frombuffer(bytes(row), dtype=numpy.uint8)
+                                for row in gf_mul_table])
+
+    def _linear_table(self, impulses):
+        """
+        Build the table for a linear map over GF(256), given the result for a unit
+        impulse at every position: ``table[j, b] = b * impulses[j]``, padded to full
+        64-bit words.
+        """
+        length, width = impulses.shape
+        words = (width + 7) // 8
+        table = numpy.zeros((length, 256, words * 8), dtype=numpy.uint8)
+        table[:, :, :width] = self.mul[:, impulses].transpose(1, 0, 2)
+        return table.view(numpy.uint64)
+
+    def _apply(self, table, data):
+        """
+        Apply the linear map to each row of data, returns an array of ``nsym``
+        bytes per row.
+        """
+        contributions = table[numpy.arange(data.shape[1]), data]
+        result = numpy.bitwise_xor.reduce(contributions, axis=1)
+        return result.view(numpy.uint8)[:, :self.nsym]
+
+    def _parity_table(self, length):
+        if length not in self.parity_tables:
+            # parity of a unit impulse at every position of the message
+            impulses = numpy.zeros((length, self.nsym), dtype=numpy.uint8)
+            for j in range(length):
+                msg = bytearray(length)
+                msg[j] = 1
+                impulses[j] = numpy.frombuffer(bytes(GFTableBackend.parity(self, msg)),
+                                               dtype=numpy.uint8)
+            self.parity_tables[length] = self._linear_table(impulses)
+        return self.parity_tables[length]
+
+    def _syndrome_table(self, length):
+        if length not in self.syndrome_tables:
+            # syndrome i of an impulse at position j is alpha^((i + fcr) * degree)
+            degrees = numpy.arange(length - 1, -1, -1).reshape(length, 1)
+            powers = numpy.arange(self.fcr, self.fcr + self.nsym).reshape(1, self.nsym)
+            gf_exp_arr = numpy.array(gf_exp[:255], dtype=numpy.uint8)
+            impulses = gf_exp_arr[(degrees * powers) % 255]
+            self.syndrome_tables[length] = self._linear_table(impulses)
+        return self.syndrome_tables[length]
+
+    def parity_many(self, msgs, zero_pad=0):
+        if not len(msgs):
+            return []
+        data = _as_matrix(msgs)
+        if data is None:
+            return GFTableBackend.parity_many(self, msgs, zero_pad)
+        if data.shape[1] + zero_pad + self.nsym > 255:
+            raise ValueError("message too long")
+
+        # The zero padding does not contribute to the parity
+        table = self._parity_table(data.shape[1] + zero_pad)
+        parity = self._apply(table, data).tobytes()
+        nsym = self.nsym
+        return [bytearray(parity[i*nsym:(i+1)*nsym]) for i in range(len(msgs))]
+
+    def syndromes_many(self, codewords):
+        if not len(codewords):
+            return []
+        data = _as_matrix(codewords)
+        if data is None:
+            return GFTableBackend.syndromes_many(self, codewords)
+        table = self._syndrome_table(data.shape[1])
+        return self._apply(table, data).tolist()
+
+def _as_matrix(rows):
+    """
+    Pack equal-length buffers into a 2D uint8 array, returns None if the lengths differ.
+    """
+    if isinstance(rows, numpy.ndarray):
+        return rows.astype(numpy.uint8, copy=False)
+    length = len(rows[0])
+    if any(len(row) != length for row in rows):
+        return None
+    joined = bytearray()
+    for row in rows:
+        joined += row
+    return numpy.frombuffer(joined, dtype=numpy.uint8).reshape(len(rows), length)
+
+def _bytes_to_int(b):
+    if not b:
+        return 0
+    return int(binascii.hexlify(bytes(b)), 16)
+
+def _int_to_bytes(x, length):
+    if not length:
+        return bytearray()
+    return bytearray(binascii.unhexlify("%0*x" % (2 * length, x)))
+
+gf_backends = {
+        GFPythonBackend.name: GFPythonBackend,
+        GFTableBackend.name: GFTableBackend,
+        GFNumpyBackend.name: GFNumpyBackend,
+        }
+
+def gf_backend(name, nsym, fcr=0):
+    """
+    Build the encoder backend ``name``, or the fastest available one if ``name``
+    is None.
+    """
+    if name is None:
+        name = GFNumpyBackend.name if numpy is not None else GFTableBackend.name
+    if name == GFNumpyBackend.name and numpy is None:
+        raise ValueError("The numpy backend needs numpy")
+    return gf_backends[name](nsym, fcr)
+
+
 #===================================================================================================
 # API
 #===================================================================================================
@@ -229,10 +453,14 @@ class RSCodec(object):
     ``decode`` to extract the original message (if the number of errors allows for correct decoding).
     The ``nsym`` argument is the length of the correction code, and it determines the number of 
     error bytes (if I understand this correctly, half of ``nsym`` is correctable)
+
+    The ``backend`` argument selects the GF(256) encoder implementation, see ``gf_backends``.
+    All backends give identical results.
     """
-    def __init__(self, nsym=10, fcr=0):
+    def __init__(self, nsym=10, fcr=0, backend=None):
         self.nsym = nsym
         self.fcr = fcr
+        self.backend = gf_backend(backend, nsym, fcr)
 
     def encode(self, data):
         if isinstance(data, str):
@@ -241,8 +469,18 @@ class RSCodec(object):
         enc = bytearray()
         for i in range(0, len(data), chunk_size):
             chunk = data[i:i+chunk_size]
-            enc.extend(rs_encode_msg(chunk, self.nsym, self.fcr))
+            enc.extend(chunk)
+            enc.extend(self.backend.parity(chunk))
         return enc
+
+    def parity(self, chunks, zero_pad=0):
+        """
+        Calculate the parity bytes of each chunk in ``chunks``, as if
+        ``zero_pad`` zero bytes were appended to them. Returns a list of
+        ``bytearray``. With the numpy backend, all chunks of equal length are
+        encoded in one vectorised operation.
+        """
+        return self.backend.parity_many(chunks, zero_pad)
     
     def decode(self, data):
         if isinstance(data, str):
@@ -250,7 +488,30 @@ class RSCodec(object):
         dec = bytearray()
         for i in range(0, len(data), 255):
             chunk = data[i:i+255]
-            dec.extend(rs_correct_msg(chunk, self.nsym))
+            dec.extend(rs_correct_msg(chunk, self.nsym, self.fcr))
+        return dec
+
+    def decode_many(self, codewords, erase_pos=None):
+        """
+        Decode many codewords of up to 255 bytes each, given as a list of buffers
+        or as a 2D numpy array. The syndromes of all codewords are calculated at once
+        by the backend, and only the codewords with errors go through the
+        Berlekamp-Massey and Forney steps.
+
+        ``erase_pos`` is an optional list that gives the erasure positions for each
+        codeword. Returns a list of ``bytearray`` messages, without the parity.
+        Raises ``ReedSolomonError`` if a codeword cannot be corrected.
+        """
+        synds = self.backend.syndromes_many(codewords)
+        dec = []
+        for i, synd in enumerate(synds):
+            codeword = bytearray(codewords[i])
+            if max(synd) == 0:
+                dec.append(codeword[:-self.nsym])
+            else:
+                erasures = erase_pos[i] if erase_pos else None
+                dec.append(bytearray(rs_correct_msg(codeword, self.nsym, self.fcr,
+                                                    erasures, synd)))
         return dec
 
 
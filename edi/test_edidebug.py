@@ -0,0 +1,80 @@
+#!/usr/bin/env python2
+#
+# Tests of the edidebug conversion, run with
+#   python2 -m unittest discover
+# from the edi directory
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+import edigen
+from edidecoder import ETI_FRAME_SIZE
+
+EDIDEBUG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "edidebug.py")
+
+class ParallelConversionTest(unittest.TestCase):
+    """edidebug -j N has to write the same ETI as -j 1"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="edidebug-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def convert(self, edi_filename, jobs):
+        eti_filename = os.path.join(self.tmpdir, "j{}.eti".format(jobs))
+        subprocess.check_call([sys.executable, EDIDEBUG, "-f", edi_filename,
+            "-o", eti_filename, "-j", str(jobs), "-v", "0"])
+        with open(eti_filename, "rb") as fd:
+            return fd.read()
+
+    def check_parallel(self, num_frames, **options):
+        edi_filename = os.path.join(self.tmpdir, "capture.edi")
+        with open(edi_filename, "wb") as fd:
+            fd.write(b"".join(edigen.generate(num_frames, **options)[1]))
+
+        reference = self.convert(edi_filename, 1)
+        if not options.get('loss'):
+            self.assertEqual(len(reference), num_frames * ETI_FRAME_SIZE)
+        self.assertEqual(self.convert(edi_filename, 4), reference)
+
+    def test_af(self):
+        self.check_parallel(500, mode="af")
+
+    def test_pft_reordered(self):
+        self.check_parallel(3000, mode="pft", reorder=4)
+
+    def test_pft_rs_reordered(self):
+        self.check_parallel(3000, mode="pft-rs", reorder=4)
+
+    def test_pft_rs_reordered_loss(self):
+        self.check_parallel(1500, mode="pft-rs", fragments=12, reorder=6, loss=0.02)
+
+if __name__ == "__main__":
+    unittest.main()
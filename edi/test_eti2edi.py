@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+#
+# Round trip tests of eti2edi and edidebug, run with
+#   python2 -m unittest discover
+# from the edi directory
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+import edigen
+
+EDI_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class RoundTripTest(unittest.TestCase):
+    """Encoding ETI with eti2edi and decoding it with edidebug has to give
+    back the same ETI. The captures are longer than 250 frames, where the
+    ETI FCT wraps and the EDI FCT goes on with fcth."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="eti2edi-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def round_trip(self, num_frames, *options):
+        eti_filename = os.path.join(self.tmpdir, "in.eti")
+        edi_filename = os.path.join(self.tmpdir, "out.edi")
+        out_filename = os.path.join(self.tmpdir, "out.eti")
+
+        eti = b"".join(edigen.synthetic_eti(num_frames))
+        with open(eti_filename, "wb") as fd:
+            fd.write(eti)
+
+        with open(os.devnull, "wb") as devnull:
+            subprocess.check_call([sys.executable, os.path.join(EDI_DIR, "eti2edi.py"),
+                "-f", eti_filename, "-o", edi_filename] + list(options), stderr=devnull)
+        stats = subprocess.check_output([sys.executable, os.path.join(EDI_DIR, "edidebug.py"),
+            "-f", edi_filename, "-o", out_filename, "--stats"])
+        stats = json.loads(stats)
+
+        self.assertEqual(stats['frames'], num_frames)
+        self.assertEqual(stats['fct_discontinuities'], 0)
+        with open(out_filename, "rb") as fd:
+            self.assertTrue(fd.read() == eti, "Decoded ETI differs")
+
+    def test_af(self):
+        self.round_trip(600)
+
+    def test_af_fct_wrap(self):
+        # The EDI FCT wraps at 5000
+        self.round_trip(5100)
+
+    def test_pft(self):
+        self.round_trip(600, "-F", "4")
+
+    def test_pft_rs(self):
+        self.round_trip(600, "-r", "-F", "6")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+#
+# Receive EDI over UDP, unicast or multicast, in batches of datagrams
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import errno
+import select
+import socket
+import struct
+
+# Largest UDP payload
+MAX_DATAGRAM_SIZE = 65536
+
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+
+def parse_address(address):
+    """Parse "port", "ip:port" or ":port" into an (ip, port) tuple, where ip
+    is "" for all local addresses"""
+    if ":" in address:
+        ip, port = address.rsplit(":", 1)
+    else:
+        ip, port = "", address
+    return ip, int(port)
+
+def is_multicast(ip):
+    try:
+        return 224 <= int(ip.split(".")[0]) <= 239
+    except ValueError:
+        return False
+
+class DatagramStream:
+    """One received datagram, with the peek(), read() and tell() interface
+    of BufferedFile. Both return views into data. For the receive buffer,
+    which gets reused for the next batch, persistent is False: data that
+    has to be kept must be copied."""
+
+    def __init__(self, data, persistent=False):
+        self.data = data
+        self.pos = 0
+        self.persistent = persistent
+
+    def peek(self, n):
+        return self.data[self.pos:self.pos + n]
+
+    def read(self, n):
+        ret = self.data[self.pos:self.pos + n]
+        self.pos += len(ret)
+        return ret
+
+    def tell(self):
+        return self.pos
+
+class UdpReceiver:
+    """Receive datagrams on a UDP port. If ip is a multicast group, it gets
+    joined on the interface with the given local address.
+
+    receive() waits for data, and then reads everything that is available,
+    up to batch_size datagrams, into preallocated buffers."""
+
+    def __init__(self, ip, port, interface="0.0.0.0", batch_size=64,
+            max_size=MAX_DATAGRAM_SIZE):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        except socket.error:
+            pass
+
+        self.sock.bind((ip, port))
+
+        if is_multicast(ip):
+            mreq = struct.pack("4s4s", socket.inet_aton(ip), socket.inet_aton(interface))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+        self.sock.setblocking(False)
+
+        self.max_size = max_size
+        self.buf = bytearray(batch_size * max_size)
+        self.slots = [memoryview(self.buf)[i * max_size:(i + 1) * max_size]
+                for i in range(batch_size)]
+
+        self.num_datagrams = 0
+        self.num_batches = 0
+        self.num_oversized = 0
+
+    def receive(self, timeout=None):
+        """Wait for datagrams, and return them as a list of DatagramStreams,
+        valid until the next call. Returns an empty list if nothing arrived
+        within timeout seconds."""
+        streams = []
+        while not streams:
+            for slot in self.slots:
+                try:
+                    n = self.sock.recv_into(slot)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    elif e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                if n == self.max_size:
+                    # probably truncated
+                    self.num_oversized += 1
+                streams.append(DatagramStream(slot[:n]))
+
+            if not streams:
+                readable, _, _ = select.select([self.sock], [], [], timeout)
+                if not readable:
+                    return streams
+
+        self.num_datagrams += len(streams)
+        self.num_batches += 1
+        return streams
+
+    def stats(self):
+        return {'datagrams': self.num_datagrams,
+                'batches': self.num_batches,
+                'oversized': self.num_oversized}
+
+    def fileno(self):
+        """For select()"""
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python2
+#
+# Send EDI over UDP to unicast and multicast destinations
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import sys
+import errno
+import socket
+
+from udpreceiver import parse_address, is_multicast
+
+# Errors that mean that the packet could not be sent right now
+DROP_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+def parse_destination(spec):
+    """Parse "IP:PORT[,ttl=N][,iface=IP][,src=PORT]" into the arguments
+    of Destination"""
+    fields = spec.split(",")
+    ip, port = parse_address(fields[0])
+    if not ip:
+        raise ValueError("Destination {} has no IP address".format(spec))
+
+    options = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition("=")
+        if key == "ttl":
+            options['ttl'] = int(value)
+        elif key == "iface":
+            options['interface'] = value
+        elif key == "src":
+            options['source_port'] = int(value)
+        else:
+            raise ValueError("Unknown destination option {}".format(field))
+    return (ip, port), options
+
+class Destination:
+    """A non-blocking UDP socket sending to one destination. For multicast,
+    ttl and interface (a local address) select the multicast TTL and the
+    outgoing interface. With source_port, the socket is bound to it.
+
+    send() never blocks: packets that cannot be sent are counted as
+    dropped, and errors are counted and reported when they start."""
+
+    def __init__(self, address, ttl=None, interface=None, source_port=None):
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        if source_port is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((interface or "", source_port))
+
+        if is_multicast(address[0]):
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                    ttl if ttl is not None else 1)
+            if interface is not None:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                        socket.inet_aton(interface))
+        elif ttl is not None:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+
+        self.sock.setblocking(False)
+
+        self.num_sent = 0
+        self.num_dropped = 0
+        self.num_errors = 0
+        self.failing = False
+
+    def send(self, packet):
+        try:
+            self.sock.sendto(packet, self.address)
+        except socket.error as e:
+            if e.errno in DROP_ERRNOS:
+                self.num_dropped += 1
+            else:
+                self.num_errors += 1
+                if not self.failing:
+                    sys.stderr.write("Sending to {}:{} failed: {}\n".format(
+                        self.address[0], self.address[1], e))
+                    self.failing = True
+        else:
+            self.num_sent += 1
+            self.failing = False
+
+    def stats(self):
+        return {'sent': self.num_sent,
+                'dropped': self.num_dropped,
+                'errors': self.num_errors}
+
+    def close(self):
+        self.sock.close()
+
+    def __repr__(self):
+        return "{}:{}".format(*self.address)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+#
+# Publish ETI frames over ZeroMQ, in the format of the ODR-DabMux ZeroMQ
+# output that ODR-DabMod and zmqtest/zmq-sub receive
+#
+# Every message carries four ETI frames: a zmq_dab_message_t header with
+# the version and the length of each frame, the frames, and then the
+# metadata of each frame as a list of TLV items closed by a separation
+# marker.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Matthias P. Braendli
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+import struct
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+from edidecoder import ETI_FRAME_SIZE
+
+NUM_FRAMES_PER_ZMQ_MESSAGE = 4
+ZMQ_MESSAGE_VERSION = 1
+
+# zmq_dab_message_t: version and buflen[4], in the byte order of the
+# machines ODR-DabMux runs on
+zmq_header_struct = "<I4h"
+ZMQ_HEADER_SIZE = struct.calcsize(zmq_header_struct)
+
+# Metadata of one frame: utc_offset, edi_time and dlfc items, each with id
+# and length, and the separation marker
+zmq_metadata_struct = "!BHh" "BHL" "BHH" "BH"
+ZMQ_METADATA_SIZE = struct.calcsize(zmq_metadata_struct)
+
+ZMQ_MESSAGE_SIZE = (ZMQ_HEADER_SIZE +
+        NUM_FRAMES_PER_ZMQ_MESSAGE * (ETI_FRAME_SIZE + ZMQ_METADATA_SIZE))
+
+# The UTCO of the EDI deti TAG item is TAI-UTC minus 32
+UTCO_OFFSET = 32
+
+class ZmqEtiWriter:
+    """Publishes ETI frames on a ZeroMQ PUB socket bound to endpoint, with
+    the same interface as EtiWriter.
+
+    The frames are built in place in the message, which is given to ZeroMQ
+    without copy. ZeroMQ keeps the buffer until the message is sent, so
+    every message gets a new one. The metadata comes from the timestamp of
+    the deti TAG item, it is zero for frames without timestamp.
+
+    If pacer is set, it is waited on before every message, to publish a
+    file in real time. Frames that do not fill a message when flush() is
+    called are dropped, the message format has no room for them."""
+
+    def __init__(self, endpoint, pacer=None, context=None):
+        if zmq is None:
+            raise ImportError("ZmqEtiWriter needs pyzmq")
+        self.context = context if context is not None else zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.bind(endpoint)
+        self.pacer = pacer
+
+        self.message = None
+        self.num = 0
+
+        self.num_messages = 0
+        self.num_frames = 0
+        self.num_dropped = 0
+
+    def write(self, eti_data):
+        if self.message is None:
+            self.message = bytearray(ZMQ_MESSAGE_SIZE)
+
+        offset = ZMQ_HEADER_SIZE + self.num * ETI_FRAME_SIZE
+        eti_data.build_eti(self.message, offset)
+
+        fc = eti_data.fc
+        if fc.get('ATSTF'):
+            utc_offset = fc['UTCO'] + UTCO_OFFSET
+            edi_time = fc['SECONDS']
+        else:
+            utc_offset = 0
+            edi_time = 0
+        offset = (ZMQ_HEADER_SIZE + NUM_FRAMES_PER_ZMQ_MESSAGE * ETI_FRAME_SIZE +
+                self.num * ZMQ_METADATA_SIZE)
+        struct.pack_into(zmq_metadata_struct, self.message, offset,
+                1, 2, utc_offset,
+                2, 4, edi_time,
+                3, 2, fc['FCT'],
+                0, 0)
+
+        self.num += 1
+        if self.num == NUM_FRAMES_PER_ZMQ_MESSAGE:
+            self.send()
+
+    def send(self):
+        struct.pack_into(zmq_header_struct, self.message, 0, ZMQ_MESSAGE_VERSION,
+                *([ETI_FRAME_SIZE] * NUM_FRAMES_PER_ZMQ_MESSAGE))
+        if self.pacer:
+            self.pacer.wait()
+        self.socket.send(self.message, copy=False)
+        self.num_messages += 1
+        self.num_frames += self.num
+        self.message = None
+        self.num = 0
+
+    def flush(self):
+        self.num_dropped += self.num
+        self.message = None
+        self.num = 0
+
+    def close(self):
+        self.flush()
+        # Do not hang on exit if a subscriber stopped reading
+        self.socket.close(linger=1000)
+
+    def stats(self):
+        d = {'messages': self.num_messages,
+             'frames': self.num_frames,
+             'dropped_frames': self.num_dropped}
+        if self.pacer:
+            d['pacer'] = self.pacer.stats()
+        return d
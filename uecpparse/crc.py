@@ -0,0 +1 @@
+../edi/crc.py
\ No newline at end of file